@@ -18,6 +18,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'scheduler.encoding.CompressionMiddleware',
 ]
 
 ROOT_URLCONF = 'battles.urls'
@@ -73,6 +74,125 @@ USE_TZ = True
 STATIC_URL = '/static/'
 STATIC_ROOT = f'{BASE_DIR}/static'
 WARGAMING_API = os.environ.get('WARGAMING_API', 'demo')
+# Base URL of WG APIs stand-in for load testing, e.g. http://localhost:8001/
+# of manage.py wg_standin. Real WG APIs are used if empty.
+WG_API_URL = os.environ.get('WG_API_URL')
 
 # MSK Prime_time  starts at 9 AM UTC
 PRIME_STARTS_AT_HOUR = 9
+
+# WG realms: PAPI region and language, game API URL and hour (UTC)
+# when battles of the next day start
+DEFAULT_REALM = 'ru'
+REALMS = {
+    'ru': {
+        'region': 'ru',
+        'language': 'ru',
+        'game_api': 'https://ru.wargaming.net/globalmap/game_api',
+        'prime_starts_at_hour': PRIME_STARTS_AT_HOUR,
+    },
+    'eu': {
+        'region': 'eu',
+        'language': 'en',
+        'game_api': 'https://eu.wargaming.net/globalmap/game_api',
+        'prime_starts_at_hour': 12,
+    },
+    'na': {
+        'region': 'na',
+        'language': 'en',
+        'game_api': 'https://na.wargaming.net/globalmap/game_api',
+        'prime_starts_at_hour': 18,
+    },
+}
+# Realms served by this worker, realm traffic can be routed by
+# /<realm>/ URL prefix to dedicated workers, e.g. SERVED_REALMS=eu,na
+SERVED_REALMS = os.environ.get('SERVED_REALMS', ','.join(REALMS)).split(',')
+
+# In-process LRU cache in front of memcache for WG API data: max number
+# of entries (0 disables it) and max seconds to keep an entry
+MEMCACHE_L1_SIZE = int(os.environ.get('MEMCACHE_L1_SIZE', 1000))
+MEMCACHE_L1_LIFETIME = 2
+
+# Single filler of cache entries missed by several workers at once: seconds
+# the lease is kept if the filler dies, max seconds other workers wait for
+# the value (they fetch it too after that) and seconds between checks
+CACHE_LEASE_TIMEOUT = 10
+CACHE_LEASE_WAIT = 3
+CACHE_LEASE_POLL = 0.05
+# Threads refreshing stale cached values in background
+CACHE_REFRESH_WORKERS = 4
+
+# Clan lookups: seconds to cache "not found" answers of WG API, seconds
+# between rebuilds of in-memory filter of clan tags known in DB and
+# false positive rate of the filter
+CLAN_NOT_FOUND_LIFETIME = 60
+KNOWN_TAGS_REFRESH = 300
+KNOWN_TAGS_ERROR_RATE = 0.01
+
+# Max number of clans in a single /update_many/ request
+MAX_CLANS_PER_REQUEST = 50
+
+# Max hours of battles window from now, e.g. /update/TAG?hours=6
+MAX_WINDOW_HOURS = 7 * 24
+
+# Server-Sent Events: seconds between checks for timetable changes
+# and between heartbeat messages of idle connections
+PUSH_INTERVAL = 10
+PUSH_HEARTBEAT = 15
+
+# Responses smaller than COMPRESS_MIN_LENGTH bytes are sent uncompressed
+COMPRESS_MIN_LENGTH = 1024
+COMPRESS_GZIP_LEVEL = 6
+COMPRESS_BROTLI_QUALITY = 5
+
+# Concurrent calls to WG APIs: pool size and overall deadline in seconds
+# of a fan-out, calls themselves are bounded by HTTP timeouts below
+UPSTREAM_WORKERS = 16
+UPSTREAM_TIMEOUT = 30
+
+# HTTP requests to WG APIs: timeouts in seconds, retries on 5xx/timeouts
+# with jittered exponential backoff, keep-alive connections per host
+UPSTREAM_CONNECT_TIMEOUT = 3.05
+UPSTREAM_READ_TIMEOUT = 5
+UPSTREAM_RETRIES = 2
+UPSTREAM_BACKOFF = 0.5
+UPSTREAM_BACKOFF_MAX = 4
+UPSTREAM_POOLS = {
+    'default': 4,
+    'api.worldoftanks.ru': UPSTREAM_WORKERS,
+    'ru.wargaming.net': UPSTREAM_WORKERS,
+    'api.worldoftanks.eu': UPSTREAM_WORKERS,
+    'eu.wargaming.net': UPSTREAM_WORKERS,
+    'api.worldoftanks.com': UPSTREAM_WORKERS,
+    'na.wargaming.net': UPSTREAM_WORKERS,
+}
+
+# Rate limits of WG APIs shared by all workers: {host: (requests per second, burst)}
+# Part of the burst is reserved for interactive requests, background work
+# (tags backfill) can't use it
+UPSTREAM_RATE_LIMITS = {
+    'api.worldoftanks.ru': (10, 10),
+    'ru.wargaming.net': (5, 5),
+    'api.worldoftanks.eu': (10, 10),
+    'eu.wargaming.net': (5, 5),
+    'api.worldoftanks.com': (10, 10),
+    'na.wargaming.net': (5, 5),
+}
+UPSTREAM_RATE_LIMIT_RESERVE = 0.5
+UPSTREAM_RATE_LIMIT_WAIT = 5
+UPSTREAM_BACKGROUND_RATE_LIMIT_WAIT = 60
+
+# Circuit breaker of WG API endpoints: calls are stopped for cool-down seconds
+# after failures in a row, last known good payloads (kept for lifetime
+# seconds) are served instead
+UPSTREAM_BREAKER_FAILURES = 5
+UPSTREAM_BREAKER_COOLDOWN = 30
+UPSTREAM_LAST_GOOD_LIFETIME = 24 * 60 * 60
+# Seconds timetables of clans are served with Warning: 110 after their
+# provinces were refreshed with last known good data
+TIMETABLE_STALE_LIFETIME = 60
+
+# Seconds to keep hourly counters of traffic received from WG APIs,
+# counters are aggregated in process and flushed every interval seconds
+TRAFFIC_LIFETIME = 7 * 24 * 60 * 60
+TRAFFIC_FLUSH_INTERVAL = 10
@@ -1,14 +1,24 @@
-from django.urls import path
+from django.urls import path, include
 from django.views.generic.base import RedirectView
 from django.conf import settings
 from django.conf.urls.static import static
 
-from scheduler.views import FetchClanDataView, UpdateAllProvinces
+from scheduler.views import FetchClanDataView, FetchClansDataView, UpdateAllProvinces, \
+    ClanEventsView, ProvinceEventsView
 from .views import IndexView
 
+# realm API, URLs without realm prefix are of settings.DEFAULT_REALM
+realm_urlpatterns = [
+    path('update_many/', FetchClansDataView.as_view()),
+    path('update/<int:clan_id>-<slug:clan_tag>', FetchClanDataView.as_view()),
+    path('update/<slug:clan_tag>', FetchClanDataView.as_view()),
+    path('events/clan/<slug:clan_tag>', ClanEventsView.as_view()),
+    path('events/province/<slug:front_id>/<slug:province_id>', ProvinceEventsView.as_view()),
+]
+
 urlpatterns = [
     path('', IndexView.as_view(), name='home'),
     path('update_all/', UpdateAllProvinces.as_view()),
-    path('update/<int:clan_id>-<slug:clan_tag>', FetchClanDataView.as_view()),
-    path('update/<slug:clan_tag>', FetchClanDataView.as_view()),
+    path('', include(realm_urlpatterns)),
+    path('<slug:realm>/', include(realm_urlpatterns)),
 ] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
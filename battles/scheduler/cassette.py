@@ -0,0 +1,119 @@
+"""Record/replay of upstream HTTP traffic
+
+Cassette is a gzipped file with a JSON line per request: url, params,
+status, body and latency of the response (or error of the request).
+WG application id isn't stored, so a cassette can be replayed with another one.
+In replay mode responses are served from the cassette without network,
+responses for the same request are served in the recorded order.
+"""
+import gzip
+import json
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from datetime import timedelta
+from urllib.parse import urlencode
+
+import requests
+from requests.exceptions import RequestException, ConnectionError
+
+RECORD = 'record'
+REPLAY = 'replay'
+
+
+class CassetteMiss(RequestException):
+    pass
+
+
+# params which aren't stored, cassette can be replayed with other values
+SECRET_PARAMS = {'application_id'}
+
+
+def request_key(url, params):
+    params = sorted((k, str(v)) for k, v in (params or {}).items() if k not in SECRET_PARAMS)
+    return f'{url}?{urlencode(params)}'
+
+
+def hide_secrets(text, params):
+    for name in SECRET_PARAMS & (params or {}).keys():
+        text = text.replace(str(params[name]), '***')
+    return text
+
+
+class Cassette:
+    def __init__(self, path, mode, preserve_latency=False):
+        self.path = path
+        self.mode = mode
+        self.preserve_latency = preserve_latency
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.file = None
+        if mode == RECORD:
+            self.file = gzip.open(path, 'wt', encoding='utf-8')
+        else:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self.entries.setdefault(entry['key'], deque()).append(entry)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+    def record(self, url, params, started_at, response=None, error=None):
+        entry = {
+            'key': request_key(url, params),
+            'latency': round(time.perf_counter() - started_at, 4),
+        }
+        if error is not None:
+            # error message can contain URL with all params
+            entry['error'] = hide_secrets(f'{error.__class__.__name__}: {error}', params)
+        else:
+            entry.update(
+                status=response.status_code,
+                content_type=response.headers.get('Content-Type'),
+                body=response.text,
+            )
+        line = json.dumps(entry, ensure_ascii=False, separators=(',', ':'))
+        with self.lock:
+            self.file.write(line + '\n')
+
+    def replay(self, url, params):
+        key = request_key(url, params)
+        with self.lock:
+            entries = self.entries.get(key)
+            if not entries:
+                raise CassetteMiss(f'{key} is not recorded')
+            # the last response is served for all following requests
+            entry = entries.popleft() if len(entries) > 1 else entries[0]
+        if self.preserve_latency:
+            time.sleep(entry['latency'])
+        if 'error' in entry:
+            raise ConnectionError(f'Recorded error: {entry["error"]}')
+
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.url = key
+        response.encoding = 'utf-8'
+        response._content = entry['body'].encode('utf-8')
+        if entry['content_type']:
+            response.headers['Content-Type'] = entry['content_type']
+        response.elapsed = timedelta(seconds=entry['latency'])
+        return response
+
+
+# cassette in use is shared by all threads, including upstream calls pool
+active = None
+
+
+@contextmanager
+def use_cassette(path, mode, preserve_latency=False):
+    """Record upstream traffic to the file or replay it from the file"""
+    global active
+    active = Cassette(path, mode, preserve_latency)
+    try:
+        yield active
+    finally:
+        active.close()
+        active = None
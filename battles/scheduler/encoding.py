@@ -0,0 +1,111 @@
+"""Fast JSON encoding and response compression
+
+orjson and brotli are used if installed, with json and gzip as fallback.
+"""
+import json
+import gzip
+import re
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.cache import patch_vary_headers
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class TimetableJSONEncoder(DjangoJSONEncoder):
+    def default(self, o):
+        if hasattr(o, 'to_json'):
+            return o.to_json()
+        return super().default(o)
+
+
+def _default(o):
+    # called by orjson only for types it can't serialize natively (Clan)
+    return o.to_json()
+
+
+def dumps(data):
+    """Serialize data to JSON str
+
+    datetimes, dates and times are serialized natively, other objects
+    with to_json() method.
+    """
+    if orjson is not None:
+        return orjson.dumps(
+            data, default=_default,
+            option=orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS,
+        ).decode()
+    return json.dumps(data, cls=TimetableJSONEncoder, separators=(',', ':'), ensure_ascii=False)
+
+
+def parse_accept_encoding(header):
+    """Returns {coding: quality} from Accept-Encoding header"""
+    codings = {}
+    for item in header.split(','):
+        coding, _, params = item.strip().partition(';')
+        match = re.search(r'q=([0-9.]+)', params)
+        try:
+            codings[coding.strip().lower()] = float(match.group(1)) if match else 1.0
+        except ValueError:
+            continue
+    return codings
+
+
+def choose_encoding(header):
+    codings = parse_accept_encoding(header)
+    available = ['br', 'gzip'] if brotli is not None else ['gzip']
+    # server preference on equal quality
+    candidates = [
+        (codings.get(i, codings.get('*', 0)), -n, i)
+        for n, i in enumerate(available)
+    ]
+    quality, _, coding = max(candidates)
+    return coding if quality > 0 else None
+
+
+def compress(content, coding):
+    if coding == 'br':
+        return brotli.compress(content, quality=settings.COMPRESS_BROTLI_QUALITY)
+    return gzip.compress(content, compresslevel=settings.COMPRESS_GZIP_LEVEL, mtime=0)
+
+
+class CompressionMiddleware:
+    """Compress large responses with brotli or gzip negotiated by Accept-Encoding
+
+    Streaming responses (SSE) are passed as is.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if response.streaming or response.has_header('Content-Encoding'):
+            return response
+        if len(response.content) < settings.COMPRESS_MIN_LENGTH:
+            return response
+
+        patch_vary_headers(response, ['Accept-Encoding'])
+        coding = choose_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if coding is None:
+            return response
+
+        content = compress(response.content, coding)
+        if len(content) >= len(response.content):
+            return response
+        response.content = content
+        response['Content-Length'] = str(len(content))
+        response['Content-Encoding'] = coding
+        # compressed representation isn't byte-equal to the original one
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        return response
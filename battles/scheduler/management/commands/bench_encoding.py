@@ -0,0 +1,63 @@
+import json
+from datetime import datetime, time, timedelta
+from timeit import timeit
+import pytz
+
+from django.core.management.base import BaseCommand
+
+from scheduler.encoding import dumps, compress, TimetableJSONEncoder, orjson, brotli
+from scheduler.models import Clan
+
+
+def make_timetable(provinces, rounds):
+    """Timetable of the same shape as get_clan_timetable() returns"""
+    clan = Clan(id=1, tag='CLAN')
+    clans = [Clan(id=1000 + i, tag=f'C{i:03}') for i in range(provinces * 2)]
+    prime = datetime(2017, 12, 13, 18, 0, tzinfo=pytz.UTC)
+    data = []
+    for i in range(provinces):
+        data.append({
+            'owner': clans[i * 2].id,
+            'province_id': f'province_{i}',
+            'arena_name': 'Руинберг',
+            'province_name': f'Провинция {i}',
+            'prime_time': time(18, 0),
+            'rounds': [{
+                'clan_a': clan,
+                'clan_b': clans[i * 2 + 1] if n < rounds - 1 else clans[i * 2],
+                'time': prime + timedelta(minutes=30) * n,
+                'start_at': prime + timedelta(minutes=30) * n + timedelta(seconds=95),
+                'title': f'1/{2 ** (rounds - n - 1)}' if n < rounds - 1 else 'Owner',
+            } for n in range(rounds)],
+            'mode': 'Landing',
+            'server': 'RU6',
+        })
+    return {'clan': {'clan_id': clan.id, 'tag': clan.tag}, 'provinces': data}
+
+
+class Command(BaseCommand):
+    help = 'Benchmark of timetable JSON encoding and compression'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--provinces', type=int, default=50)
+        parser.add_argument('--rounds', type=int, default=6)
+        parser.add_argument('--number', type=int, default=200)
+
+    def handle(self, *args, **options):
+        timetable = make_timetable(options['provinces'], options['rounds'])
+        number = options['number']
+
+        def old_encode():
+            return json.dumps(timetable, cls=TimetableJSONEncoder)
+
+        print(f"Timetable of {options['provinces']} provinces, {number} runs, "
+              f"orjson: {orjson is not None}, brotli: {brotli is not None}")
+        for name, encode in [('json', old_encode), ('dumps', lambda: dumps(timetable))]:
+            seconds = timeit(encode, number=number) / number
+            print(f'{name:>8}: {seconds * 1000:.3f} ms, {len(encode().encode())} bytes')
+
+        content = dumps(timetable).encode()
+        for coding in ['gzip', 'br'] if brotli is not None else ['gzip']:
+            seconds = timeit(lambda: compress(content, coding), number=number) / number
+            size = len(compress(content, coding))
+            print(f'{coding:>8}: {seconds * 1000:.3f} ms, {size} bytes')
@@ -4,7 +4,8 @@ from itertools import zip_longest
 import pytz
 
 from django.core.management.base import BaseCommand, CommandError
-from scheduler.models import Schedule, Clan
+from scheduler.models import Schedule, Clan, ClanInvolvement
+from scheduler.util import invalidate_timetables
 
 provinces_data = [{
     'arena_id': '47_canada_a',
@@ -237,3 +238,5 @@ class Command(BaseCommand):
                 clan_a_tag = clan_a.tag
                 clan_b_tag = clan_b and clan_b.tag
                 print(f"ROUND {round_number}: {clan_a_tag} vs {clan_b_tag} on {s.province_id}")
+
+        invalidate_timetables(s.realm, ClanInvolvement.rebuild([s.id]))
@@ -0,0 +1,46 @@
+from time import perf_counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from scheduler.cassette import use_cassette, RECORD, REPLAY
+from scheduler.upstream import connection_stats
+from scheduler.wgconnect import get_clans_related_provinces
+from scheduler.writer import write_provinces
+
+
+class Command(BaseCommand):
+    help = 'Refresh clans provinces from WG API, traffic can be recorded or replayed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('clan_ids', nargs='+', type=int)
+        parser.add_argument('--realm', default=settings.DEFAULT_REALM, choices=settings.REALMS)
+        parser.add_argument('--record', metavar='CASSETTE')
+        parser.add_argument('--replay', metavar='CASSETTE')
+        parser.add_argument('--latency', action='store_true',
+                            help='Preserve recorded latencies on replay')
+        parser.add_argument('--dry-run', action='store_true', help="Don't write to DB")
+
+    def refresh(self, clan_ids, realm, dry_run):
+        start = perf_counter()
+        provinces = get_clans_related_provinces(clan_ids, realm)
+        # data is fetched lazily by the loader
+        provinces = [i for i in provinces if i.data is not None]
+        fetched = perf_counter()
+        if not dry_run:
+            write_provinces(provinces, realm)
+        print(f'{len(provinces)} provinces fetched in {fetched - start:.3f}s, '
+              f'written in {perf_counter() - fetched:.3f}s')
+
+    def handle(self, *args, **options):
+        if options['record'] and options['replay']:
+            raise CommandError('--record and --replay are mutually exclusive')
+        if options['record']:
+            with use_cassette(options['record'], RECORD):
+                self.refresh(options['clan_ids'], options['realm'], options['dry_run'])
+        elif options['replay']:
+            with use_cassette(options['replay'], REPLAY, options['latency']):
+                self.refresh(options['clan_ids'], options['realm'], options['dry_run'])
+        else:
+            self.refresh(options['clan_ids'], options['realm'], options['dry_run'])
+        print(f'Connections: {connection_stats()}')
@@ -0,0 +1,20 @@
+from datetime import datetime
+import pytz
+
+from django.core.management.base import BaseCommand
+
+from scheduler.upstream import get_traffic
+
+
+class Command(BaseCommand):
+    help = 'Traffic received from WG APIs per endpoint per hour'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, default=24)
+
+    def handle(self, *args, **options):
+        print(f'{"hour (UTC)":<17} {"endpoint":<34} {"calls":>7} {"bytes":>12} {"objects":>8}')
+        for hour, endpoint, counters in sorted(get_traffic(options['hours'])):
+            hour = datetime.fromtimestamp(hour, tz=pytz.UTC).strftime('%Y-%m-%d %H:%M')
+            print(f'{hour:<17} {endpoint:<34} {counters["calls"]:>7} '
+                  f'{counters["bytes"]:>12} {counters["objects"]:>8}')
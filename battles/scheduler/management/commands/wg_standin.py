@@ -0,0 +1,310 @@
+"""Local stand-in of WG APIs for load testing
+
+Serves synthetic global map consistent between PAPI (wot/globalmap,
+wgn/clans) and game API (tournament_info, clan battles) endpoints.
+Tournaments are played in real time: every province starts at its prime
+time, rounds take 30 minutes, the first clan of a pair wins.
+Point the backend at it with WG_API_URL=http://host:port/
+"""
+import json
+import time
+import random
+import threading
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+import pytz
+
+from django.core.management.base import BaseCommand
+
+from scheduler.util import get_battle_date, get_prime_hour
+
+ROUND_DURATION = timedelta(minutes=30)
+
+
+class World:
+    """Synthetic fronts, provinces and clans generated from the seed"""
+    def __init__(self, seed=1, fronts=3, provinces=50, clans=2000, now=None):
+        rnd = random.Random(seed)
+        self.now = now or (lambda: datetime.now(tz=pytz.UTC))
+        self.clans = {1000 + i: f'C{i:04X}' for i in range(clans)}
+        clan_ids = list(self.clans)
+        self.fronts = [f'front_{i}' for i in range(fronts)]
+        self.provinces = {}
+        for front_id in self.fronts:
+            for i in range(provinces):
+                province_id = f'{front_id}_province_{i}'
+                self.provinces[province_id] = {
+                    'front_id': front_id,
+                    'province_id': province_id,
+                    'province_name': f'Province {i}',
+                    'arena_id': f'{i % 30:02}_arena',
+                    'arena_name': f'Arena {i % 30}',
+                    'server': f'RU{i % 10 + 1}',
+                    'prime_time': f'{16 + i % 7:02}:{15 * (i % 4):02}',
+                    'landing_type': 'tournament' if i % 5 == 0 else None,
+                    'owner_clan_id': rnd.choice(clan_ids) if i % 3 else None,
+                    'pretenders': rnd.sample(clan_ids, rnd.choice([2, 3, 5, 8, 12, 16, 24, 32])),
+                }
+
+    def battles_start_at(self, province):
+        # the same world is served for all realms
+        date = get_battle_date(self.now())
+        hour, minute = map(int, province['prime_time'].split(':'))
+        start = datetime(date.year, date.month, date.day, hour, minute, tzinfo=pytz.UTC)
+        if hour < get_prime_hour():
+            start += timedelta(days=1)
+        return start
+
+    def state(self, province):
+        """Returns (status, round_number, clans of current round)"""
+        start = self.battles_start_at(province)
+        now = self.now()
+        if now < start:
+            return 'NOT_STARTED', None, province['pretenders']
+        round_number = int((now - start) / ROUND_DURATION) + 1
+        clans = province['pretenders']
+        for _ in range(round_number - 1):
+            if len(clans) == 1:
+                # last round was played with the owner
+                return 'FINISHED', round_number, []
+            clans = clans[::2]
+        if len(clans) == 1 and province['owner_clan_id'] is None:
+            return 'FINISHED', round_number, []
+        return 'STARTED', round_number, clans
+
+    @staticmethod
+    def pairs(province, clans):
+        """[(clan_a, clan_b), ...] of the round, clan_b is None for clan without opponent"""
+        if len(clans) == 1:
+            return [(clans[0], province['owner_clan_id'])]
+        pairs = [(clans[i], clans[i + 1]) for i in range(0, len(clans) - 1, 2)]
+        if len(clans) % 2:
+            pairs.append((clans[-1], None))
+        return pairs
+
+    def province_data(self, province_id):
+        province = self.provinces[province_id]
+        status, round_number, clans = self.state(province)
+        start_at = self.battles_start_at(province)
+        battles_start_at = start_at.strftime('%Y-%m-%dT%H:%M:%S')
+        active_battles = []
+        if status == 'STARTED':
+            round_start = start_at + ROUND_DURATION * (round_number - 1)
+            active_battles = [{
+                'clan_a': {'clan_id': clan_a},
+                'clan_b': {'clan_id': clan_b},
+                'round': round_number,
+                'start_at': round_start.strftime('%Y-%m-%dT%H:%M:%S'),
+            } for clan_a, clan_b in self.pairs(province, clans) if clan_b is not None]
+        return {
+            'front_id': province['front_id'],
+            'province_id': province_id,
+            'province_name': province['province_name'],
+            'arena_id': province['arena_id'],
+            'arena_name': province['arena_name'],
+            'server': province['server'],
+            'prime_time': province['prime_time'],
+            'battles_start_at': battles_start_at,
+            'owner_clan_id': province['owner_clan_id'],
+            'landing_type': province['landing_type'],
+            'round_number': round_number,
+            'status': status,
+            'attackers': [],
+            'competitors': province['pretenders'] if status != 'FINISHED' else [],
+            'active_battles': active_battles,
+        }
+
+    def tournament_info(self, province_id):
+        province = self.provinces[province_id]
+        status, round_number, clans = self.state(province)
+        battles = []
+        if status == 'STARTED':
+            battles = [{
+                'is_fake': clan_b is None,
+                'first_competitor': {'id': clan_a},
+                'second_competitor': None if clan_b is None else {'id': clan_b},
+            } for clan_a, clan_b in self.pairs(province, clans)]
+        return {'round_number': round_number or 1, 'battles': battles}
+
+    def clan_battles(self, clan_id):
+        battles, planned_battles = [], []
+        for province_id, province in self.provinces.items():
+            if clan_id not in province['pretenders']:
+                continue
+            status, _, clans = self.state(province)
+            item = {'front_id': province['front_id'], 'province_id': province_id}
+            if status == 'NOT_STARTED':
+                planned_battles.append(item)
+            elif clan_id in clans:
+                battles.append(item)
+        return {'battles': battles, 'planned_battles': planned_battles}
+
+    def clan_provinces(self, clan_id):
+        return [
+            {'front_id': province['front_id'], 'province_id': province_id}
+            for province_id, province in self.provinces.items()
+            if province['owner_clan_id'] == clan_id
+        ] or None
+
+
+def papi_ok(data, total=None):
+    return {
+        'status': 'ok',
+        'meta': {'count': len(data), 'total': len(data) if total is None else total},
+        'data': data,
+    }
+
+
+def papi_error(code, message):
+    return {
+        'status': 'error',
+        'error': {'code': code, 'message': message, 'field': None, 'value': None},
+    }
+
+
+def paginate(items, params):
+    limit = int(params.get('limit', 100))
+    page_no = int(params.get('page_no', 1))
+    return items[(page_no - 1) * limit:page_no * limit]
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, world, latency=0, jitter=0, error_rate=0, rate_limit=0):
+        super().__init__(address, Handler)
+        self.world = world
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.lock = threading.Lock()
+        self.second = None
+        self.requests_in_second = 0
+
+    def is_rate_limited(self):
+        if not self.rate_limit:
+            return False
+        with self.lock:
+            second = int(time.time())
+            if second != self.second:
+                self.second, self.requests_in_second = second, 0
+            self.requests_in_second += 1
+            return self.requests_in_second > self.rate_limit
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        url = urlsplit(self.path)
+        path = url.path.strip('/')
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        is_game_api = path.startswith('game_api/')
+
+        if server.latency or server.jitter:
+            time.sleep(max(0, server.latency + random.uniform(-server.jitter, server.jitter)))
+        if server.is_rate_limited():
+            if is_game_api:
+                return self.send_json({'error': 'Too many requests'}, 429)
+            return self.send_json(papi_error(407, 'REQUEST_LIMIT_EXCEEDED'))
+        if random.random() < server.error_rate:
+            if is_game_api:
+                return self.send_json({'error': 'Service unavailable'}, 503)
+            return self.send_json(papi_error(504, 'SOURCE_NOT_AVAILABLE'))
+
+        try:
+            data = self.route(server.world, path, params)
+        except (KeyError, ValueError) as e:
+            return self.send_json(papi_error(402, f'INVALID_PARAMETER {e}'))
+        if data is None:
+            return self.send_json({'error': 'Not found'}, 404)
+        self.send_json(data)
+
+    @staticmethod
+    def route(world, path, params):
+        parts = path.split('/')
+        if path == 'game_api/tournament_info':
+            return world.tournament_info(params['alias'])
+        if parts[:2] == ['game_api', 'clan'] and len(parts) == 4 and parts[3] == 'battles':
+            return world.clan_battles(int(parts[2]))
+        if path == 'wot/globalmap/fronts':
+            fronts = [{'front_id': i, 'front_name': i} for i in world.fronts]
+            return papi_ok(paginate(fronts, params), len(fronts))
+        if path == 'wot/globalmap/provinces':
+            front_id = params['front_id']
+            if 'province_id' in params:
+                provinces = [
+                    world.province_data(i) for i in params['province_id'].split(',')
+                    if i in world.provinces and world.provinces[i]['front_id'] == front_id
+                ]
+                return papi_ok(provinces)
+            provinces = [
+                i for i, province in world.provinces.items() if province['front_id'] == front_id
+            ]
+            return papi_ok([world.province_data(i) for i in paginate(provinces, params)],
+                           len(provinces))
+        if path == 'wot/globalmap/clanprovinces':
+            return papi_ok({
+                i: world.clan_provinces(int(i)) for i in params['clan_id'].split(',')
+            })
+        if path == 'wgn/clans/list':
+            search = params.get('search', '').upper()
+            clans = [
+                {'clan_id': clan_id, 'tag': tag}
+                for clan_id, tag in world.clans.items() if tag.startswith(search)
+            ]
+            return papi_ok(paginate(clans, params), len(clans))
+        if path == 'wgn/clans/info':
+            return papi_ok({
+                i: {'clan_id': int(i), 'tag': world.clans[int(i)]} if int(i) in world.clans else None
+                for i in params['clan_id'].split(',')
+            })
+
+
+class Command(BaseCommand):
+    help = 'Local stand-in of WG APIs with synthetic data for load testing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8001)
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--fronts', type=int, default=3)
+        parser.add_argument('--provinces', type=int, default=50, help='Provinces per front')
+        parser.add_argument('--clans', type=int, default=2000)
+        parser.add_argument('--latency', type=float, default=0.05, help='Seconds')
+        parser.add_argument('--jitter', type=float, default=0.02, help='Seconds')
+        parser.add_argument('--error-rate', type=float, default=0)
+        parser.add_argument('--rate-limit', type=int, default=0,
+                            help='Requests per second, 0 - unlimited')
+
+    def handle(self, *args, **options):
+        world = World(options['seed'], options['fronts'], options['provinces'], options['clans'])
+        server = StandInServer(
+            (options['host'], options['port']), world,
+            latency=options['latency'],
+            jitter=options['jitter'],
+            error_rate=options['error_rate'],
+            rate_limit=options['rate_limit'],
+        )
+        print(f'Serving WG APIs stand-in on http://{options["host"]}:{options["port"]}/, '
+              f'set WG_API_URL to use it')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
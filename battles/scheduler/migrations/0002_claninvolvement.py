@@ -0,0 +1,49 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_involvements(apps, schema_editor):
+    Schedule = apps.get_model('scheduler', 'Schedule')
+    ClanInvolvement = apps.get_model('scheduler', 'ClanInvolvement')
+
+    rows = {}
+    for schedule in Schedule.objects.prefetch_related('pretenders', 'battles'):
+        if schedule.owner_id:
+            rows[(schedule.owner_id, schedule.id, 'owner')] = False
+        for clan in schedule.pretenders.all():
+            rows[(clan.id, schedule.id, 'pretender')] = False
+        for battle in schedule.battles.all():
+            is_current = battle.round == schedule.round_number
+            for clan_id in (battle.clan_a_id, battle.clan_b_id):
+                if clan_id is not None:
+                    key = (clan_id, schedule.id, 'participant')
+                    rows[key] = rows.get(key, False) or is_current
+
+    ClanInvolvement.objects.bulk_create([
+        ClanInvolvement(clan_id=clan_id, schedule_id=schedule_id, role=role, current_round=current)
+        for (clan_id, schedule_id, role), current in rows.items()
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scheduler', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ClanInvolvement',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('role', models.CharField(choices=[('owner', 'Owner'), ('pretender', 'Pretender'), ('participant', 'Round participant')], max_length=11)),
+                ('current_round', models.BooleanField(default=False)),
+                ('clan', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='scheduler.Clan')),
+                ('schedule', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='involvements', to='scheduler.Schedule')),
+            ],
+            options={
+                'unique_together': {('clan', 'schedule', 'role')},
+            },
+        ),
+        migrations.RunPython(fill_involvements, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,53 @@
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def remove_duplicates(apps, schema_editor):
+    """Keep the latest row of duplicated schedules and battles"""
+    Schedule = apps.get_model('scheduler', 'Schedule')
+    ProvinceBattles = apps.get_model('scheduler', 'ProvinceBattles')
+
+    for model, fields in [
+        (Schedule, ('front_id', 'province_id', 'date')),
+        (ProvinceBattles, ('schedule_id', 'round', 'clan_a_id', 'clan_b_id')),
+    ]:
+        duplicates = model.objects.values(*fields). \
+            annotate(count=Count('id'), last_id=Max('id')). \
+            filter(count__gt=1)
+        for duplicate in duplicates:
+            model.objects. \
+                filter(**{field: duplicate[field] for field in fields}). \
+                exclude(id=duplicate['last_id']). \
+                delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scheduler', '0002_claninvolvement'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='schedule',
+            name='status',
+            field=models.CharField(choices=[('NOT_STARTED', 'NOT_STARTED'), ('STARTED', 'STARTED'), ('FINISHED', 'FINISHED')], max_length=11, null=True),
+        ),
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='schedule',
+            unique_together={('front_id', 'province_id', 'date')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='provincebattles',
+            unique_together={('schedule', 'round', 'clan_a', 'clan_b')},
+        ),
+        # NULLs are distinct in unique constraint above,
+        # so battles without opponent need own index
+        migrations.RunSQL(
+            'CREATE UNIQUE INDEX scheduler_provincebattles_no_opponent_uniq '
+            'ON scheduler_provincebattles (schedule_id, round, clan_a_id) '
+            'WHERE clan_b_id IS NULL',
+            'DROP INDEX scheduler_provincebattles_no_opponent_uniq',
+        ),
+    ]
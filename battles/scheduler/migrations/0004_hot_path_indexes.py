@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scheduler', '0003_unique_schedules_and_battles'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='clan',
+            name='tag',
+            field=models.CharField(db_index=True, max_length=5),
+        ),
+        migrations.AddIndex(
+            model_name='schedule',
+            index=models.Index(fields=['date', 'status', 'province_id'], name='scheduler_s_date_2d4c16_idx'),
+        ),
+    ]
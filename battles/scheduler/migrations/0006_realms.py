@@ -0,0 +1,26 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scheduler', '0005_schedule_updated_at'),
+    ]
+
+    operations = [
+        # existing data is from RU realm
+        migrations.AddField(
+            model_name='clan',
+            name='realm',
+            field=models.CharField(default='ru', max_length=4),
+        ),
+        migrations.AddField(
+            model_name='schedule',
+            name='realm',
+            field=models.CharField(default='ru', max_length=4),
+        ),
+        migrations.AlterUniqueTogether(
+            name='schedule',
+            unique_together={('realm', 'front_id', 'province_id', 'date')},
+        ),
+    ]
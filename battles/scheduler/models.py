@@ -2,10 +2,11 @@ import pytz
 import math
 from datetime import datetime, timedelta
 
-from django.db import models
-from django.db.models import Q
+from django.db import models, transaction
 from django.conf import settings
 
+from .util import get_prime_hour
+
 
 def get_rounds_titles(clans_count, current_round, owner=None):
     """Return title for rounds
@@ -34,10 +35,26 @@ def get_rounds_titles(clans_count, current_round, owner=None):
     return titles
 
 
+class ScheduleQuerySet(models.QuerySet):
+    def with_timetable_data(self):
+        """Preload owner, pretenders and battles used by get_battle_times
+
+        Costs 3 queries regardless of the number of schedules.
+        """
+        return self.select_related('owner').prefetch_related(
+            'pretenders',
+            models.Prefetch(
+                'battles',
+                queryset=ProvinceBattles.objects.select_related('clan_a', 'clan_b'),
+            ),
+        )
+
+
 class Schedule(models.Model):
     """Store an attack on province on selected date
 
     """
+    realm = models.CharField(max_length=4, default=settings.DEFAULT_REALM)
     front_id = models.CharField(max_length=255)
     front_name = models.CharField(max_length=255)
     province_id = models.CharField(max_length=255)
@@ -55,35 +72,65 @@ class Schedule(models.Model):
     ))
     round_number = models.IntegerField(null=True)
     # is status needed?
-    status = models.CharField(null=True, max_length=8, choices=(
+    status = models.CharField(null=True, max_length=11, choices=(
         ('NOT_STARTED', 'NOT_STARTED'),
         ('STARTED', 'STARTED'),
         ('FINISHED', 'FINISHED')
     ))
+    # change marker of the writer: set when values of the schedule row are
+    # changed, pretenders and battles don't change it
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = ScheduleQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ('realm', 'front_id', 'province_id', 'date')
+        indexes = [
+            models.Index(fields=['date', 'status', 'province_id']),
+        ]
 
     def __repr__(self):
         return f"<Schedule {self.province_id}@{self.date}>"
 
+    # battles and pretenders are filtered in python to make use of
+    # ScheduleQuerySet.with_timetable_data() prefetched values
+    @property
+    def current_round_battles(self):
+        return [battle for battle in self.battles.all() if battle.round == self.round_number]
+
     @property
     def all_clans(self):
         if self.round_number:
             clans = set()
-            for battle in self.battles.filter(round=self.round_number):
+            for battle in self.current_round_battles:
                 clans.update([battle.clan_a, battle.clan_b])
             return clans - {None}
         else:
             return self.pretenders.all()
 
+    def is_involved(self, clan):
+        """Clan is owner, pretender or has a battle in current round"""
+        return clan.id == self.owner_id or \
+            clan in self.pretenders.all() or \
+            any(clan.id in (battle.clan_a_id, battle.clan_b_id)
+                for battle in self.current_round_battles)
+
+    @property
+    def prime_datetime(self):
+        prime = datetime.combine(self.date, self.prime_time).replace(tzinfo=pytz.UTC)
+        if self.prime_time.hour < get_prime_hour(self.realm):
+            prime += timedelta(days=1)
+        return prime
+
     def get_battle_times(self, clan):
         clans_count = len(set(self.all_clans) - {self.owner})
         print(clans_count)
 
-        today = datetime.combine(self.date, self.prime_time).replace(tzinfo=pytz.UTC)
-        if self.prime_time.hour < settings.PRIME_STARTS_AT_HOUR:
-            today += timedelta(days=1)
+        today = self.prime_datetime
         existing_battles = {
             battle.round - 1: battle
-            for battle in self.battles.filter(Q(clan_a=clan) | Q(clan_b=clan))
+            for battle in self.battles.all()
+            if clan.id in (battle.clan_a_id, battle.clan_b_id)
         }
 
         round_titles = get_rounds_titles(clans_count, self.round_number or 1, self.owner)
@@ -140,6 +187,11 @@ class ProvinceBattles(models.Model):
     round = models.IntegerField()
     start_at = models.DateTimeField()
 
+    class Meta:
+        # battles without opponent (clan_b is NULL) are covered
+        # by partial unique index created in migration 0003
+        unique_together = ('schedule', 'round', 'clan_a', 'clan_b')
+
     def __repr__(self):
         return (
             '<ProvinceBattles %s vs %s ' % (
@@ -151,10 +203,73 @@ class ProvinceBattles(models.Model):
 
 
 class Clan(models.Model):
-    tag = models.CharField(max_length=5)
+    # clan ids are unique across realms, tags are unique only in a realm
+    realm = models.CharField(max_length=4, default=settings.DEFAULT_REALM)
+    tag = models.CharField(max_length=5, db_index=True)
 
     def to_json(self):
         return {'id': self.id, 'tag': self.tag}
 
     def __repr__(self):
         return f'<Clan {self.id}: {self.tag}>'
+
+
+class ClanInvolvement(models.Model):
+    """Denormalized index of clans involved into schedule
+
+    Makes lookup of clan's provinces for the date a single indexed query.
+    Rows are rebuilt with ClanInvolvement.rebuild() on every schedule update.
+    """
+    OWNER = 'owner'
+    PRETENDER = 'pretender'
+    PARTICIPANT = 'participant'
+
+    clan = models.ForeignKey('Clan', on_delete=models.CASCADE, related_name='+')
+    schedule = models.ForeignKey('Schedule', on_delete=models.CASCADE, related_name='involvements')
+    role = models.CharField(max_length=11, choices=(
+        (OWNER, 'Owner'),
+        (PRETENDER, 'Pretender'),
+        (PARTICIPANT, 'Round participant'),
+    ))
+    # participant has a battle in schedule's current round
+    current_round = models.BooleanField(default=False)
+
+    class Meta:
+        unique_together = ('clan', 'schedule', 'role')
+
+    def __repr__(self):
+        return f'<ClanInvolvement {self.clan_id} {self.role} {self.schedule_id}>'
+
+    @classmethod
+    def rebuild(cls, schedule_ids):
+        """Replace involvement rows of schedules with actual owner, pretenders and battles
+
+        Returns ids of clans which were or became involved into schedules
+        """
+        schedules = Schedule.objects.filter(id__in=schedule_ids).prefetch_related(
+            'pretenders', 'battles')
+
+        # (clan_id, schedule_id, role) -> current_round
+        rows = {}
+        for schedule in schedules:
+            if schedule.owner_id:
+                rows[(schedule.owner_id, schedule.id, cls.OWNER)] = False
+            for clan in schedule.pretenders.all():
+                rows[(clan.id, schedule.id, cls.PRETENDER)] = False
+            for battle in schedule.battles.all():
+                is_current = battle.round == schedule.round_number
+                for clan_id in (battle.clan_a_id, battle.clan_b_id):
+                    if clan_id is None:
+                        continue
+                    key = (clan_id, schedule.id, cls.PARTICIPANT)
+                    rows[key] = rows.get(key, False) or is_current
+
+        with transaction.atomic():
+            existing = cls.objects.filter(schedule_id__in=schedule_ids)
+            clan_ids = set(existing.values_list('clan_id', flat=True))
+            existing.delete()
+            cls.objects.bulk_create([
+                cls(clan_id=clan_id, schedule_id=schedule_id, role=role, current_round=current)
+                for (clan_id, schedule_id, role), current in rows.items()
+            ])
+        return clan_ids | {clan_id for clan_id, _, _ in rows}
@@ -0,0 +1,104 @@
+"""Server-Sent Events channels
+
+Every channel (clan or province timetable) has a single poller thread in
+the process, shared by all subscribers of the channel. Poller calls
+poll() function every settings.PUSH_INTERVAL seconds and sends payload
+to subscribers only if its version was changed.
+"""
+import time
+import queue
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connections
+
+
+log = logging.getLogger(__name__)
+
+
+class Channel:
+    def __init__(self, hub, key, poll):
+        """
+        :param key: channel key, e.g. ('clan', 123)
+        :param poll: function returning (version, payload)
+        """
+        self.hub = hub
+        self.key = key
+        self.poll = poll
+        self.subscribers = set()
+        self.version = None
+        self.payload = None
+        self.thread = None
+
+    def subscribe(self):
+        subscriber = queue.Queue()
+        # latest known payload is sent to new subscriber immediately
+        if self.payload is not None:
+            subscriber.put(self.payload)
+        self.subscribers.add(subscriber)
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self.run, name=f'push-{self.key}', daemon=True)
+            self.thread.start()
+        return subscriber
+
+    def broadcast(self, version, payload):
+        with self.hub.lock:
+            self.version, self.payload = version, payload
+            for subscriber in self.subscribers:
+                subscriber.put(payload)
+
+    def run(self):
+        while True:
+            with self.hub.lock:
+                if not self.subscribers:
+                    self.thread = None
+                    del self.hub.channels[self.key]
+                    break
+            try:
+                version, payload = self.poll()
+            except Exception:
+                log.exception('Unable to poll channel %s', self.key)
+            else:
+                if version != self.version:
+                    self.broadcast(version, payload)
+            time.sleep(settings.PUSH_INTERVAL)
+        # DB connections are opened per thread
+        connections.close_all()
+
+
+class Hub:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.channels = {}
+
+    def subscribe(self, key, poll):
+        with self.lock:
+            if key not in self.channels:
+                self.channels[key] = Channel(self, key, poll)
+            return self.channels[key].subscribe()
+
+    def unsubscribe(self, key, subscriber):
+        with self.lock:
+            if key in self.channels:
+                self.channels[key].subscribers.discard(subscriber)
+
+
+hub = Hub()
+
+
+def event_stream(key, poll):
+    """Generator of SSE messages for StreamingHttpResponse"""
+    subscriber = hub.subscribe(key, poll)
+    try:
+        while True:
+            try:
+                payload = subscriber.get(timeout=settings.PUSH_HEARTBEAT)
+            except queue.Empty:
+                # keeps connection open through proxies
+                yield ': heartbeat\n\n'
+            else:
+                yield f'data: {payload}\n\n'
+    finally:
+        hub.unsubscribe(key, subscriber)
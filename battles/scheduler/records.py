@@ -0,0 +1,207 @@
+"""Typed records of WG API data
+
+Upstream payloads are validated before they are cached and parsed once
+into slot-based records. Records support item access, so they can be used
+in place of dicts, and are equal to dicts with the same data.
+"""
+from datetime import datetime, time
+import pytz
+
+
+class ValidationError(ValueError):
+    pass
+
+
+class Record:
+    __slots__ = ()
+
+    def __init__(self, **kwargs):
+        for name, value in kwargs.items():
+            setattr(self, name, value)
+
+    def __getitem__(self, item):
+        try:
+            return getattr(self, item)
+        except AttributeError:
+            raise KeyError(item)
+
+    def __setitem__(self, item, value):
+        setattr(self, item, value)
+
+    def __contains__(self, item):
+        return hasattr(self, item)
+
+    def get(self, item, default=None):
+        return getattr(self, item, default)
+
+    def to_dict(self):
+        """Fields which are set, nested records are converted too"""
+        return {
+            name: _to_dict(getattr(self, name))
+            for name in self.__slots__ if hasattr(self, name)
+        }
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            other = other.to_dict()
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self.to_dict()}>'
+
+
+def _to_dict(value):
+    if isinstance(value, Record):
+        return value.to_dict()
+    if isinstance(value, list):
+        return [_to_dict(i) for i in value]
+    return value
+
+
+class ClanRef(Record):
+    __slots__ = ('clan_id',)
+
+
+class Battle(Record):
+    __slots__ = ('clan_a', 'clan_b', 'start_at', 'round')
+
+
+class Province(Record):
+    __slots__ = (
+        'front_id', 'front_name', 'province_id', 'province_name', 'arena_id', 'arena_name',
+        'server', 'prime_time', 'battles_start_at', 'owner_clan_id', 'landing_type',
+        'round_number', 'status', 'pretenders', 'active_battles', 'stale',
+    )
+
+
+STATUSES = {'NOT_STARTED', 'STARTED', 'FINISHED', None}
+
+
+def _check(condition, message, *args):
+    if not condition:
+        raise ValidationError(message % args)
+
+
+def _field(data, name, types, required=True):
+    if name not in data:
+        _check(not required, 'Field %s is missing', name)
+        return
+    value = data[name]
+    _check(isinstance(value, types), 'Field %s has invalid value %r', name, value)
+    return value
+
+
+def parse_datetime(value):
+    """WG API timestamps are ISO 8601 in UTC without timezone"""
+    if isinstance(value, datetime):
+        return value
+    _check(isinstance(value, str), 'Invalid datetime %r', value)
+    try:
+        dt = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValidationError(f'Invalid datetime {value!r}')
+    return dt if dt.tzinfo else dt.replace(tzinfo=pytz.UTC)
+
+
+def parse_time(value):
+    if isinstance(value, time):
+        return value
+    _check(isinstance(value, str), 'Invalid time %r', value)
+    try:
+        return time.fromisoformat(value)
+    except ValueError:
+        raise ValidationError(f'Invalid time {value!r}')
+
+
+def parse_clan_ref(data, nullable=False):
+    _check(isinstance(data, dict), 'Invalid clan %r', data)
+    clan_id = _field(data, 'clan_id', (int, type(None)) if nullable else int)
+    return ClanRef(clan_id=clan_id)
+
+
+def parse_battle(data):
+    if isinstance(data, Battle):
+        return data
+    _check(isinstance(data, dict), 'Invalid battle %r', data)
+    return Battle(
+        clan_a=parse_clan_ref(_field(data, 'clan_a', dict)),
+        # clan without opponent
+        clan_b=parse_clan_ref(_field(data, 'clan_b', dict), nullable=True),
+        start_at=parse_datetime(_field(data, 'start_at', (str, datetime))),
+        round=_field(data, 'round', int),
+    )
+
+
+def parse_province(data):
+    """Validate province data from PAPI and make Province record
+
+    Raises ValidationError for malformed data.
+    """
+    if isinstance(data, Province):
+        return data
+    _check(isinstance(data, dict), 'Invalid province %r', data)
+    province = Province(
+        front_id=_field(data, 'front_id', str),
+        province_id=_field(data, 'province_id', str),
+        prime_time=parse_time(_field(data, 'prime_time', (str, time))),
+        battles_start_at=parse_datetime(_field(data, 'battles_start_at', (str, datetime))),
+        pretenders=_field(data, 'pretenders', list),
+        active_battles=[parse_battle(i) for i in _field(data, 'active_battles', list)],
+    )
+    _check(all(isinstance(i, int) for i in province.pretenders),
+           'Invalid pretenders %r', province.pretenders)
+    for name, types in [
+        ('front_name', str),
+        ('province_name', str),
+        ('arena_id', str),
+        ('arena_name', str),
+        ('server', str),
+        ('landing_type', (str, type(None))),
+        ('owner_clan_id', (int, type(None))),
+        ('round_number', (int, type(None))),
+        ('status', (str, type(None))),
+        ('stale', bool),
+    ]:
+        if name in data:
+            province[name] = _field(data, name, types)
+    _check(province.get('status') in STATUSES, 'Unknown status %r', province.get('status'))
+    return province
+
+
+def validate_papi_province(data):
+    """Validate province payload of PAPI globalmap.provinces, returns it as is
+
+    Pretenders of PAPI province are its competitors and attackers.
+    """
+    _check(isinstance(data, dict), 'Invalid province %r', data)
+    parse_province(dict(
+        data, pretenders=_field(data, 'competitors', list) + _field(data, 'attackers', list)))
+    return data
+
+
+def validate_tournament_info(data):
+    """Validate game API tournament_info payload, returns it as is"""
+    _check(isinstance(data, dict), 'Invalid tournament info %r', data)
+    _field(data, 'round_number', int)
+    for battle in _field(data, 'battles', list):
+        _check(isinstance(battle, dict), 'Invalid battle %r', battle)
+        is_fake = _field(battle, 'is_fake', bool)
+        _field(_field(battle, 'first_competitor', dict), 'id', int)
+        if not is_fake:
+            _field(_field(battle, 'second_competitor', dict), 'id', int)
+    return data
+
+
+def validate_clan_battles(data):
+    """Validate game API clan battles payload, returns it as is"""
+    _check(isinstance(data, dict), 'Invalid clan battles %r', data)
+    for name in ('battles', 'planned_battles'):
+        for battle in _field(data, name, list):
+            _check(isinstance(battle, dict), 'Invalid battle %r', battle)
+            _field(battle, 'front_id', str)
+            _field(battle, 'province_id', str)
+    return data
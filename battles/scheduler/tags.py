@@ -0,0 +1,121 @@
+"""In-memory filter of clan tags known in DB
+
+Bloom filter per realm: tag missing in the filter is not in DB for sure,
+so DB lookup of such tag is skipped. Filters are rebuilt from Clan table
+every settings.KNOWN_TAGS_REFRESH seconds, tags saved by this process
+are added at once.
+
+A filter is rebuilt by a single request outside of the lock and swapped
+in when it's ready, other requests keep using the old filter meanwhile.
+"""
+import re
+import math
+import hashlib
+import threading
+from time import monotonic
+
+from django.conf import settings
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from .models import Clan
+
+# WG clan tags are 2-5 chars long
+TAG_RE = re.compile(r'^[A-Z0-9_-]{2,5}$')
+
+
+def is_valid_tag(tag):
+    return bool(TAG_RE.match(tag))
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate):
+        capacity = max(capacity, 1)
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for i in self._positions(item):
+            self.bits[i >> 3] |= 1 << (i & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[i >> 3] & (1 << (i & 7)) for i in self._positions(item))
+
+
+class KnownTags:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # realm -> (built_at, filter)
+        self._filters = {}
+        # realm -> tags added while the filter is being rebuilt
+        self._building = {}
+
+    def _build(self, realm):
+        tags = list(
+            Clan.objects.filter(realm=realm).exclude(tag='').values_list('tag', flat=True))
+        # room for tags added before the next rebuild
+        tags_filter = BloomFilter(int(len(tags) * 1.2) + 1000, settings.KNOWN_TAGS_ERROR_RATE)
+        for tag in tags:
+            tags_filter.add(tag)
+        return tags_filter
+
+    def _rebuild(self, realm):
+        """Rebuild filter of realm unless other thread is rebuilding it
+
+        Returns False if the filter is being rebuilt by other thread.
+        """
+        with self._lock:
+            if realm in self._building:
+                return False
+            built_at, _ = self._filters.get(realm, (None, None))
+            if built_at is not None and monotonic() - built_at <= settings.KNOWN_TAGS_REFRESH:
+                # rebuilt by other thread
+                return True
+            self._building[realm] = []
+        tags_filter = None
+        try:
+            tags_filter = self._build(realm)
+        finally:
+            with self._lock:
+                added = self._building.pop(realm)
+                if tags_filter is not None:
+                    for tag in added:
+                        tags_filter.add(tag)
+                    self._filters[realm] = (monotonic(), tags_filter)
+        return True
+
+    def might_exist(self, realm, tag):
+        """False if clan with the tag is not in DB for sure"""
+        built_at, _ = self._filters.get(realm, (None, None))
+        if built_at is None or monotonic() - built_at > settings.KNOWN_TAGS_REFRESH:
+            if not self._rebuild(realm) and built_at is None:
+                # the first filter of realm isn't ready yet
+                return True
+        return tag in self._filters[realm][1]
+
+    def add(self, realm, tag):
+        with self._lock:
+            if realm in self._filters:
+                self._filters[realm][1].add(tag)
+            if realm in self._building:
+                self._building[realm].append(tag)
+
+    def clear(self):
+        with self._lock:
+            self._filters.clear()
+
+
+known_tags = KnownTags()
+
+
+@receiver(post_save, sender=Clan)
+def add_known_tag(sender, instance, **kwargs):
+    if instance.tag:
+        known_tags.add(instance.realm, instance.tag)
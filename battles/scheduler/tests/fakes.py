@@ -0,0 +1,50 @@
+class FakeMemcache:
+    """In-memory memcache client, values are not expired"""
+    def __init__(self):
+        self.data = {}
+
+    def gets(self, key):
+        if key not in self.data:
+            return None, None
+        return self.data[key]
+
+    def add(self, key, value, **kwargs):
+        if key in self.data:
+            return False
+        self.data[key] = (value, 1)
+        return True
+
+    def cas(self, key, value, cas, **kwargs):
+        if self.data[key][1] != cas:
+            return False
+        self.data[key] = (value, cas + 1)
+        return True
+
+    def get(self, key):
+        return self.gets(key)[0]
+
+    def set(self, key, value, **kwargs):
+        self.data[key] = (value, 1)
+
+    def get_many(self, keys):
+        return {i: self.data[i][0] for i in keys if i in self.data}
+
+    def incr(self, key, value, **kwargs):
+        if key not in self.data:
+            return None
+        self.data[key] = (str(int(self.data[key][0]) + value), 1)
+        return int(self.data[key][0])
+
+    def set_many(self, values, **kwargs):
+        for key, value in values.items():
+            self.set(key, value)
+
+    def delete_many(self, keys, **kwargs):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def add_many(self, values, **kwargs):
+        return [key for key, value in values.items() if self.add(key, value)]
+
+    def incr_many(self, values, **kwargs):
+        return {key: self.incr(key, value) for key, value in values.items()}
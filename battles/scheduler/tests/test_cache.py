@@ -0,0 +1,220 @@
+from unittest.mock import patch, Mock
+
+from django.test import SimpleTestCase, override_settings
+
+from scheduler import upstream
+from scheduler.util import LocalCache, memcached, local_cache
+
+
+class TestLocalCache(SimpleTestCase):
+    def test_lru(self):
+        cache = LocalCache(2, 10)
+        cache.set('a', 1, 10)
+        cache.set('b', 2, 10)
+        assert cache.get('a') == 1
+        cache.set('c', 3, 10)
+        # b is least recently used
+        assert cache.get_many(['a', 'b', 'c']) == {'a': 1, 'c': 3}
+        assert cache.stats() == {'hits': 3, 'misses': 1, 'evictions': 1, 'size': 2}
+
+    @patch('scheduler.util.monotonic')
+    def test_lifetime(self, monotonic):
+        monotonic.return_value = 100
+        cache = LocalCache(10, 2)
+        cache.set('a', 1, 10)
+        cache.set('b', 2, 1)
+        monotonic.return_value = 101.5
+        assert cache.get_many(['a', 'b']) == {'a': 1}
+        monotonic.return_value = 103
+        assert cache.get('a') is None
+
+    def test_values_are_copied(self):
+        cache = LocalCache(10, 10)
+        value = {'competitors': [1]}
+        cache.set('a', value, 10)
+        value['competitors'].append(2)
+        cache.get('a').pop('competitors')
+        assert cache.get('a') == {'competitors': [1]}
+
+    def test_disabled(self):
+        cache = LocalCache(0, 10)
+        cache.set('a', 1, 10)
+        assert cache.get('a') is None
+
+
+def add_all(values, **kwargs):
+    return list(values)
+
+
+@patch('scheduler.util.memcache', **{'add_many.side_effect': add_all})
+class TestMemcachedL1(SimpleTestCase):
+    def setUp(self):
+        local_cache.clear()
+
+    def test_single_key(self, memcache):
+        memcache.get.return_value = None
+        func = Mock(__name__='func', return_value={'data': 1})
+        cached = memcached()(func)
+        assert cached(1) == {'data': 1}
+        assert cached(1) == {'data': 1}
+        func.assert_called_once()
+        memcache.get.assert_called_once()
+        assert local_cache.stats()['hits'] == 1
+
+    def test_memcache_hit_is_kept(self, memcache):
+        memcache.get.return_value = {'data': 1}
+        cached = memcached()(Mock(__name__='func'))
+        cached(1)
+        cached(1)
+        memcache.get.assert_called_once()
+
+    def test_not_local(self, memcache):
+        memcache.get.return_value = None
+        func = Mock(__name__='func', return_value={'data': 1})
+        cached = memcached(local=False)(func)
+        cached(1)
+        cached(1)
+        assert func.call_count == 2
+
+    def test_list_field(self, memcache):
+        memcache.get_many.return_value = {'func/1/b': 'B'}
+        func = Mock(__name__='func', side_effect=lambda a, keys: {i: i.upper() for i in keys})
+        cached = memcached(list_field='keys')(func)
+        assert cached(1, keys=['a', 'b']) == {'a': 'A', 'b': 'B'}
+        assert func.call_args[1] == {'keys': ['a']}
+
+        memcache.get_many.reset_mock()
+        assert cached(1, keys=['a', 'b', 'c']) == {'a': 'A', 'b': 'B', 'c': 'C'}
+        # only key missed in L1 is requested from memcache
+        assert memcache.get_many.call_args[0][0] == ['func/1/c']
+        assert func.call_args[1] == {'keys': ['c']}
+
+    def test_stale_not_cached(self, memcache):
+        memcache.get.return_value = None
+        func = Mock(__name__='func', return_value={'data': 1, 'stale': True})
+        cached = memcached()(func)
+        cached(1)
+        cached(1)
+        assert func.call_count == 2
+        assert local_cache.stats()['size'] == 0
+
+
+@patch('scheduler.util.sleep', Mock())
+@patch('scheduler.util.memcache')
+class TestSingleFlight(SimpleTestCase):
+    def setUp(self):
+        local_cache.clear()
+
+    def test_lease(self, memcache):
+        memcache.get.return_value = None
+        memcache.add_many.side_effect = add_all
+        func = Mock(__name__='func', side_effect=ValueError)
+        with self.assertRaises(ValueError):
+            memcached(local=False)(func)(1)
+        assert list(memcache.add_many.call_args[0][0]) == ['lease/func/1']
+        # lease is released on errors too
+        memcache.delete_many.assert_called_once_with(['lease/func/1'])
+
+    def test_wait_for_filler(self, memcache):
+        memcache.get.return_value = None
+        memcache.add_many.return_value = []
+        memcache.get_many.side_effect = [
+            {'lease/func/1': '1'},
+            {'lease/func/1': '1', 'func/1': {'data': 1}},
+        ]
+        func = Mock(__name__='func')
+        assert memcached()(func)(1) == {'data': 1}
+        func.assert_not_called()
+        memcache.delete_many.assert_not_called()
+
+    @override_settings(CACHE_LEASE_WAIT=0.01)
+    def test_filler_timeout(self, memcache):
+        memcache.get.return_value = None
+        memcache.add_many.return_value = []
+        memcache.get_many.return_value = {'lease/func/1': '1'}
+        func = Mock(__name__='func', return_value={'data': 1})
+        assert memcached()(func)(1) == {'data': 1}
+        func.assert_called_once()
+        memcache.delete_many.assert_not_called()
+
+    def test_lease_released(self, memcache):
+        memcache.get.return_value = None
+        # filler gave up without caching the value
+        memcache.add_many.side_effect = [[], ['lease/func/1']]
+        memcache.get_many.return_value = {}
+        func = Mock(__name__='func', return_value={'data': 1})
+        assert memcached()(func)(1) == {'data': 1}
+        func.assert_called_once()
+        # waiting stops at once, lease is taken over
+        assert memcache.get_many.call_count == 1
+        memcache.delete_many.assert_called_once_with(['lease/func/1'])
+
+    def test_list_field(self, memcache):
+        # b is being filled by other worker
+        memcache.add_many.side_effect = lambda values, **kwargs: ['lease/func/1/a']
+        memcache.get_many.side_effect = [{}, {'lease/func/1/b': '1', 'func/1/b': 'B'}]
+        func = Mock(__name__='func', side_effect=lambda a, keys: {i: i.upper() for i in keys})
+        assert memcached(list_field='keys')(func)(1, keys=['a', 'b']) == {'a': 'A', 'b': 'B'}
+        assert func.call_args_list[0][1] == {'keys': ['a']}
+        func.assert_called_once()
+
+
+class InlineExecutor:
+    def submit(self, fn, *args):
+        fn(*args)
+
+
+@patch('scheduler.util._refresher', InlineExecutor())
+@patch('scheduler.util.time', Mock(return_value=1000))
+@patch('scheduler.util.memcache')
+class TestStaleWhileRevalidate(SimpleTestCase):
+    def setUp(self):
+        local_cache.clear()
+
+    def test_store(self, memcache):
+        memcache.get.return_value = None
+        memcached(timeout=10, hard_timeout=60)(Mock(__name__='func', return_value=1))(1)
+        memcache.set.assert_called_once_with(
+            'func/1', value={'fresh_until': 1010, 'value': 1}, expire=60)
+
+    def test_fresh(self, memcache):
+        memcache.get.return_value = {'fresh_until': 1001, 'value': 1}
+        func = Mock(__name__='func')
+        assert memcached(hard_timeout=60)(func)(1) == 1
+        func.assert_not_called()
+        memcache.add_many.assert_not_called()
+
+    def test_stale(self, memcache):
+        memcache.get.return_value = {'fresh_until': 1000, 'value': 1}
+        memcache.add_many.side_effect = add_all
+        priorities = []
+        func = Mock(__name__='func', side_effect=lambda a: priorities.append(
+            upstream._priority.get()) or 2)
+        assert memcached(timeout=10, hard_timeout=60, local=False)(func)(1) == 1
+        # refreshed in background by the lease holder
+        func.assert_called_once_with(1)
+        assert priorities == [upstream.BACKGROUND]
+        assert upstream._priority.get() == upstream.INTERACTIVE
+        memcache.set.assert_called_once_with(
+            'func/1', value={'fresh_until': 1010, 'value': 2}, expire=60)
+        memcache.delete_many.assert_called_once_with(['lease/func/1'])
+
+    def test_stale_being_refreshed(self, memcache):
+        memcache.get.return_value = {'fresh_until': 1000, 'value': 1}
+        memcache.add_many.return_value = []
+        func = Mock(__name__='func')
+        assert memcached(hard_timeout=60)(func)(1) == 1
+        func.assert_not_called()
+
+    def test_list_field(self, memcache):
+        memcache.get_many.return_value = {
+            'func/1/a': {'fresh_until': 1005, 'value': 'a'},
+            'func/1/b': {'fresh_until': 995, 'value': 'b'},
+        }
+        memcache.add_many.side_effect = add_all
+        func = Mock(__name__='func', side_effect=lambda a, keys: {i: i.upper() for i in keys})
+        cached = memcached(list_field='keys', timeout=10, hard_timeout=60)(func)
+        assert cached(1, keys=['a', 'b']) == {'a': 'a', 'b': 'b'}
+        func.assert_called_once_with(1, keys=['b'])
+        memcache.set_many.assert_called_once_with(
+            {'func/1/b': {'fresh_until': 1010, 'value': 'B'}}, expire=60)
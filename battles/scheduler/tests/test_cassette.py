@@ -0,0 +1,114 @@
+import os
+import gzip
+import json
+import tempfile
+from unittest.mock import patch, Mock
+
+import requests
+from django.test import SimpleTestCase
+
+from scheduler import upstream
+from scheduler.cassette import use_cassette, RECORD, REPLAY, CassetteMiss
+from scheduler.util import local_cache
+from scheduler.wgconnect import WGClanBattles
+
+PROVINCE = {
+    'active_battles': [],
+    'attackers': [],
+    'competitors': [1, 2],
+    'front_id': 'front_id',
+    'arena_id': 'arena_id',
+    'arena_name': 'arena',
+    'province_id': 'province_id',
+    'province_name': 'province',
+    'prime_time': '18:15',
+    'battles_start_at': '2017-12-13T18:15:00',
+    'round_number': 1,
+    'owner_clan_id': 999,
+    'status': 'NOT_STARTED',
+}
+
+
+def fake_wg_api(url, params=None, **kwargs):
+    if url.endswith('/game_api/clan/1/battles'):
+        data = {'battles': [{'front_id': 'front_id', 'province_id': 'province_id'}],
+                'planned_battles': []}
+    elif url.endswith('/globalmap/clanprovinces/'):
+        data = {'status': 'ok', 'data': {'1': None}}
+    elif url.endswith('/globalmap/provinces/'):
+        data = {'status': 'ok', 'data': [PROVINCE]}
+    else:
+        raise AssertionError(f'Unexpected request {url}')
+    response = requests.Response()
+    response.status_code = 200
+    response._content = json.dumps(data).encode()
+    response.headers['Content-Type'] = 'application/json'
+    return response
+
+
+class TestCassette(SimpleTestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.jsonl.gz')
+        os.close(fd)
+        self.patches = [
+            patch('scheduler.util.memcache', Mock(**{
+                'get.return_value': None,
+                'get_many.return_value': {},
+                'add_many.side_effect': lambda values, **kwargs: list(values),
+            })),
+            patch('scheduler.wgconnect.memcache', Mock(**{'get_many.return_value': {}})),
+            patch('scheduler.upstream.memcache', Mock(**{
+                'gets.return_value': (None, None),
+                'get.return_value': None,
+                'incr_many.return_value': {},
+            })),
+        ]
+        for i in self.patches:
+            i.start()
+        local_cache.clear()
+
+    def tearDown(self):
+        for i in self.patches:
+            i.stop()
+        os.remove(self.path)
+
+    def test_record_replay(self):
+        with use_cassette(self.path, RECORD):
+            with patch.object(upstream.session, 'get', side_effect=fake_wg_api):
+                recorded = WGClanBattles(1).get_clan_related_provinces()
+
+        # no network on replay
+        with use_cassette(self.path, REPLAY):
+            with patch.object(upstream.session, 'get', side_effect=AssertionError):
+                replayed = WGClanBattles(1).get_clan_related_provinces()
+        assert [i.data for i in replayed] == [i.data for i in recorded]
+        assert replayed[0]['pretenders'] == [1, 2]
+
+    def test_recorded_error(self):
+        with use_cassette(self.path, RECORD):
+            with patch.object(upstream.session, 'get', side_effect=requests.ConnectionError):
+                with self.assertRaises(requests.ConnectionError):
+                    upstream.get('https://example.com/', {'a': 1})
+
+        with use_cassette(self.path, REPLAY):
+            with self.assertRaises(requests.ConnectionError):
+                upstream.get('https://example.com/', {'a': 1})
+            with self.assertRaises(CassetteMiss):
+                upstream.get('https://example.com/', {'a': 2})
+
+    def test_application_id_not_stored(self):
+        with use_cassette(self.path, RECORD):
+            with patch.object(upstream.session, 'get', side_effect=lambda *a, **kw: fake_wg_api(
+                    'https://example.com/globalmap/clanprovinces/')):
+                upstream.get('https://example.com/', {'application_id': 'secret1', 'a': 1})
+            with patch.object(upstream.session, 'get', side_effect=requests.ConnectionError(
+                    'https://example.com/?application_id=secret1&a=2')):
+                with self.assertRaises(requests.ConnectionError):
+                    upstream.get('https://example.com/', {'application_id': 'secret1', 'a': 2})
+        with gzip.open(self.path, 'rt') as f:
+            assert 'secret1' not in f.read()
+
+        # replayed with another application id
+        with use_cassette(self.path, REPLAY):
+            response = upstream.get('https://example.com/', {'application_id': 'other', 'a': 1})
+            assert response.json()['data'] == {'1': None}
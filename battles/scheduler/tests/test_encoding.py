@@ -0,0 +1,63 @@
+import gzip
+import json
+from unittest.mock import patch
+
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import SimpleTestCase, RequestFactory, override_settings
+
+from scheduler.encoding import dumps, choose_encoding, CompressionMiddleware, TimetableJSONEncoder
+from scheduler.management.commands.bench_encoding import make_timetable
+
+
+class TestDumps(SimpleTestCase):
+    def test_same_as_django_encoder(self):
+        timetable = make_timetable(3, 4)
+        assert json.loads(dumps(timetable)) == \
+            json.loads(json.dumps(timetable, cls=TimetableJSONEncoder))
+
+    @patch('scheduler.encoding.orjson', None)
+    def test_without_orjson(self):
+        timetable = make_timetable(3, 4)
+        assert json.loads(dumps(timetable)) == \
+            json.loads(json.dumps(timetable, cls=TimetableJSONEncoder))
+
+
+@override_settings(COMPRESS_MIN_LENGTH=100)
+class TestCompressionMiddleware(SimpleTestCase):
+    content = b'{"provinces": []}' * 100
+
+    def get_response(self, response, **headers):
+        request = RequestFactory().get('/', **headers)
+        return CompressionMiddleware(lambda r: response)(request)
+
+    def test_choose_encoding(self):
+        assert choose_encoding('') is None
+        assert choose_encoding('gzip, deflate') == 'gzip'
+        assert choose_encoding('gzip;q=0, deflate') is None
+        assert choose_encoding('*') in ('br', 'gzip')
+        with patch('scheduler.encoding.brotli', object()):
+            assert choose_encoding('gzip, br') == 'br'
+            assert choose_encoding('gzip, br;q=0.5') == 'gzip'
+
+    def test_gzip(self):
+        response = HttpResponse(self.content)
+        response['ETag'] = '"etag"'
+        response = self.get_response(response, HTTP_ACCEPT_ENCODING='gzip')
+        assert response['Content-Encoding'] == 'gzip'
+        assert response['Vary'] == 'Accept-Encoding'
+        assert response['ETag'] == 'W/"etag"'
+        assert gzip.decompress(response.content) == self.content
+
+    def test_not_accepted(self):
+        response = self.get_response(HttpResponse(self.content))
+        assert not response.has_header('Content-Encoding')
+        assert response.content == self.content
+
+    def test_small_response(self):
+        response = self.get_response(HttpResponse(b'{}'), HTTP_ACCEPT_ENCODING='gzip')
+        assert not response.has_header('Content-Encoding')
+
+    def test_streaming_response(self):
+        response = StreamingHttpResponse(iter([self.content]))
+        response = self.get_response(response, HTTP_ACCEPT_ENCODING='gzip')
+        assert not response.has_header('Content-Encoding')
@@ -1,29 +1,35 @@
-from unittest.mock import patch
+from unittest.mock import patch, Mock
 from django.test import TestCase
 from datetime import datetime, time
 import pytz
 
-from scheduler.wgconnect import WGClanBattles
-from scheduler.wgconnect import wot_globalmap_provinces
+from scheduler.wgconnect import WGClanBattles, WGProvinceData, ProvinceLoader
+from scheduler.wgconnect import wot_globalmap_provinces, province_records
+from scheduler.records import ValidationError
+from scheduler.upstream import UpstreamUnavailable
+from scheduler.util import local_cache
 
 
 class TestWGConnectWrappers(TestCase):
     def setUp(self):
         self.memcache = patch('scheduler.util.memcache')
         self.memcache2 = patch('scheduler.wgconnect.memcache')
-        memcache = self.memcache.start()
+        self.memcache_util = memcache = self.memcache.start()
         memcache.get.return_value = None
         memcache.get_many.return_value = {}
         memcache2 = self.memcache2.start()
         memcache2.get.return_value = None
         memcache2.get_many.return_value = {}
+        local_cache.clear()
 
     def tearDown(self):
         self.memcache.stop()
         self.memcache2.stop()
 
-    @patch('scheduler.wgconnect.wot')
-    def test_wot_globalmap_provinces(self, wot):
+    @patch('scheduler.wgconnect.get_clients')
+    def test_wot_globalmap_provinces(self, get_clients):
+        wot = Mock()
+        get_clients.return_value = wot, Mock()
         province_data = {
             'active_battles': [],
             'attackers': [],
@@ -40,9 +46,47 @@ class TestWGConnectWrappers(TestCase):
             'status': 'FINISHED',
         }
         wot.globalmap.provinces.return_value = [province_data]
-        assert wot_globalmap_provinces(front_id='fake', province_id=['fake']) == {
+        assert wot_globalmap_provinces('ru', front_id='fake', province_id=['fake']) == {
             'province_id': province_data
         }
+        assert 'active_battles.start_at' in wot.globalmap.provinces.call_args[1]['fields']
+        get_clients.assert_called_with('ru')
+
+    @patch('scheduler.wgconnect.get_clients')
+    def test_wot_globalmap_provinces_malformed(self, get_clients):
+        wot = Mock()
+        get_clients.return_value = wot, Mock()
+        province_data = {
+            'active_battles': [],
+            'attackers': [],
+            'competitors': [1],
+            'front_id': 'fake',
+            'province_id': 'good',
+            'prime_time': '18:15',
+            'battles_start_at': '2017-12-13T18:15:00',
+            'status': 'NOT_STARTED',
+        }
+        wot.globalmap.provinces.return_value = [
+            province_data,
+            dict(province_data, province_id='bad', prime_time='evening'),
+            # battle without opponent object
+            dict(province_data, province_id='bad_battle', active_battles=[
+                {'clan_a': {'clan_id': 1}, 'start_at': '2017-12-13T18:15:00', 'round': 1}]),
+        ]
+        # malformed province is skipped and isn't cached
+        assert wot_globalmap_provinces(
+            'ru', front_id='fake', province_id=['good', 'bad', 'bad_battle']
+        ) == {'good': province_data}
+        cached = self.memcache_util.set_many.call_args_list
+        assert [list(i[0][0]) for i in cached] == [['wot_globalmap_provinces/\'ru\'/front_id=fake/good']]
+
+        # payload without valid provinces is a failure of the endpoint
+        wot.globalmap.provinces.return_value = [dict(province_data, competitors=None)]
+        with patch('scheduler.upstream.memcache') as upstream_memcache:
+            upstream_memcache.get_many.return_value = {}
+            with self.assertRaises(UpstreamUnavailable) as e:
+                wot_globalmap_provinces('ru', front_id='fake', province_id=['other'])
+        assert isinstance(e.exception.__cause__, ValidationError)
 
 
 class TestWGClanBattles(TestCase):
@@ -55,6 +99,8 @@ class TestWGClanBattles(TestCase):
         memcache2 = self.memcache2.start()
         memcache2.get.return_value = None
         memcache2.get_many.return_value = {}
+        local_cache.clear()
+        province_records.clear()
         self.not_started_provinces = {
             'province_id': {
                 'active_battles': [],
@@ -458,3 +504,126 @@ class TestWGClanBattles(TestCase):
             'clan_b': {'clan_id': 2},
             'round': 1,
         }]
+
+
+class TestProvinceLoader(TestCase):
+    def setUp(self):
+        self.memcache = patch('scheduler.wgconnect.memcache')
+        self.leases = patch('scheduler.util.memcache')
+        self.wot_globalmap_provinces = patch('scheduler.wgconnect.wot_globalmap_provinces')
+        self.cache = memcache = self.memcache.start()
+        self.shared = self.leases.start()
+        self.shared.add_many.side_effect = lambda values, **kwargs: list(values)
+        memcache.get_many.return_value = {
+            'ru/front_1/cached': self.province_data('front_1', 'cached'),
+        }
+        self.papi = wot_globalmap_provinces = self.wot_globalmap_provinces.start()
+        wot_globalmap_provinces.side_effect = lambda realm, front_id, province_id: {
+            i: self.province_data(front_id, i, papi=True) for i in province_id
+        }
+        province_records.clear()
+
+    def tearDown(self):
+        self.memcache.stop()
+        self.leases.stop()
+        self.wot_globalmap_provinces.stop()
+
+    @staticmethod
+    def province_data(front_id, province_id, papi=False):
+        data = {
+            'active_battles': [],
+            'front_id': front_id,
+            'province_id': province_id,
+            'prime_time': '18:15',
+            'battles_start_at': '2017-12-13T18:15:00',
+            'owner_clan_id': None,
+            'status': 'NOT_STARTED',
+        }
+        if papi:
+            data.update(attackers=[], competitors=[1])
+        else:
+            data['pretenders'] = [1]
+        return data
+
+    def test_batch(self):
+        memcache, wot_globalmap_provinces = self.cache, self.papi
+        loader = ProvinceLoader()
+        provinces = loader.load_many([
+            ('front_1', 'cached'), ('front_1', 'p1'), ('front_1', 'p2'),
+            ('front_2', 'p3'), ('front_1', 'p1'),
+        ])
+        assert provinces[1] is provinces[4]
+        memcache.get_many.assert_not_called()
+
+        assert provinces[0]['pretenders'] == [1]
+        memcache.get_many.assert_called_once()
+        assert sorted(memcache.get_many.call_args[0][0]) == [
+            'ru/front_1/cached', 'ru/front_1/p1', 'ru/front_1/p2', 'ru/front_2/p3']
+        # one PAPI request per front for missed provinces
+        assert sorted(
+            (i[1]['front_id'], sorted(i[1]['province_id']))
+            for i in wot_globalmap_provinces.call_args_list
+        ) == [('front_1', ['p1', 'p2']), ('front_2', ['p3'])]
+        assert [i['province_id'] for i in provinces] == ['cached', 'p1', 'p2', 'p3', 'p1']
+
+        # data is already loaded
+        provinces[3].data
+        memcache.get_many.assert_called_once()
+
+    @patch('scheduler.util.sleep')
+    def test_single_flight(self, sleep):
+        # p2 is being fetched by other worker
+        self.shared.add_many.side_effect = lambda values, **kwargs: [
+            i for i in values if i != 'lease/ru/front_1/p2']
+        self.shared.get_many.side_effect = [
+            {'lease/ru/front_1/p2': '1'},
+            {'ru/front_1/p2': self.province_data('front_1', 'p2')},
+        ]
+        provinces = ProvinceLoader().load_many([('front_1', 'p1'), ('front_1', 'p2')])
+        assert [i['province_id'] for i in provinces] == ['p1', 'p2']
+        assert [i[1]['province_id'] for i in self.papi.call_args_list] == [['p1']]
+        self.shared.delete_many.assert_called_once_with(['lease/ru/front_1/p1'])
+        assert sleep.call_count == 2
+
+    def test_malformed(self):
+        self.cache.get_many.return_value = {
+            'ru/front_1/cached': dict(self.province_data('front_1', 'cached'), prime_time=None),
+        }
+        self.papi.side_effect = lambda realm, front_id, province_id: {
+            'p1': self.province_data(front_id, 'p1', papi=True),
+            'p2': dict(self.province_data(front_id, 'p2', papi=True), status='UNKNOWN'),
+        }
+        # malformed provinces are skipped, other provinces of the batch are loaded
+        provinces = ProvinceLoader().fetch_many(
+            [('front_1', 'cached'), ('front_1', 'p1'), ('front_1', 'p2')])
+        assert [i['province_id'] for i in provinces] == ['p1']
+        # only valid data is cached
+        assert list(self.cache.set_many.call_args[0][0]) == ['ru/front_1/p1']
+
+    def test_failed_fetch_is_retried(self):
+        loader = ProvinceLoader()
+        province = loader.load('front_1', 'p1')
+        side_effect = self.papi.side_effect
+        self.papi.side_effect = UpstreamUnavailable('provinces are unavailable')
+        with self.assertRaises(UpstreamUnavailable):
+            province.data
+        # failure is raised again, not served as missing data
+        with self.assertRaises(UpstreamUnavailable):
+            province['province_id']
+        self.papi.side_effect = side_effect
+        assert province['province_id'] == 'p1'
+
+    def test_records_are_reused(self):
+        ProvinceLoader().fetch_many([('front_1', 'cached')])
+        with patch('scheduler.wgconnect.parse_province') as parse_province:
+            provinces = ProvinceLoader().fetch_many([('front_1', 'cached')])
+        assert provinces[0]['pretenders'] == [1]
+        parse_province.assert_not_called()
+        self.cache.get_many.assert_called_once()
+
+    def test_no_io_on_comparison(self):
+        memcache = self.cache
+        province = WGProvinceData('front_1', 'p1')
+        assert province != {}
+        assert len({province, WGProvinceData('front_1', 'p1')}) == 1
+        memcache.get_many.assert_not_called()
@@ -0,0 +1,148 @@
+"""Query plan regression tests
+
+Loads a season-like volume of data and checks with EXPLAIN that
+hot path queries don't fall back to sequential scans of big tables.
+"""
+import random
+from datetime import date, datetime, time, timedelta
+import pytz
+
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from scheduler.models import Clan, Schedule, ProvinceBattles, ClanInvolvement
+from scheduler.views import get_active_clan_schedules_by_date
+from scheduler.writer import write_provinces
+
+CLANS = 20000
+PROVINCES = 100
+DAYS = 30
+FIRST_DAY = date(2017, 1, 1)
+
+BIG_TABLES = [
+    Clan._meta.db_table,
+    Schedule._meta.db_table,
+    Schedule.pretenders.through._meta.db_table,
+    ProvinceBattles._meta.db_table,
+    ClanInvolvement._meta.db_table,
+]
+
+
+class TestQueryPlans(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        rnd = random.Random(0)
+        Clan.objects.bulk_create([Clan(id=i, tag=f'{i:05X}') for i in range(1, CLANS + 1)])
+
+        schedules = Schedule.objects.bulk_create([
+            Schedule(
+                front_id='front_id',
+                front_name='front',
+                province_id=f'province_{province}',
+                province_name='province',
+                arena_id='arena_id',
+                arena_name='arena',
+                server='RU6',
+                date=FIRST_DAY + timedelta(days=day),
+                prime_time=time(18, 15),
+                battles_start_at=datetime.combine(
+                    FIRST_DAY + timedelta(days=day), time(18, 15)).replace(tzinfo=pytz.UTC),
+                owner_id=rnd.randint(1, CLANS),
+                round_number=2,
+                status='FINISHED' if day < DAYS - 1 else 'STARTED',
+            )
+            for day in range(DAYS)
+            for province in range(PROVINCES)
+        ])
+
+        pretenders = []
+        battles = []
+        for schedule in schedules:
+            clans = rnd.sample(range(1, CLANS + 1), 8)
+            pretenders.extend(
+                Schedule.pretenders.through(schedule_id=schedule.id, clan_id=clan_id)
+                for clan_id in clans
+            )
+            for round_number, pairs in [(1, zip(clans[::2], clans[1::2])),
+                                        (2, zip(clans[:4:2], clans[1:4:2]))]:
+                battles.extend(
+                    ProvinceBattles(
+                        schedule_id=schedule.id,
+                        round=round_number,
+                        clan_a_id=clan_a,
+                        clan_b_id=clan_b,
+                        start_at=schedule.battles_start_at,
+                    )
+                    for clan_a, clan_b in pairs
+                )
+        Schedule.pretenders.through.objects.bulk_create(pretenders)
+        ProvinceBattles.objects.bulk_create(battles)
+        ClanInvolvement.rebuild([schedule.id for schedule in schedules])
+
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+        cls.today = FIRST_DAY + timedelta(days=DAYS - 1)
+        cls.schedule = schedules[-1]
+        cls.clan = cls.schedule.owner
+
+    def assert_index_scans(self, queries):
+        sql_queries = [
+            query['sql'] for query in queries
+            if query['sql'].lstrip().split()[0].upper() in ('SELECT', 'INSERT', 'UPDATE', 'DELETE')
+        ]
+        assert sql_queries
+        with connection.cursor() as cursor:
+            for sql in sql_queries:
+                cursor.execute('EXPLAIN ' + sql)
+                plan = '\n'.join(row[0] for row in cursor.fetchall())
+                for table in BIG_TABLES:
+                    assert f'Seq Scan on {table}' not in plan, f'{sql}\n{plan}'
+
+    def test_clan_lookup(self):
+        with CaptureQueriesContext(connection) as queries:
+            Clan.objects.get(tag=self.clan.tag)
+        self.assert_index_scans(queries)
+
+    def test_get_active_clan_schedules_by_date(self):
+        with CaptureQueriesContext(connection) as queries:
+            schedules = get_active_clan_schedules_by_date(self.clan, self.today)
+        assert schedules
+        self.assert_index_scans(queries)
+
+    def test_get_battle_times(self):
+        schedule = Schedule.objects.get(id=self.schedule.id)
+        with CaptureQueriesContext(connection) as queries:
+            schedule.get_battle_times(self.clan)
+        self.assert_index_scans(queries)
+
+    def test_update_province(self):
+        schedule = self.schedule
+        with CaptureQueriesContext(connection) as queries:
+            write_provinces([{
+                'front_id': schedule.front_id,
+                'province_id': schedule.province_id,
+                'province_name': schedule.province_name,
+                'arena_id': schedule.arena_id,
+                'arena_name': schedule.arena_name,
+                'server': schedule.server,
+                'prime_time': schedule.prime_time,
+                'battles_start_at': schedule.battles_start_at,
+                'owner_clan_id': schedule.owner_id,
+                'round_number': 2,
+                'status': 'STARTED',
+                'pretenders': [1, 2, 3, 4],
+                'active_battles': [{
+                    'start_at': schedule.battles_start_at,
+                    'clan_a': {'clan_id': 1},
+                    'clan_b': {'clan_id': 2},
+                    'round': 2,
+                }, {
+                    'start_at': schedule.battles_start_at,
+                    'clan_a': {'clan_id': 3},
+                    'clan_b': {'clan_id': None},
+                    'round': 2,
+                }],
+            }])
+        self.assert_index_scans(queries)
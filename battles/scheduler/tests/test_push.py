@@ -0,0 +1,72 @@
+import queue
+from unittest.mock import Mock, patch
+
+from django.test import SimpleTestCase, override_settings
+
+from scheduler.push import Hub
+from scheduler.views import refresh_provinces
+
+
+@override_settings(PUSH_INTERVAL=0.01)
+class TestHub(SimpleTestCase):
+    def subscribe(self, hub, key, poll):
+        subscriber = hub.subscribe(key, poll)
+        self.addCleanup(hub.unsubscribe, key, subscriber)
+        return subscriber
+
+    def test_shared_poll(self):
+        hub = Hub()
+        poll = Mock(return_value=('v1', 'payload'))
+        subscriber1 = self.subscribe(hub, ('clan', 1), poll)
+        subscriber2 = self.subscribe(hub, ('clan', 1), poll)
+        assert subscriber1.get(timeout=1) == 'payload'
+        assert subscriber2.get(timeout=1) == 'payload'
+        assert len(hub.channels) == 1
+
+        # same version isn't sent again
+        with self.assertRaises(queue.Empty):
+            subscriber1.get(timeout=0.05)
+
+        poll.return_value = ('v2', 'payload2')
+        assert subscriber1.get(timeout=1) == 'payload2'
+        assert subscriber2.get(timeout=1) == 'payload2'
+
+    def test_new_subscriber_gets_latest_payload(self):
+        hub = Hub()
+        poll = Mock(return_value=('v1', 'payload'))
+        subscriber1 = self.subscribe(hub, ('clan', 1), poll)
+        assert subscriber1.get(timeout=1) == 'payload'
+        subscriber2 = self.subscribe(hub, ('clan', 1), Mock())
+        assert subscriber2.get(timeout=1) == 'payload'
+
+    def test_channel_closed_without_subscribers(self):
+        hub = Hub()
+        poll = Mock(return_value=('v1', 'payload'))
+        subscriber = hub.subscribe(('clan', 1), poll)
+        channel = hub.channels[('clan', 1)]
+        hub.unsubscribe(('clan', 1), subscriber)
+        channel.thread.join(timeout=1)
+        assert hub.channels == {}
+
+    def test_poll_errors_are_skipped(self):
+        hub = Hub()
+        poll = Mock(side_effect=Exception('WG API is down'))
+        subscriber = self.subscribe(hub, ('clan', 1), poll)
+        with self.assertRaises(queue.Empty):
+            subscriber.get(timeout=0.05)
+        poll.side_effect = None
+        poll.return_value = ('v1', 'payload')
+        assert subscriber.get(timeout=1) == 'payload'
+
+
+class TestRefreshProvinces(SimpleTestCase):
+    @patch('scheduler.views.ProvinceLoader')
+    @patch('scheduler.views.write_provinces')
+    @patch('scheduler.views.acquire_lock')
+    def test_refreshed_once_per_interval(self, acquire_lock, write_provinces, loader):
+        # second province is being refreshed by another subscriber
+        acquire_lock.side_effect = [True, False]
+        refresh_provinces('ru', [('front', 'province_1'), ('front', 'province_2')])
+        loader.assert_called_once_with('ru')
+        loader.return_value.fetch_many.assert_called_once_with([('front', 'province_1')])
+        write_provinces.assert_called_once_with(loader.return_value.fetch_many.return_value, 'ru')
@@ -0,0 +1,106 @@
+from datetime import datetime, time
+
+import pytz
+from django.test import SimpleTestCase, TestCase
+
+from scheduler.models import Schedule, ProvinceBattles
+from scheduler.records import Province, parse_province, validate_tournament_info, \
+    validate_clan_battles, ValidationError
+from scheduler.writer import write_provinces
+
+
+def make_raw_province(**kwargs):
+    data = {
+        'front_id': 'front_id',
+        'province_id': 'province_id',
+        'province_name': 'province',
+        'arena_id': 'arena_id',
+        'arena_name': 'arena',
+        'server': 'RU6',
+        'prime_time': '18:15',
+        'battles_start_at': '2017-12-13T18:15:00',
+        'owner_clan_id': 999,
+        'round_number': 1,
+        'status': 'STARTED',
+        'pretenders': [1, 2, 3],
+        'active_battles': [{
+            'start_at': '2017-12-13T18:15:00',
+            'clan_a': {'clan_id': 1},
+            'clan_b': {'clan_id': 2},
+            'round': 1,
+        }],
+    }
+    data.update(kwargs)
+    return data
+
+
+class TestProvinceRecord(SimpleTestCase):
+    def test_parse(self):
+        province = parse_province(make_raw_province())
+        assert isinstance(province, Province)
+        assert province.battles_start_at == datetime(2017, 12, 13, 18, 15, tzinfo=pytz.UTC)
+        assert province['prime_time'] == time(18, 15)
+        assert province['active_battles'][0]['clan_b']['clan_id'] == 2
+        assert province.get('front_name') is None
+        with self.assertRaises(KeyError):
+            province['front_name']
+        assert not hasattr(province, '__dict__')
+
+    def test_equal_to_dict(self):
+        province = parse_province(make_raw_province())
+        assert province == make_raw_province(
+            prime_time=time(18, 15),
+            battles_start_at=datetime(2017, 12, 13, 18, 15, tzinfo=pytz.UTC),
+            active_battles=[{
+                'start_at': datetime(2017, 12, 13, 18, 15, tzinfo=pytz.UTC),
+                'clan_a': {'clan_id': 1},
+                'clan_b': {'clan_id': 2},
+                'round': 1,
+            }],
+        )
+        assert province != make_raw_province(status='FINISHED')
+
+    def test_malformed(self):
+        for data in [
+            make_raw_province(battles_start_at='2017-12-13 evening'),
+            make_raw_province(prime_time=None),
+            make_raw_province(pretenders=['1']),
+            make_raw_province(status='UNKNOWN'),
+            make_raw_province(active_battles=[{'clan_a': {}, 'clan_b': {}}]),
+            make_raw_province(active_battles=[
+                {'clan_a': {'clan_id': 1}, 'start_at': '2017-12-13T18:15:00', 'round': 1}]),
+            make_raw_province(active_battles=[{
+                'clan_a': None, 'clan_b': {'clan_id': 2},
+                'start_at': '2017-12-13T18:15:00', 'round': 1}]),
+            make_raw_province(active_battles=[
+                {'clan_a': {'clan_id': 1}, 'clan_b': {'clan_id': 2}, 'round': 1}]),
+            make_raw_province(active_battles=[None]),
+            {k: v for k, v in make_raw_province().items() if k != 'province_id'},
+        ]:
+            with self.assertRaises(ValidationError):
+                parse_province(data)
+
+    def test_game_api(self):
+        validate_tournament_info({'round_number': 1, 'battles': [
+            {'is_fake': True, 'first_competitor': {'id': 1}, 'second_competitor': None},
+        ]})
+        with self.assertRaises(ValidationError):
+            validate_tournament_info({'battles': []})
+        for battle in [
+            {'is_fake': True},
+            {'is_fake': True, 'first_competitor': None},
+            {'is_fake': False, 'first_competitor': {'id': 1}},
+            {'is_fake': False, 'first_competitor': {'id': 1}, 'second_competitor': None},
+        ]:
+            with self.assertRaises(ValidationError):
+                validate_tournament_info({'round_number': 1, 'battles': [battle]})
+        with self.assertRaises(ValidationError):
+            validate_clan_battles({'battles': [{'front_id': 'front_id'}], 'planned_battles': []})
+
+
+class TestWriteRecords(TestCase):
+    def test_write(self):
+        write_provinces([parse_province(make_raw_province())])
+        schedule = Schedule.objects.get()
+        assert schedule.prime_time == time(18, 15)
+        assert ProvinceBattles.objects.get().clan_b_id == 2
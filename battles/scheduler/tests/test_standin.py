@@ -0,0 +1,93 @@
+import threading
+from datetime import datetime
+
+import pytz
+import requests
+from django.test import SimpleTestCase
+
+from scheduler.management.commands.wg_standin import World, StandInServer
+from scheduler.records import parse_province, validate_tournament_info, validate_clan_battles
+
+
+def at(hour, minute=0):
+    return lambda: datetime(2026, 10, 18, hour, minute, tzinfo=pytz.UTC)
+
+
+class TestWorld(SimpleTestCase):
+    def test_deterministic(self):
+        assert World(seed=2).provinces == World(seed=2).provinces
+        assert World(seed=2).provinces != World(seed=3).provinces
+
+    def test_tournament(self):
+        world = World(fronts=1, provinces=7, clans=100, now=at(12))
+        province_id = 'front_0_province_0'
+        province = world.provinces[province_id]
+        assert world.province_data(province_id)['status'] == 'NOT_STARTED'
+        assert world.tournament_info(province_id) == {'round_number': 1, 'battles': []}
+
+        world.now = at(16, 5)
+        data = world.province_data(province_id)
+        assert data['status'] == 'STARTED'
+        assert data['round_number'] == 1
+        parse_province(dict(data, pretenders=data['competitors']))
+        info = validate_tournament_info(world.tournament_info(province_id))
+        clans = {i['first_competitor']['id'] for i in info['battles']} | {
+            i['second_competitor']['id'] for i in info['battles'] if not i['is_fake']}
+        assert clans == set(province['pretenders'])
+
+        # clans in battles of game API and PAPI are the same
+        real = {i['clan_a']['clan_id'] for i in data['active_battles']}
+        assert real <= clans
+        for clan_id in province['pretenders']:
+            battles = validate_clan_battles(world.clan_battles(clan_id))['battles']
+            assert {'front_id': 'front_0', 'province_id': province_id} in battles
+
+        world.now = at(23, 59)
+        assert world.province_data(province_id)['status'] == 'FINISHED'
+
+
+class TestServer(SimpleTestCase):
+    def setUp(self):
+        self.server = StandInServer(('127.0.0.1', 0), World(fronts=2, provinces=5, clans=50))
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}/'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_pagination(self):
+        url = self.url + 'wot/globalmap/provinces/'
+        page = requests.get(url, {'front_id': 'front_1', 'limit': 3, 'page_no': 2}).json()
+        assert page['meta'] == {'count': 2, 'total': 5}
+        assert [i['province_id'] for i in page['data']] == [
+            'front_1_province_3', 'front_1_province_4']
+
+        data = requests.get(url, {
+            'front_id': 'front_1', 'province_id': 'front_1_province_0,front_0_province_0',
+        }).json()['data']
+        assert [i['province_id'] for i in data] == ['front_1_province_0']
+
+    def test_clans(self):
+        data = requests.get(self.url + 'wgn/clans/info/', {'clan_id': '1000,1'}).json()['data']
+        assert data == {'1000': {'clan_id': 1000, 'tag': 'C0000'}, '1': None}
+        data = requests.get(self.url + 'wgn/clans/list/', {'search': 'c000'}).json()['data']
+        assert len(data) == 16
+
+    def test_errors(self):
+        self.server.error_rate = 1
+        error = requests.get(self.url + 'wot/globalmap/fronts/').json()['error']
+        assert error['message'] == 'SOURCE_NOT_AVAILABLE'
+        response = requests.get(self.url + 'game_api/clan/1000/battles')
+        assert response.status_code == 503
+
+    def test_rate_limit(self):
+        self.server.rate_limit = 2
+        url = self.url + 'game_api/tournament_info'
+        # requests may be split by a second boundary, 5 requests don't fit in two seconds
+        codes = [requests.get(url, {'alias': 'front_0_province_0'}).status_code for _ in range(5)]
+        assert 429 in codes
+        url = self.url + 'wot/globalmap/fronts/'
+        errors = [requests.get(url).json().get('error') for _ in range(5)]
+        assert {'code': 407, 'message': 'REQUEST_LIMIT_EXCEEDED', 'field': None, 'value': None} \
+            in errors
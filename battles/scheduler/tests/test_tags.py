@@ -0,0 +1,146 @@
+from unittest.mock import patch
+
+from django.test import TestCase, override_settings
+from wargaming.exceptions import RequestError
+
+from scheduler.models import Clan
+from scheduler.tags import BloomFilter, known_tags, is_valid_tag
+from scheduler.upstream import RateLimited
+from scheduler.util import local_cache, get_timetable_versions
+from scheduler.views import find_clan
+from scheduler.wgconnect import get_clan_data
+from scheduler.tests.fakes import FakeMemcache
+
+
+class TestBloomFilter(TestCase):
+    def test_no_false_negatives(self):
+        tags_filter = BloomFilter(1000, 0.01)
+        tags = [f'{i:05X}' for i in range(1000)]
+        for tag in tags:
+            tags_filter.add(tag)
+        assert all(tag in tags_filter for tag in tags)
+        false_positives = sum(f'X{i:04X}' in tags_filter for i in range(1000))
+        assert false_positives < 50
+
+    def test_valid_tag(self):
+        assert is_valid_tag('A-_1')
+        assert not is_valid_tag('A')
+        assert not is_valid_tag('TOOLONG')
+        assert not is_valid_tag('A B')
+
+
+class TestKnownTags(TestCase):
+    def setUp(self):
+        known_tags.clear()
+        Clan.objects.create(id=1, tag='KNOWN')
+
+    def test_known_tags(self):
+        assert known_tags.might_exist('ru', 'KNOWN')
+        assert not known_tags.might_exist('ru', 'OTHER')
+        assert not known_tags.might_exist('eu', 'KNOWN')
+        # saved clans are added without rebuild
+        Clan.objects.create(id=2, tag='OTHER')
+        with self.assertNumQueries(0):
+            assert known_tags.might_exist('ru', 'OTHER')
+
+    @override_settings(KNOWN_TAGS_REFRESH=0)
+    def test_old_filter_used_while_rebuilding(self):
+        known_tags.might_exist('ru', 'KNOWN')
+        build = known_tags._build
+
+        def rebuild(realm):
+            Clan.objects.create(id=3, tag='NEW')
+            # concurrent requests don't wait for the rebuild
+            with self.assertNumQueries(0):
+                assert known_tags.might_exist('ru', 'KNOWN')
+            return build(realm)
+
+        with patch.object(known_tags, '_build', side_effect=rebuild) as _build:
+            assert known_tags.might_exist('ru', 'NEW')
+        _build.assert_called_once()
+
+    @patch('scheduler.views.get_clan_data')
+    def test_filter_miss_of_saved_clan(self, get_clan_data):
+        known_tags.might_exist('ru', 'KNOWN')
+        # saved by other process after the filter was built
+        Clan.objects.bulk_create([Clan(id=2, tag='LATE')])
+        get_clan_data.return_value = {'clan_id': 2, 'tag': 'LATE'}
+        # DB lookup, no upsert
+        with self.assertNumQueries(1):
+            assert find_clan('ru', 'LATE').id == 2
+        # renamed clan is updated
+        get_clan_data.return_value = {'clan_id': 2, 'tag': 'NEW'}
+        with patch('scheduler.util.memcache', FakeMemcache()):
+            version = get_timetable_versions('ru', [2])[2]
+            # lookup, update and clans sharing schedules
+            with self.assertNumQueries(3):
+                assert find_clan('ru', 'NEW').tag == 'NEW'
+            # timetables show the new tag
+            assert get_timetable_versions('ru', [2])[2] != version
+        assert Clan.objects.get(id=2).tag == 'NEW'
+
+    @patch('scheduler.views.get_clan_data')
+    def test_unknown_tag_skips_db(self, get_clan_data):
+        get_clan_data.return_value = None
+        known_tags.might_exist('ru', 'KNOWN')
+        with self.assertNumQueries(0):
+            assert self.client.get('/update/NOPE').status_code == 404
+        get_clan_data.assert_called_once_with('ru', 'NOPE')
+        # malformed tags aren't looked up at all
+        get_clan_data.reset_mock()
+        with self.assertNumQueries(0):
+            assert self.client.get('/update/TOOLONG').status_code == 404
+        get_clan_data.assert_not_called()
+
+    @patch('scheduler.views.get_clan_data')
+    def test_upstream_error(self, get_clan_data):
+        get_clan_data.side_effect = RequestError(504, None, 'SOURCE_NOT_AVAILABLE', None)
+        assert self.client.get('/update/OTHER').status_code == 503
+
+        get_clan_data.side_effect = RateLimited('Rate limit of host exceeded')
+        response = self.client.get('/update/OTHER')
+        assert response.status_code == 503
+        assert response['Retry-After'] == '5'
+
+
+@patch('scheduler.util.memcache')
+class TestClanNotFound(TestCase):
+    def setUp(self):
+        local_cache.clear()
+
+    @patch('scheduler.wgconnect.papi')
+    def test_not_found_cached(self, papi, memcache):
+        memcache.get.return_value = None
+        papi.return_value = [{'clan_id': 1, 'tag': 'TAGS'}]
+        assert get_clan_data('ru', 'TAG') is None
+        memcache.set.assert_called_once_with(
+            "get_clan_data/'ru'/'TAG'", value='<not found>', expire=60)
+        # served from local cache
+        assert get_clan_data('ru', 'TAG') is None
+        papi.assert_called_once()
+
+        local_cache.clear()
+        memcache.get.return_value = '<not found>'
+        assert get_clan_data('ru', 'TAG') is None
+        papi.assert_called_once()
+
+    @patch('scheduler.wgconnect.papi')
+    def test_errors(self, papi, memcache):
+        memcache.get.return_value = None
+        papi.side_effect = RequestError(407, 'search', 'NOT_ENOUGH_SEARCH_LENGTH', 'T')
+        assert get_clan_data('ru', 'T') is None
+        memcache.set.assert_called_once()
+
+        # same code as of invalid search
+        memcache.set.reset_mock()
+        papi.side_effect = RequestError(407, None, 'REQUEST_LIMIT_EXCEEDED', None)
+        with self.assertRaises(RequestError):
+            get_clan_data('ru', 'LIMIT')
+        memcache.set.assert_not_called()
+
+        # upstream errors aren't cached
+        memcache.set.reset_mock()
+        papi.side_effect = RequestError(504, None, 'SOURCE_NOT_AVAILABLE', None)
+        with self.assertRaises(RequestError):
+            get_clan_data('ru', 'TAG')
+        memcache.set.assert_not_called()
@@ -0,0 +1,367 @@
+import time
+import threading
+from time import perf_counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from unittest.mock import patch, Mock
+
+from django.test import SimpleTestCase, override_settings
+import requests
+from requests.exceptions import ConnectTimeout
+import wargaming
+from wargaming.exceptions import RequestError
+
+from scheduler import upstream
+from scheduler.upstream import fan_out, papi, UpstreamTimeout, acquire, background, \
+    RateLimited, BACKGROUND, CircuitBreaker, CircuitOpen, UpstreamUnavailable, guarded, \
+    record_traffic, get_traffic, count_objects, response_size
+from scheduler.util import local_cache
+from scheduler.wgconnect import game_api_clan_battles
+from scheduler.tests.fakes import FakeMemcache
+
+
+def sleep(seconds, result=None):
+    def call():
+        time.sleep(seconds)
+        return result
+    return call
+
+
+class TestFanOut(SimpleTestCase):
+    def test_concurrent(self):
+        start = perf_counter()
+        assert fan_out([sleep(0.2, i) for i in range(5)]) == [0, 1, 2, 3, 4]
+        assert perf_counter() - start < 0.5
+
+    def test_exception(self):
+        def fail():
+            raise ValueError('fail')
+        with self.assertRaises(ValueError):
+            fan_out([sleep(0, 1), fail])
+
+    def test_timeout(self):
+        with self.assertRaises(UpstreamTimeout):
+            fan_out([sleep(0, 1), sleep(0.5)], timeout=0.1)
+
+    def test_nested(self):
+        results = fan_out([
+            lambda i=i: fan_out([sleep(0.01, (i, j)) for j in range(3)])
+            for i in range(3)
+        ])
+        assert results == [[(i, j) for j in range(3)] for i in range(3)]
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = b'{"status": "ok", "data": {"1": {"tag": "TAG"}}}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@patch('scheduler.upstream.time.sleep', Mock())
+class TestSession(SimpleTestCase):
+    def test_retry(self):
+        ok, error = Mock(status_code=200), Mock(status_code=503)
+        with patch.object(upstream.session, 'get', side_effect=[ConnectTimeout(), error, ok]) as get:
+            assert upstream.get('https://example.com/') is ok
+        assert get.call_count == 3
+        assert get.call_args[1]['timeout'] == (3.05, 5)
+
+    def test_retry_limit(self):
+        error = Mock(status_code=503)
+        with patch.object(upstream.session, 'get', return_value=error) as get:
+            assert upstream.get('https://example.com/') is error
+        assert get.call_count == 3
+
+        with patch.object(upstream.session, 'get', side_effect=ConnectTimeout()):
+            with self.assertRaises(ConnectTimeout):
+                upstream.get('https://example.com/')
+
+    def test_reused_connections(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            url = f'http://127.0.0.1:{server.server_port}/wgn/clans/info/'
+            wgn = wargaming.WGN('app', 'ru', 'ru')
+            for _ in range(3):
+                call = wgn.clans.info(clan_id=1)
+                call.url = url
+                assert papi(call)['1'] == {'tag': 'TAG'}
+            assert upstream.connection_stats()['127.0.0.1'] == {'new': 1, 'reused': 2}
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_papi_not_request(self):
+        data = [{'province_id': 'id'}]
+        assert papi(data) is data
+
+    @patch('scheduler.upstream.backoff', Mock(return_value=0))
+    @patch('scheduler.upstream.request')
+    def test_papi_retry(self, request):
+        not_available = {'status': 'error', 'error': {
+            'code': 504, 'message': 'SOURCE_NOT_AVAILABLE', 'field': None, 'value': None}}
+        request.side_effect = [
+            Mock(content=b'', json=lambda: not_available),
+            Mock(content=b'', headers={}, raw=None, json=lambda: {'status': 'ok', 'data': []}),
+        ]
+        call = wargaming.WGN('app', 'ru', 'ru').clans.list(search='TAG')
+        # empty data is returned, it isn't re-fetched lazily
+        assert papi(call) == []
+        assert request.call_count == 2
+        assert request.call_args[0][0] == 'GET'
+        assert call.error is None
+
+        request.reset_mock()
+        request.side_effect = None
+        request.return_value = Mock(content=b'', json=lambda: {'status': 'error', 'error': {
+            'code': 407, 'message': 'INVALID_SEARCH', 'field': 'search', 'value': None}})
+        call = wargaming.WGN('app', 'ru', 'ru').clans.list(search='T')
+        call.http_method = 'POST'
+        with self.assertRaises(RequestError):
+            papi(call)
+        # other errors aren't retried
+        request.assert_called_once()
+        assert request.call_args[0][0] == 'POST'
+        assert call.error['message'] == 'INVALID_SEARCH'
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = 0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+        self.slept += seconds
+
+
+@override_settings(
+    UPSTREAM_RATE_LIMITS={'host': (2, 4)},
+    UPSTREAM_RATE_LIMIT_RESERVE=0.5,
+    UPSTREAM_RATE_LIMIT_WAIT=1,
+)
+class TestRateLimiter(SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.patches = [
+            patch('scheduler.upstream.memcache', FakeMemcache()),
+            patch('scheduler.upstream.time', self.clock),
+        ]
+        for i in self.patches:
+            i.start()
+
+    def tearDown(self):
+        for i in self.patches:
+            i.stop()
+
+    def test_burst(self):
+        for _ in range(4):
+            acquire('host')
+        assert self.clock.slept == 0
+        # next token in 0.5 seconds
+        acquire('host')
+        assert self.clock.slept == 0.5
+
+    def test_interactive_wait_limit(self):
+        for _ in range(4):
+            acquire('host')
+        with override_settings(UPSTREAM_RATE_LIMIT_WAIT=0.1):
+            with self.assertRaises(RateLimited):
+                acquire('host')
+        assert self.clock.slept == 0
+
+    def test_background_reserve(self):
+        with background():
+            acquire('host')
+            acquire('host')
+            assert self.clock.slept == 0
+            # half of the bucket is reserved for interactive calls
+            acquire('host')
+            assert self.clock.slept == 0.5
+        acquire('host')
+        acquire('host')
+        assert self.clock.slept == 0.5
+
+    def test_background_wait_limit(self):
+        for _ in range(4):
+            acquire('host')
+        with override_settings(UPSTREAM_BACKGROUND_RATE_LIMIT_WAIT=0.1):
+            with background(), self.assertRaises(RateLimited):
+                acquire('host')
+        assert self.clock.slept == 0
+
+    def test_unlimited_host(self):
+        acquire('other')
+
+    def test_memcache_unavailable(self):
+        with patch('scheduler.upstream.memcache') as memcache:
+            memcache.gets.side_effect = ConnectionRefusedError()
+            acquire('host')
+
+    def test_priority_in_workers(self):
+        with background():
+            assert fan_out([
+                lambda: upstream._priority.get(),
+                lambda: upstream._priority.get(),
+            ]) == [BACKGROUND, BACKGROUND]
+
+
+def fail():
+    raise ConnectTimeout()
+
+
+@override_settings(UPSTREAM_BREAKER_FAILURES=2, UPSTREAM_BREAKER_COOLDOWN=30)
+class TestCircuitBreaker(SimpleTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.patches = [
+            patch('scheduler.upstream.memcache', FakeMemcache()),
+            patch('scheduler.upstream.time', self.clock),
+        ]
+        for i in self.patches:
+            i.start()
+
+    def tearDown(self):
+        for i in self.patches:
+            i.stop()
+
+    def test_breaker(self):
+        breaker = CircuitBreaker('endpoint')
+        for _ in range(2):
+            with self.assertRaises(ConnectTimeout):
+                breaker.call(fail)
+        assert breaker.is_open
+        with self.assertRaises(CircuitOpen):
+            breaker.call(lambda: 1)
+
+        # trial call after cool-down
+        self.clock.now += 31
+        with self.assertRaises(ConnectTimeout):
+            breaker.call(fail)
+        with self.assertRaises(CircuitOpen):
+            breaker.call(lambda: 1)
+
+        self.clock.now += 31
+        assert breaker.call(lambda: 1) == 1
+        assert not breaker.is_open
+
+    def test_trial_unexpected_error(self):
+        breaker = CircuitBreaker('endpoint')
+        for _ in range(2):
+            with self.assertRaises(ConnectTimeout):
+                breaker.call(fail)
+        self.clock.now += 31
+        with self.assertRaises(KeyError):
+            breaker.call(Mock(side_effect=KeyError('clan_b')))
+        # circuit isn't stuck, the next trial closes it
+        assert breaker.call(lambda: 1) == 1
+        assert not breaker.is_open
+
+    def test_rate_limited_not_failure(self):
+        breaker = CircuitBreaker('endpoint')
+        for _ in range(3):
+            with self.assertRaises(RateLimited):
+                breaker.call(Mock(side_effect=RateLimited('Rate limit of host exceeded')))
+        assert not breaker.is_open
+        assert breaker.failures == 0
+
+    def test_guarded(self):
+        assert guarded('test/guarded', 'key', lambda: {'battles': [1]}) == ({'battles': [1]}, False)
+        assert guarded('test/guarded', 'key', fail) == ({'battles': [1]}, True)
+        with self.assertRaises(UpstreamUnavailable):
+            guarded('test/guarded', 'other', fail)
+
+    @patch('scheduler.util.memcache')
+    @patch('scheduler.upstream.get')
+    def test_stale_game_api_data(self, get, memcache):
+        local_cache.clear()
+        memcache.get.return_value = None
+        battles = [{'front_id': 'front_id', 'province_id': 'province_id'}]
+        get.return_value = Mock(status_code=200, content=b'{}', headers={}, raw=None,
+                                json=lambda: {'battles': battles, 'planned_battles': []})
+        assert game_api_clan_battles('ru', 1) == {'battles': battles, 'planned_battles': []}
+        memcache.set.assert_called_once()
+
+        memcache.set.reset_mock()
+        local_cache.clear()
+        get.side_effect = ConnectTimeout()
+        assert game_api_clan_battles('ru', 1) == {'battles': battles, 'planned_battles': [], 'stale': True}
+        # stale data isn't cached
+        memcache.set.assert_not_called()
+
+
+class TestTraffic(SimpleTestCase):
+    def setUp(self):
+        upstream._traffic.clear()
+        upstream._traffic_flushed_at = 0
+        self.clock = FakeClock()
+        self.clock.now = 3600 * 100 + 10
+        self.memcache = FakeMemcache()
+        self.patches = [
+            patch('scheduler.upstream.memcache', self.memcache),
+            patch('scheduler.upstream.time', self.clock),
+        ]
+        for i in self.patches:
+            i.start()
+
+    def tearDown(self):
+        for i in self.patches:
+            i.stop()
+
+    def test_traffic(self):
+        record_traffic('game_api/clan_battles', 100, 2)
+        record_traffic('game_api/clan_battles', 50, 1)
+        self.clock.now += 3600
+        record_traffic('papi/wot/globalmap/provinces', 1000, 10)
+        # not flushed counters of the process are reported too
+        assert sorted(get_traffic(2)) == [
+            (3600 * 100, 'game_api/clan_battles', {'calls': 2, 'bytes': 150, 'objects': 3}),
+            (3600 * 101, 'papi/wot/globalmap/provinces',
+             {'calls': 1, 'bytes': 1000, 'objects': 10}),
+        ]
+        assert get_traffic(1) == [
+            (3600 * 101, 'papi/wot/globalmap/provinces',
+             {'calls': 1, 'bytes': 1000, 'objects': 10}),
+        ]
+
+    @override_settings(TRAFFIC_FLUSH_INTERVAL=10)
+    def test_flush_interval(self):
+        with patch.object(self.memcache, 'incr_many', wraps=self.memcache.incr_many) as incr_many:
+            record_traffic('game_api/clan_battles', 100, 2)
+            record_traffic('game_api/clan_battles', 50, 1)
+            self.clock.now += 5
+            record_traffic('game_api/clan_battles', 10, 1)
+            # the first call is flushed at once, others are aggregated
+            assert incr_many.call_count == 2
+            self.clock.now += 5
+            record_traffic('game_api/clan_battles', 10, 1)
+            incr_many.assert_called_with({
+                'traffic/100/game_api/clan_battles/calls': 3,
+                'traffic/100/game_api/clan_battles/bytes': 70,
+                'traffic/100/game_api/clan_battles/objects': 3,
+            })
+        assert self.memcache.get('traffic/100/game_api/clan_battles/bytes') == '170'
+
+    def test_response_size(self):
+        response = requests.Response()
+        response._content = b'{"data": []}'
+        assert response_size(response) == 12
+        # compressed size
+        response.headers['Content-Length'] = '5'
+        assert response_size(response) == 5
+
+    def test_count_objects(self):
+        assert count_objects([{}, {}]) == 2
+        assert count_objects({'1': [{}, {}, {}], '2': None}) == 3
+        assert count_objects({'1': {'tag': 'TAG'}, '2': {'tag': 'TAG'}}) == 2
@@ -0,0 +1,157 @@
+from datetime import datetime, time, date
+from unittest.mock import patch
+import pytz
+
+from django.test import TestCase
+
+from scheduler.models import Clan, Schedule, ProvinceBattles, ClanInvolvement
+from scheduler.writer import write_provinces
+
+
+def make_province_data(province_id, **kwargs):
+    data = {
+        'front_id': 'front_id',
+        'front_name': 'front',
+        'province_id': province_id,
+        'province_name': 'province',
+        'arena_id': 'arena_id',
+        'arena_name': 'arena',
+        'server': 'RU6',
+        'prime_time': time(18, 15),
+        'battles_start_at': datetime(2017, 12, 13, 18, 15, tzinfo=pytz.UTC),
+        'owner_clan_id': 999,
+        'round_number': 1,
+        'status': 'STARTED',
+        'pretenders': [1, 2, 3],
+        'active_battles': [{
+            'start_at': datetime(2017, 12, 13, 18, 15, tzinfo=pytz.UTC),
+            'clan_a': {'clan_id': 1},
+            'clan_b': {'clan_id': 2},
+            'round': 1,
+        }, {
+            'start_at': datetime(2017, 12, 13, 18, 15, tzinfo=pytz.UTC),
+            'clan_a': {'clan_id': 3},
+            'clan_b': {'clan_id': None},
+            'round': 1,
+        }],
+    }
+    data.update(kwargs)
+    return data
+
+
+class TestWriteProvinces(TestCase):
+    def test_create(self):
+        write_provinces([make_province_data('province_id')])
+        schedule = Schedule.objects.get()
+        assert schedule.date == date(2017, 12, 13)
+        assert schedule.owner_id == 999
+        assert schedule.status == 'STARTED'
+        assert schedule.round_number == 1
+        assert {c.id for c in schedule.pretenders.all()} == {1, 2, 3}
+        assert set(schedule.battles.values_list('clan_a_id', 'clan_b_id')) == {(1, 2), (3, None)}
+        assert set(Clan.objects.values_list('id', flat=True)) == {1, 2, 3, 999}
+        assert ClanInvolvement.objects.filter(schedule=schedule, current_round=True).count() == 3
+
+    def test_update_doesnt_duplicate(self):
+        write_provinces([make_province_data('province_id')])
+        write_provinces([make_province_data(
+            'province_id',
+            pretenders=[1, 3],
+            owner_clan_id=None,
+            active_battles=[{
+                'start_at': datetime(2017, 12, 13, 18, 20, tzinfo=pytz.UTC),
+                'clan_a': {'clan_id': 3},
+                'clan_b': {'clan_id': None},
+                'round': 1,
+            }],
+        )])
+        schedule = Schedule.objects.get()
+        assert schedule.owner_id is None
+        assert {c.id for c in schedule.pretenders.all()} == {1, 3}
+        assert ProvinceBattles.objects.count() == 2
+        assert schedule.battles.get(clan_b=None).start_at == \
+            datetime(2017, 12, 13, 18, 20, tzinfo=pytz.UTC)
+
+    @patch('scheduler.util.memcache')
+    def test_invalidate_timetables(self, memcache):
+        write_provinces([make_province_data('province_id')])
+        with self.captureOnCommitCallbacks(execute=True):
+            write_provinces([make_province_data('province_id', pretenders=[1, 4])])
+        assert sorted(memcache.set_many.call_args[0][0]) == sorted(
+            f'timetable_version/ru/{clan_id}' for clan_id in [1, 2, 3, 4, 999])
+
+    @patch('scheduler.util.memcache')
+    def test_unchanged_timetables_not_invalidated(self, memcache):
+        write_provinces([make_province_data('province_id')])
+        Schedule.objects.update(updated_at=datetime(2017, 1, 1, tzinfo=pytz.UTC))
+        with self.captureOnCommitCallbacks(execute=True):
+            write_provinces([make_province_data('province_id')])
+        memcache.set_many.assert_not_called()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            write_provinces([make_province_data('province_id', owner_clan_id=4)])
+        assert sorted(memcache.set_many.call_args[0][0]) == sorted(
+            f'timetable_version/ru/{clan_id}' for clan_id in [1, 2, 3, 4, 999])
+
+    @patch('scheduler.util.memcache')
+    def test_stale_not_written(self, memcache):
+        write_provinces([make_province_data('province_id')])
+        write_provinces([
+            make_province_data('province_id', pretenders=[1, 4], stale=True),
+            make_province_data('other', stale=True),
+        ])
+        schedule = Schedule.objects.get()
+        assert {c.id for c in schedule.pretenders.all()} == {1, 2, 3}
+        memcache.set_many.assert_called_once()
+        assert sorted(memcache.set_many.call_args[0][0]) == sorted(
+            f'timetable_stale/ru/{clan_id}' for clan_id in [1, 2, 3, 4, 999])
+
+    def test_realms(self):
+        write_provinces([make_province_data('province_id')])
+        write_provinces([make_province_data('province_id', pretenders=[4])], 'eu')
+        assert Schedule.objects.count() == 2
+        schedule = Schedule.objects.get(realm='eu')
+        assert [c.id for c in schedule.pretenders.all()] == [4]
+        assert Clan.objects.get(id=4).realm == 'eu'
+        assert Clan.objects.get(id=1).realm == 'ru'
+        # battles before 12:00 UTC are of the previous day in EU
+        write_provinces([make_province_data('province_id', pretenders=[4], battles_start_at=datetime(
+            2017, 12, 14, 11, 15, tzinfo=pytz.UTC))], 'eu')
+        assert list(Schedule.objects.filter(realm='eu').values_list('date', flat=True)) == [
+            date(2017, 12, 13)]
+
+    def test_updated_at_changed_only_on_changes(self):
+        write_provinces([make_province_data('province_id')])
+        Schedule.objects.update(updated_at=datetime(2017, 1, 1, tzinfo=pytz.UTC))
+
+        write_provinces([make_province_data('province_id')])
+        assert Schedule.objects.get().updated_at == datetime(2017, 1, 1, tzinfo=pytz.UTC)
+
+        # pretenders aren't values of the schedule row
+        write_provinces([make_province_data('province_id', pretenders=[1, 2])])
+        assert Schedule.objects.get().updated_at == datetime(2017, 1, 1, tzinfo=pytz.UTC)
+
+        write_provinces([make_province_data('province_id', owner_clan_id=4)])
+        assert Schedule.objects.get().updated_at != datetime(2017, 1, 1, tzinfo=pytz.UTC)
+
+    def test_not_started_round_number_ignored(self):
+        write_provinces([make_province_data('province_id', status=None, active_battles=[])])
+        assert Schedule.objects.get().round_number is None
+
+    def test_no_pretenders_skipped(self):
+        assert write_provinces([make_province_data('province_id', pretenders=[])]) == []
+        assert not Schedule.objects.exists()
+
+    def test_constant_number_of_queries(self):
+        provinces_data = [make_province_data(f'province_id_{i}') for i in range(20)]
+        # clans, schedules, pretenders (2), battles (2), involvements rebuild (6)
+        # and 2 savepoints of atomic blocks
+        with self.assertNumQueries(16):
+            write_provinces(provinces_data)
+        assert Schedule.objects.count() == 20
+
+        # involvements of unchanged schedules aren't rebuilt,
+        # test is run in one transaction, so previous write is moved to the past
+        Schedule.objects.update(updated_at=datetime(2017, 1, 1, tzinfo=pytz.UTC))
+        with self.assertNumQueries(8):
+            write_provinces(provinces_data)
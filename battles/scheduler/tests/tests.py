@@ -1,10 +1,18 @@
 from datetime import datetime, time, timedelta
+from unittest.mock import patch
 import pytz
 
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.utils.dateparse import parse_datetime
+from django.utils.http import parse_http_date
 
-from scheduler.models import Clan, Schedule, ProvinceBattles
-from scheduler.views import get_active_clan_schedules_by_date
+from scheduler.models import Clan, Schedule, ProvinceBattles, ClanInvolvement
+from scheduler.views import get_active_clan_schedules_by_date, make_timetable
+from scheduler.tags import known_tags
+from scheduler.upstream import RateLimited
+from scheduler.util import get_today, get_timetable_versions, cache_timetables, \
+    invalidate_timetables, mark_timetables_stale
+from scheduler.tests.fakes import FakeMemcache
 
 
 def create_clans(number, owner=False):
@@ -326,6 +334,7 @@ class TestSelectCorrectProvinces(TestCase):
             round=1,
             start_at='2016-01-01T12:00:00Z'
         )
+        ClanInvolvement.rebuild(Schedule.objects.values_list('id', flat=True))
 
     def test_lost_on_first_round(self):
         assert get_active_clan_schedules_by_date(self.clan2, '2017-01-01') == []
@@ -335,3 +344,313 @@ class TestSelectCorrectProvinces(TestCase):
 
     def test_owner_has_battle(self):
         assert len(get_active_clan_schedules_by_date(self.owner, '2017-01-01')) == 1
+
+
+class TestTimetableQueries(TestCase):
+    def setUp(self):
+        self.cache = FakeMemcache()
+        self.memcache = patch('scheduler.util.memcache', self.cache)
+        self.memcache.start()
+        self.clan, *self.others, self.owner = create_clans(8, owner=True)
+        self.date = datetime.now(tz=pytz.UTC).date() + timedelta(days=1)
+        for i in range(10):
+            schedule = Schedule.objects.create(
+                front_id='front_id',
+                front_name='front',
+                province_id=f'province_id_{i}',
+                province_name='province',
+                arena_id='arena_id',
+                arena_name='arena',
+                server='server',
+                date=self.date,
+                prime_time='18:00',
+                battles_start_at=f'{self.date}T18:00:00Z',
+                round_number=1 if i % 2 else None,
+                owner=self.owner,
+            )
+            schedule.pretenders.add(self.clan, *self.others)
+            if schedule.round_number:
+                for clan_a, clan_b in zip([self.clan] + self.others[1::2], self.others[::2]):
+                    schedule.battles.create(
+                        clan_a=clan_a,
+                        clan_b=clan_b,
+                        round=1,
+                        start_at=schedule.battles_start_at,
+                    )
+        ClanInvolvement.rebuild(Schedule.objects.values_list('id', flat=True))
+        # filter of known tags is built once per process, not on every request
+        known_tags.clear()
+        known_tags.might_exist('ru', self.clan.tag)
+
+    def tearDown(self):
+        self.memcache.stop()
+
+    def test_constant_number_of_queries(self):
+        with self.assertNumQueries(3):
+            schedules = get_active_clan_schedules_by_date(self.clan, self.date)
+            for schedule in schedules:
+                assert schedule.is_involved(self.clan)
+                assert len(schedule.get_battle_times(self.clan)['rounds']) == 4
+        assert len(schedules) == 10
+
+    def test_view_constant_number_of_queries(self):
+        # clan lookup + schedules, pretenders and battles
+        with self.assertNumQueries(4):
+            response = self.client.get(f'/update/{self.clan.tag}')
+        assert len(response.json()['provinces']) == 10
+
+    def test_many_clans_constant_number_of_queries(self):
+        tags = ','.join(clan.tag for clan in [self.clan] + self.others)
+        # clans lookup + involvements + schedules, pretenders and battles
+        with self.assertNumQueries(5):
+            response = self.client.get(f'/update_many/?tags={tags}&ids=999')
+        data = response.json()
+        assert len(data['clans']) == 8
+        assert all(len(i['provinces']) == 10 for i in data['clans'])
+        assert data['not_found'] == [999]
+
+    def timetable_key(self, fmt='full'):
+        version = get_timetable_versions('ru', [self.clan.id])[self.clan.id]
+        return f'timetable/ru/{self.clan.id}/{get_today()}/{fmt}/{version["id"]}'
+
+    def test_cached_timetable(self):
+        self.cache.set(self.timetable_key(), '{"provinces": []}')
+        # only clan lookup
+        with self.assertNumQueries(1):
+            response = self.client.get(f'/update/{self.clan.tag}')
+        assert response.json() == {'provinces': []}
+        version = get_timetable_versions('ru', [self.clan.id])[self.clan.id]
+        assert response['ETag'] == f'"{version["id"]}/{get_today()}/full"'
+
+    def test_timetable_is_cached(self):
+        response = self.client.get(f'/update/{self.clan.tag}')
+        assert self.cache.get(self.timetable_key()) == response.content.decode()
+
+    def test_invalidated_timetable(self):
+        self.client.get(f'/update/{self.clan.tag}')
+        key = self.timetable_key()
+        invalidate_timetables('ru', [self.clan.id])
+        assert self.timetable_key() != key
+        self.cache.set(key, '{"provinces": []}')
+        # timetable of the old version isn't served
+        assert len(self.client.get(f'/update/{self.clan.tag}').json()['provinces']) == 10
+
+    def test_timetable_built_before_invalidation(self):
+        # timetable is built from data read before update of the clan's schedules
+        versions = get_timetable_versions('ru', [self.clan.id])
+        timetable = make_timetable(self.clan, [])
+        invalidate_timetables('ru', [self.clan.id])
+        cache_timetables('ru', {self.clan.id: timetable}, versions, get_today())
+        assert len(self.client.get(f'/update/{self.clan.tag}').json()['provinces']) == 10
+
+    def test_not_modified(self):
+        response = self.client.get(f'/update/{self.clan.tag}')
+        # timetable isn't built for the client with actual version
+        self.cache.delete_many([self.timetable_key()])
+
+        # only clan lookup
+        with self.assertNumQueries(1):
+            response = self.client.get(
+                f'/update/{self.clan.tag}', HTTP_IF_NONE_MATCH=response['ETag'])
+        assert response.status_code == 304
+        assert response.content == b''
+
+        response = self.client.get(
+            f'/update/{self.clan.tag}', HTTP_IF_NONE_MATCH='"outdated"')
+        assert response.status_code == 200
+
+    def test_last_modified_not_going_backwards(self):
+        response = self.client.get(f'/update/{self.clan.tag}')
+        last_modified = response['Last-Modified']
+        # the most recently updated schedule is left
+        Schedule.objects.filter(province_id='province_id_9').update(status='FINISHED')
+        with patch('scheduler.util.time', return_value=parse_http_date(last_modified) + 10):
+            invalidate_timetables('ru', [self.clan.id])
+        response = self.client.get(
+            f'/update/{self.clan.tag}', HTTP_IF_MODIFIED_SINCE=last_modified)
+        assert response.status_code == 200
+        assert len(response.json()['provinces']) == 9
+        assert parse_http_date(response['Last-Modified']) == parse_http_date(last_modified) + 10
+
+    def test_stale_warning(self):
+        response = self.client.get(f'/update/{self.clan.tag}')
+        assert 'Warning' not in response
+        mark_timetables_stale('ru', [self.clan.id])
+        response = self.client.get(f'/update/{self.clan.tag}', HTTP_IF_NONE_MATCH=response['ETag'])
+        assert response.status_code == 304
+        assert response['Warning'] == '110 - "Response is Stale"'
+        tags = ','.join(clan.tag for clan in [self.clan] + self.others)
+        assert self.client.get(f'/update_many/?tags={tags}')['Warning'] == \
+            '110 - "Response is Stale"'
+
+    def test_filtered_not_modified(self):
+        url = f'/update/{self.clan.tag}?from={self.date}T17:00:00'
+        response = self.client.get(url)
+        assert 'Last-Modified' not in response
+        # clan lookup and ids of filtered schedules
+        with self.assertNumQueries(2):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        assert response.status_code == 304
+        response = self.client.get(
+            f'/update/{self.clan.tag}?from={self.date}T19:00:00',
+            HTTP_IF_NONE_MATCH=response['ETag'])
+        assert response.status_code == 200
+
+    @patch('scheduler.views.get_clans_tags')
+    def test_tags_backfill_invalidates_timetables(self, get_clans_tags):
+        version = get_timetable_versions('ru', [self.clan.id])[self.clan.id]
+        Clan.objects.filter(id=self.others[0].id).update(tag='')
+        get_clans_tags.return_value = {str(self.others[0].id): {'tag': 'NEW'}}.items()
+        b''.join(self.client.get('/update_all/').streaming_content)
+        assert Clan.objects.get(id=self.others[0].id).tag == 'NEW'
+        # tag is shown in timetables of clans sharing schedules with the clan
+        assert get_timetable_versions('ru', [self.clan.id])[self.clan.id] != version
+
+    @patch('scheduler.views.get_clans_tags')
+    def test_tags_backfill_rate_limited(self, get_clans_tags):
+        Clan.objects.filter(id=self.others[0].id).update(tag='')
+        get_clans_tags.side_effect = RateLimited('Rate limit of host exceeded')
+        content = b''.join(self.client.get('/update_all/').streaming_content)
+        assert b'WG API is unavailable: Rate limit of host exceeded' in content
+        assert Clan.objects.get(id=self.others[0].id).tag == ''
+
+    def test_compact_format(self):
+        full = self.client.get(f'/update/{self.clan.tag}').json()
+        response = self.client.get(f'/update/{self.clan.tag}?format=compact')
+        assert 'Accept' in response['Vary'].split(', ')
+        data = response.json()
+        assert data['format'] == 'compact'
+        assert data['clan'] == full['clan']
+        assert len(data['provinces']) == len(full['provinces'])
+
+        provinces = {i['province_id']: i for i in full['provinces']}
+        for province in data['provinces']:
+            expected = provinces[province['province_id']]
+            prime_at = parse_datetime(province['prime_at'])
+            rounds = province['rounds']
+            assert rounds['title'] == [i['title'] for i in expected['rounds']]
+            for i, round_data in enumerate(expected['rounds']):
+                assert prime_at + timedelta(minutes=rounds['time'][i]) == \
+                    parse_datetime(round_data['time'])
+                for side in ('clan_a', 'clan_b'):
+                    clan_id = rounds[side][i]
+                    if round_data[side] is None:
+                        assert clan_id is None
+                    else:
+                        assert data['clans'][str(clan_id)] == round_data[side]['tag']
+
+    def test_compact_format_by_accept_header(self):
+        response = self.client.get(
+            f'/update_many/?tags={self.clan.tag}',
+            HTTP_ACCEPT='application/vnd.battles.compact+json')
+        assert response.json()['clans'][0]['format'] == 'compact'
+
+    def test_many_clans_not_modified(self):
+        url = f'/update_many/?tags={self.clan.tag},{self.others[0].tag}'
+        response = self.client.get(url)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        assert response.status_code == 304
+
+    @patch('scheduler.views.get_clan_data')
+    def test_many_clans_unknown_tag(self, get_clan_data):
+        get_clan_data.return_value = None
+        response = self.client.get(f'/update_many/?tags={self.clan.tag},NONE')
+        data = response.json()
+        assert [i['clan']['tag'] for i in data['clans']] == [self.clan.tag]
+        assert data['not_found'] == ['NONE']
+
+    def test_window_filter(self):
+        def count(query):
+            response = self.client.get(f'/update/{self.clan.tag}?{query}')
+            return len(response.json()['provinces'])
+
+        assert count(f'to={self.date}T12:00:00Z') == 0
+        assert count(f'from={self.date}T17:00:00&to={self.date}T19:00:00') == 10
+        assert count(f'from={self.date + timedelta(days=1)}') == 0
+        assert count(f'to={self.date}') == 10
+        assert count('hours=1') == 0
+        # filtered timetables aren't cached
+        assert not [i for i in self.cache.data if i.startswith('timetable/')]
+
+    def test_status_filter(self):
+        Schedule.objects.filter(round_number=1).update(status='STARTED')
+        response = self.client.get(f'/update/{self.clan.tag}?status=STARTED')
+        assert len(response.json()['provinces']) == 5
+
+    def test_invalid_filter(self):
+        response = self.client.get(f'/update/{self.clan.tag}?status=UNKNOWN')
+        assert response.status_code == 400
+        response = self.client.get(f'/update/{self.clan.tag}?from=yesterday')
+        assert response.status_code == 400
+        for hours in ['1e10', 'inf', 'nan', '-1', '0', '169']:
+            response = self.client.get(f'/update/{self.clan.tag}?hours={hours}')
+            assert response.status_code == 400
+        response = self.client.get(f'/update/{self.clan.tag}?to=0001-01-01T00:00:00')
+        assert response.status_code == 400
+
+    @patch('scheduler.views.get_clan_data')
+    def test_realm(self, get_clan_data):
+        get_clan_data.return_value = None
+        # clan with the same tag in another realm
+        Clan.objects.create(id=500000001, realm='eu', tag=self.clan.tag)
+        response = self.client.get(f'/eu/update/{self.clan.tag}')
+        assert response.json()['clan']['clan_id'] == 500000001
+        assert response.json()['provinces'] == []
+        response = self.client.get(f'/ru/update/{self.clan.tag}')
+        assert response.json()['clan']['clan_id'] == self.clan.id
+        assert len(response.json()['provinces']) == 10
+
+        assert self.client.get(f'/xx/update/{self.clan.tag}').status_code == 404
+        assert self.client.get('/eu/update/NONE').status_code == 404
+        get_clan_data.assert_called_once_with('eu', 'NONE')
+
+    @override_settings(SERVED_REALMS=['eu'])
+    def test_realm_not_served(self):
+        assert self.client.get(f'/ru/update/{self.clan.tag}').status_code == 404
+        assert self.client.get(f'/update_many/?tags={self.clan.tag}').status_code == 404
+
+
+class TestClanInvolvement(TestCase):
+    def setUp(self):
+        self.clan1, self.clan2, self.clan3, self.owner = create_clans(3, owner=True)
+        self.schedule = Schedule.objects.create(
+            front_id='front_id',
+            front_name='front',
+            province_id='province_id',
+            province_name='province',
+            arena_id='arena_id',
+            arena_name='arena',
+            server='server',
+            date='2017-01-01',
+            prime_time='12:00',
+            battles_start_at='2017-01-01T12:00:00Z',
+            round_number=2,
+            owner=self.owner,
+        )
+        self.schedule.pretenders.add(self.clan1, self.clan2, self.clan3)
+        self.schedule.battles.create(
+            clan_a=self.clan1, clan_b=self.clan2, round=1, start_at='2017-01-01T12:00:00Z')
+        self.schedule.battles.create(
+            clan_a=self.clan3, clan_b=None, round=1, start_at='2017-01-01T12:00:00Z')
+        self.schedule.battles.create(
+            clan_a=self.clan1, clan_b=self.clan3, round=2, start_at='2017-01-01T12:30:00Z')
+
+    def test_rebuild(self):
+        ClanInvolvement.rebuild([self.schedule.id])
+        assert set(ClanInvolvement.objects.values_list('clan_id', 'role', 'current_round')) == {
+            (self.owner.id, ClanInvolvement.OWNER, False),
+            (self.clan1.id, ClanInvolvement.PRETENDER, False),
+            (self.clan2.id, ClanInvolvement.PRETENDER, False),
+            (self.clan3.id, ClanInvolvement.PRETENDER, False),
+            (self.clan1.id, ClanInvolvement.PARTICIPANT, True),
+            (self.clan2.id, ClanInvolvement.PARTICIPANT, False),
+            (self.clan3.id, ClanInvolvement.PARTICIPANT, True),
+        }
+
+    def test_rebuild_replaces_rows(self):
+        ClanInvolvement.rebuild([self.schedule.id])
+        self.schedule.pretenders.remove(self.clan2)
+        self.schedule.battles.filter(clan_b=self.clan2).delete()
+        touched = ClanInvolvement.rebuild([self.schedule.id])
+        assert not ClanInvolvement.objects.filter(clan=self.clan2).exists()
+        assert touched == {self.clan1.id, self.clan2.id, self.clan3.id, self.owner.id}
@@ -0,0 +1,512 @@
+"""Calls to upstream WG APIs
+
+All HTTP requests are made by the shared keep-alive session with timeouts
+and retries, and are limited by the rate limiter shared by all workers.
+Independent calls are executed concurrently by the shared bounded pool.
+"""
+import time
+import random
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout, RequestException
+from pymemcache.exceptions import MemcacheError
+from wargaming.meta import WGAPI
+from wargaming.exceptions import RequestError
+from wargaming.settings import HTTP_USER_AGENT_HEADER
+
+from django.conf import settings
+
+from . import cassette
+from .records import ValidationError
+from .util import memcache
+
+
+log = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+def _init_worker():
+    _local.worker = True
+
+
+executor = ThreadPoolExecutor(
+    max_workers=settings.UPSTREAM_WORKERS,
+    thread_name_prefix='upstream',
+    initializer=_init_worker,
+)
+
+
+class UpstreamTimeout(Exception):
+    pass
+
+
+# failures of upstream calls, malformed payloads are failures too
+UPSTREAM_ERRORS = (RequestException, RequestError, ValidationError)
+
+
+class CircuitOpen(RequestException):
+    pass
+
+
+class UpstreamUnavailable(RequestException):
+    pass
+
+
+def fan_out(calls, timeout=None):
+    """Execute independent calls concurrently, returns results in the same order
+
+    :param calls: list of functions without arguments
+    :param timeout: overall deadline in seconds for all calls together,
+        settings.UPSTREAM_TIMEOUT by default
+
+    Exception raised by a call is raised to the caller, UpstreamTimeout
+    is raised if some calls aren't finished by the deadline. Calls which are
+    already running can't be stopped, they keep running in the pool until
+    their HTTP timeouts, only calls not started yet are cancelled.
+    Nested fan-outs are executed sequentially in the worker, so pool
+    can't be exhausted by workers waiting for each other.
+    """
+    calls = list(calls)
+    if len(calls) < 2 or getattr(_local, 'worker', False):
+        return [call() for call in calls]
+
+    timeout = settings.UPSTREAM_TIMEOUT if timeout is None else timeout
+    # context (e.g. priority of calls) is passed to workers
+    futures = [executor.submit(contextvars.copy_context().run, call) for call in calls]
+    _, not_done = wait(futures, timeout=timeout)
+    if not_done:
+        for future in not_done:
+            future.cancel()
+        raise UpstreamTimeout(f'{len(not_done)} of {len(futures)} upstream calls '
+                              f'not finished by deadline of {timeout} seconds')
+    return [future.result() for future in futures]
+
+
+def make_session():
+    session = requests.Session()
+    session.headers['User-Agent'] = HTTP_USER_AGENT_HEADER
+    # connections pool per host, size should be close to number of workers
+    pools = dict(settings.UPSTREAM_POOLS)
+    default = pools.pop('default')
+    session.mount('https://', HTTPAdapter(pool_maxsize=default))
+    session.mount('http://', HTTPAdapter(pool_maxsize=default))
+    for host, size in pools.items():
+        session.mount(f'https://{host}/', HTTPAdapter(pool_maxsize=size))
+    return session
+
+
+session = make_session()
+
+
+def backoff(attempt):
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(
+        settings.UPSTREAM_BACKOFF_MAX, settings.UPSTREAM_BACKOFF * 2 ** attempt))
+
+
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+
+_priority = contextvars.ContextVar('upstream_priority', default=INTERACTIVE)
+
+
+@contextmanager
+def priority(value):
+    """Priority of upstream calls made in the block"""
+    token = _priority.set(value)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def background():
+    """Calls of background work (e.g. tags backfill) wait for interactive ones"""
+    return priority(BACKGROUND)
+
+
+class RateLimited(RequestException):
+    pass
+
+
+def _take_token(host, rate, burst, reserve):
+    """Take token from the bucket shared by all workers
+
+    Returns 0 if token was taken, seconds to wait for the next token otherwise
+    """
+    key = f'ratelimit/{host}'
+    now = time.time()
+    state, cas = memcache.gets(key)
+    if state is None:
+        tokens = burst
+    else:
+        tokens, updated_at = state
+        tokens = min(burst, tokens + (now - updated_at) * rate)
+    if tokens - 1 < reserve:
+        return (1 + reserve - tokens) / rate
+
+    value = [tokens - 1, now]
+    if state is None:
+        taken = memcache.add(key, value, expire=60, noreply=False)
+    else:
+        taken = memcache.cas(key, value, cas, expire=60, noreply=False)
+    # bucket was changed by another worker, try again
+    return 0 if taken else random.uniform(0, 1 / rate)
+
+
+def acquire(host):
+    """Wait for a token of host's rate limit
+
+    Background calls can't take tokens from the reserved part of the bucket,
+    so they wait while interactive calls are in progress. Interactive calls
+    wait at most settings.UPSTREAM_RATE_LIMIT_WAIT seconds, background ones
+    settings.UPSTREAM_BACKGROUND_RATE_LIMIT_WAIT seconds, then RateLimited
+    is raised.
+    """
+    if host not in settings.UPSTREAM_RATE_LIMITS:
+        return
+    rate, burst = settings.UPSTREAM_RATE_LIMITS[host]
+    is_background = _priority.get() == BACKGROUND
+    reserve = burst * settings.UPSTREAM_RATE_LIMIT_RESERVE if is_background else 0
+    deadline = time.time() + (
+        settings.UPSTREAM_BACKGROUND_RATE_LIMIT_WAIT if is_background
+        else settings.UPSTREAM_RATE_LIMIT_WAIT)
+    while True:
+        try:
+            wait_seconds = _take_token(host, rate, burst, reserve)
+        except (MemcacheError, OSError) as e:
+            # limiter isn't available, don't block requests
+            log.warning('Rate limiter is not available: %s', e)
+            return
+        if not wait_seconds:
+            return
+        if time.time() + wait_seconds > deadline:
+            raise RateLimited(f'Rate limit of {host} exceeded')
+        time.sleep(wait_seconds)
+
+
+def get(url, params=None):
+    """GET request, see request()"""
+    return request('GET', url, params)
+
+
+def request(method, url, params=None):
+    """GET or POST request with connect/read timeouts
+
+    Params of POST request are sent as form data.
+    Request is retried on 5xx responses, connection errors and timeouts.
+    Exception of last attempt is raised, last 5xx response is returned as is.
+    Requests are recorded to or replayed from the cassette in use.
+    """
+    if method not in ('GET', 'POST'):
+        raise RequestError(f'Unknown HTTP method {method}')
+    recorder = cassette.active
+    if recorder is None:
+        return _request(method, url, params)
+    if recorder.mode == cassette.REPLAY:
+        return recorder.replay(url, params)
+
+    started_at = time.perf_counter()
+    try:
+        response = _request(method, url, params)
+    except RequestException as e:
+        recorder.record(url, params, started_at, error=e)
+        raise
+    recorder.record(url, params, started_at, response=response)
+    return response
+
+
+def _request(method, url, params):
+    host = urlsplit(url).hostname
+    retries = settings.UPSTREAM_RETRIES
+    for attempt in range(retries + 1):
+        acquire(host)
+        try:
+            timeout = (settings.UPSTREAM_CONNECT_TIMEOUT, settings.UPSTREAM_READ_TIMEOUT)
+            if method == 'GET':
+                response = session.get(url, params=params, timeout=timeout)
+            else:
+                response = session.post(url, data=params, timeout=timeout)
+        except (ConnectionError, Timeout) as e:
+            if attempt == retries:
+                raise
+            log.warning('Retrying %s after error: %s', url, e)
+        else:
+            if response.status_code < 500 or attempt == retries:
+                return response
+            log.warning('Retrying %s after status %s', url, response.status_code)
+        time.sleep(backoff(attempt))
+
+
+def papi(call):
+    """Fetch wargaming library request with the shared session, returns its data
+
+    Data is returned instead of the library request object, so it's never
+    re-fetched lazily by the library. SOURCE_NOT_AVAILABLE errors are retried
+    as the library does. Other values (e.g. data faked in tests) are returned
+    as is.
+    """
+    if not isinstance(call, WGAPI):
+        return call
+    if call._data is not None:
+        return call._data
+    retries = settings.UPSTREAM_RETRIES
+    for attempt in range(retries + 1):
+        try:
+            return _fetch_papi(call)
+        except RequestError as e:
+            if e.code != 504 or attempt == retries:
+                raise
+            log.warning('Retrying %s after error: %s', call.url, e.message)
+        time.sleep(backoff(attempt))
+
+
+def _fetch_papi(call):
+    response = request(call.http_method, call.url, params=call.params)
+    try:
+        data = response.json()
+    except ValueError:
+        raise RequestError('Unable to decode json')
+    if data.get('status', '') == 'error':
+        call.error = data['error']
+        raise RequestError(**call.error)
+    data = data.get('data', data)
+    record_traffic(papi_endpoint(call.url), response_size(response), count_objects(data))
+    if call.parser:
+        data = call.parser.parse_response_data(data)
+    call.error = None
+    call.data = data
+    return data
+
+
+def count_objects(data):
+    """Number of objects in PAPI data, lists of {key: [object, ...]} are counted"""
+    if isinstance(data, dict):
+        return sum(len(i) if isinstance(i, list) else 1 for i in data.values() if i)
+    return len(data or ())
+
+
+def papi_endpoint(url):
+    """e.g. papi/wot/globalmap/provinces"""
+    return 'papi/' + urlsplit(url).path.strip('/')
+
+
+# endpoints shown by traffic report
+TRAFFIC_ENDPOINTS = [
+    'papi/wot/globalmap/provinces',
+    'papi/wot/globalmap/clanprovinces',
+    'papi/wgn/clans/list',
+    'papi/wgn/clans/info',
+    'game_api/tournament_info',
+    'game_api/clan_battles',
+]
+TRAFFIC_COUNTERS = ['calls', 'bytes', 'objects']
+
+
+def traffic_key(hour, endpoint, counter):
+    return f'traffic/{hour}/{endpoint}/{counter}'
+
+
+# counters of this process not flushed to memcache yet: {key: value}
+_traffic = {}
+_traffic_lock = threading.Lock()
+_traffic_flushed_at = 0
+
+
+def response_size(response):
+    """Bytes received over the wire, compressed body isn't decoded"""
+    length = response.headers.get('Content-Length')
+    if length is not None and length.isdigit():
+        return int(length)
+    if response.raw is not None:
+        # chunked response
+        return response.raw.tell()
+    return len(response.content)
+
+
+def record_traffic(endpoint, size, objects):
+    """Count call, bytes and objects received from endpoint in current hour
+
+    Counters are aggregated in process and flushed every
+    settings.TRAFFIC_FLUSH_INTERVAL seconds.
+    """
+    global _traffic_flushed_at
+    now = time.time()
+    hour = int(now // 3600)
+    with _traffic_lock:
+        for counter, value in zip(TRAFFIC_COUNTERS, (1, size, objects)):
+            key = traffic_key(hour, endpoint, counter)
+            _traffic[key] = _traffic.get(key, 0) + value
+        flush = now - _traffic_flushed_at >= settings.TRAFFIC_FLUSH_INTERVAL
+        if flush:
+            _traffic_flushed_at = now
+    if flush:
+        flush_traffic()
+
+
+def flush_traffic():
+    """Add counters of this process to memcache"""
+    global _traffic
+    with _traffic_lock:
+        counters, _traffic = _traffic, {}
+    if not counters:
+        return
+    try:
+        missing = [key for key, value in memcache.incr_many(counters).items() if value is None]
+        if missing:
+            # counters are created by the first flush in the hour
+            added = memcache.add_many(
+                {key: str(counters[key]) for key in missing}, expire=settings.TRAFFIC_LIFETIME)
+            memcache.incr_many({key: counters[key] for key in missing if key not in added})
+    except (MemcacheError, OSError) as e:
+        log.warning('Unable to record traffic: %s', e)
+
+
+def get_traffic(hours):
+    """Returns [(hour_start, endpoint, {counter: value}), ...] for last hours"""
+    flush_traffic()
+    current = int(time.time() // 3600)
+    keys = [
+        (hour, endpoint, counter)
+        for hour in range(current - hours + 1, current + 1)
+        for endpoint in TRAFFIC_ENDPOINTS
+        for counter in TRAFFIC_COUNTERS
+    ]
+    values = memcache.get_many([traffic_key(*i) for i in keys])
+    result = {}
+    for hour, endpoint, counter in keys:
+        value = values.get(traffic_key(hour, endpoint, counter))
+        if value is not None:
+            result.setdefault((hour, endpoint), dict.fromkeys(TRAFFIC_COUNTERS, 0))
+            result[(hour, endpoint)][counter] = int(value)
+    return [(hour * 3600, endpoint, counters) for (hour, endpoint), counters in result.items()]
+
+
+def connection_stats():
+    """Returns {host: {'new': count, 'reused': count}} of session connections"""
+    stats = {}
+    for adapter in set(session.adapters.values()):
+        for key in adapter.poolmanager.pools.keys():
+            pool = adapter.poolmanager.pools[key]
+            host = stats.setdefault(pool.host, {'new': 0, 'reused': 0})
+            host['new'] += pool.num_connections
+            host['reused'] += pool.num_requests - pool.num_connections
+    return stats
+
+
+class CircuitBreaker:
+    """Stops calls to failing endpoint for settings.UPSTREAM_BREAKER_COOLDOWN seconds
+
+    Circuit is opened after settings.UPSTREAM_BREAKER_FAILURES failures in a row.
+    After cool-down a single trial call is allowed, its success closes the circuit.
+    Calls throttled by our rate limiter aren't failures of the endpoint.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def call(self, func):
+        with self.lock:
+            if self.opened_at is not None:
+                cooldown = time.time() - self.opened_at < settings.UPSTREAM_BREAKER_COOLDOWN
+                if cooldown or self.trial:
+                    raise CircuitOpen(f'Circuit of {self.name} is open')
+                self.trial = True
+        try:
+            result = func()
+        except RateLimited:
+            raise
+        except UPSTREAM_ERRORS:
+            with self.lock:
+                self.failures += 1
+                if self.is_open or self.failures >= settings.UPSTREAM_BREAKER_FAILURES:
+                    if not self.is_open:
+                        log.error('Circuit of %s is opened after %s failures',
+                                  self.name, self.failures)
+                    self.opened_at = time.time()
+            raise
+        finally:
+            # next trial is allowed whatever the trial call raised
+            with self.lock:
+                self.trial = False
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+        return result
+
+
+breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(endpoint):
+    with _breakers_lock:
+        if endpoint not in breakers:
+            breakers[endpoint] = CircuitBreaker(endpoint)
+        return breakers[endpoint]
+
+
+def _last_good_call(fn, *args, **kwargs):
+    # last known good payloads are optional, memcache failures are ignored
+    try:
+        return fn(*args, **kwargs)
+    except (MemcacheError, OSError) as e:
+        log.warning('Unable to access last known good payloads: %s', e)
+
+
+def guarded(endpoint, key, fetch):
+    """Call fetch() through the circuit breaker of the endpoint
+
+    Successful payload is saved as last known good, it is returned instead if
+    the endpoint fails or its circuit is open.
+    Returns (payload, is_stale), raises UpstreamUnavailable if there is no
+    last known good payload.
+    """
+    try:
+        payload = get_breaker(endpoint).call(fetch)
+    except UPSTREAM_ERRORS as e:
+        payload = _last_good_call(memcache.get, f'lkg/{key}')
+        if payload is None:
+            log.error('%s is unavailable: %s', endpoint, e)
+            raise UpstreamUnavailable(f'{endpoint} is unavailable') from e
+        log.warning('%s is unavailable, last known good %s is used: %s', endpoint, key, e)
+        return payload, True
+    _last_good_call(memcache.set, f'lkg/{key}', payload,
+                    expire=settings.UPSTREAM_LAST_GOOD_LIFETIME)
+    return payload, False
+
+
+def guarded_many(endpoint, prefix, keys, fetch):
+    """Same as guarded() for fetch() returning {key: payload}
+
+    Payloads are saved and served per key.
+    Returns (payloads, is_stale).
+    """
+    try:
+        payloads = get_breaker(endpoint).call(fetch)
+    except UPSTREAM_ERRORS as e:
+        payloads = _last_good_call(memcache.get_many, [f'lkg/{prefix}/{i}' for i in keys])
+        if not payloads:
+            log.error('%s is unavailable: %s', endpoint, e)
+            raise UpstreamUnavailable(f'{endpoint} is unavailable') from e
+        log.warning('%s is unavailable, last known good %s is used: %s', endpoint, prefix, e)
+        return {k[len(f'lkg/{prefix}/'):]: v for k, v in payloads.items()}, True
+    _last_good_call(memcache.set_many, {
+        f'lkg/{prefix}/{k}': v for k, v in payloads.items()
+    }, expire=settings.UPSTREAM_LAST_GOOD_LIFETIME)
+    return payloads, False
@@ -1,13 +1,32 @@
 import os
+import copy
 import json
+import uuid
+import contextvars
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from itertools import chain
 from functools import wraps
-from time import perf_counter
+from time import perf_counter, monotonic, sleep, time
+from datetime import datetime, timedelta
 
+from django.conf import settings
+from pymemcache.client.base import PooledClient
 
-from pymemcache.client.base import Client
+log = logging.getLogger(__name__)
 
 MEMCACHE_LIFETIME = 10
+# WG API data older than MEMCACHE_LIFETIME is served while refreshed in background
+MEMCACHE_STALE_LIFETIME = 60
+# timetables are invalidated on updates, lifetime is a safety net only
+TIMETABLE_LIFETIME = 300
+# new version is created if it is expired, so timetable is rebuilt
+TIMETABLE_VERSION_LIFETIME = 24 * 60 * 60
+TIMETABLE_FULL = 'full'
+TIMETABLE_COMPACT = 'compact'
+TIMETABLE_FORMATS = (TIMETABLE_FULL, TIMETABLE_COMPACT)
 
 
 def json_serializer(key, value):
@@ -26,13 +45,229 @@ def json_deserializer(key, value, flags):
     raise Exception("Unknown serialization format")
 
 
-memcache = Client(
+class MemcacheClient(PooledClient):
+    def add_many(self, values, expire=0):
+        """Store values of keys missing in cache, returns list of stored keys
+
+        Commands are pipelined, all keys are added in one round trip.
+        """
+        with self.client_pool.get_and_release(destroy_on_fail=True) as client:
+            # pymemcache has multi-key store command, but no public add_many
+            results = client._store_cmd(b'add', values, expire, False)
+        return [key for key, stored in results.items() if stored]
+
+    def incr_many(self, values):
+        """Increment counters, returns {key: new value or None if key is missing}
+
+        Commands are pipelined, all counters are incremented in one round trip.
+        """
+        if not values:
+            return {}
+        with self.client_pool.get_and_release(destroy_on_fail=True) as client:
+            cmds = [
+                b'incr ' + client.check_key(key, client.key_prefix) + b' '
+                + client._check_integer(value, 'value') + b'\r\n'
+                for key, value in values.items()
+            ]
+            results = client._misc_cmd(cmds, b'incr', False)
+        return {
+            key: None if result == b'NOT_FOUND' else int(result)
+            for key, result in zip(values, results)
+        }
+
+
+# client is shared by threads of upstream calls pool
+memcache = MemcacheClient(
     (os.environ.get('MEMCACHE_HOSTNAME', 'localhost'), 11211),
     serializer=json_serializer,
     deserializer=json_deserializer
 )
 
 
+def get_prime_hour(realm=None):
+    """Hour (UTC) when battles of the next day start in the realm"""
+    return settings.REALMS[realm or settings.DEFAULT_REALM]['prime_starts_at_hour']
+
+
+def get_today(realm=None):
+    dt = datetime.now()
+    if dt.hour < get_prime_hour(realm):
+        dt = dt - timedelta(days=1)
+    return dt.date()
+
+
+def get_battle_date(battle_dt, realm=None):
+    return (battle_dt - timedelta(hours=get_prime_hour(realm))).date()
+
+
+def timetable_version_key(realm, clan_id):
+    return f'timetable_version/{realm}/{clan_id}'
+
+
+def new_timetable_version():
+    """Unique version of clan timetable, versions are never reused"""
+    return {'id': uuid.uuid4().hex, 'modified': int(time())}
+
+
+def get_timetable_versions(realm, clan_ids):
+    """Returns {clan_id: version} of clans timetables
+
+    version is a dict with unique 'id' and 'modified' timestamp, it is
+    changed by invalidate_timetables(). Versions missing in cache are created.
+    Version must be read before data of the timetable is read from DB.
+    Versions of timetables marked by mark_timetables_stale() have 'stale' set.
+    """
+    keys = {timetable_version_key(realm, clan_id): clan_id for clan_id in clan_ids}
+    stale_keys = {timetable_stale_key(realm, clan_id): clan_id for clan_id in clan_ids}
+    values = memcache.get_many(list(keys) + list(stale_keys))
+    stale = {stale_keys[k] for k in stale_keys.keys() & values.keys()}
+    versions = {k: values[k] for k in keys.keys() & values.keys()}
+    for key in keys.keys() - versions.keys():
+        version = new_timetable_version()
+        if not memcache.add(key, version, expire=TIMETABLE_VERSION_LIFETIME, noreply=False):
+            # version was created by another worker
+            version = memcache.get(key) or version
+        versions[key] = version
+    return {
+        keys[k]: dict(v, stale=True) if keys[k] in stale else v
+        for k, v in versions.items()
+    }
+
+
+def timetable_stale_key(realm, clan_id):
+    return f'timetable_stale/{realm}/{clan_id}'
+
+
+def mark_timetables_stale(realm, clan_ids):
+    """Mark timetables of clans as stale for settings.TIMETABLE_STALE_LIFETIME"""
+    if clan_ids:
+        memcache.set_many(
+            {timetable_stale_key(realm, clan_id): '1' for clan_id in clan_ids},
+            expire=settings.TIMETABLE_STALE_LIFETIME)
+
+
+def timetable_key(realm, clan_id, date, fmt, version):
+    return f'timetable/{realm}/{clan_id}/{date}/{fmt}/{version["id"]}'
+
+
+def get_cached_timetables(realm, versions, date, fmt=TIMETABLE_FULL):
+    """Returns {clan_id: timetable} for cached clans timetables
+
+    versions is {clan_id: version} from get_timetable_versions(),
+    timetable is serialized body, its validators are made of the version
+    """
+    keys = {
+        timetable_key(realm, clan_id, date, fmt, version): clan_id
+        for clan_id, version in versions.items()
+    }
+    return {keys[k]: v for k, v in memcache.get_many(list(keys)).items()}
+
+
+def cache_timetables(realm, timetables, versions, date, fmt=TIMETABLE_FULL):
+    """Store {clan_id: timetable} built for versions {clan_id: version}
+
+    Timetable built from data read before invalidation is stored with
+    outdated version, so it isn't served.
+    """
+    memcache.set_many({
+        timetable_key(realm, clan_id, date, fmt, versions[clan_id]): timetable
+        for clan_id, timetable in timetables.items()
+    }, expire=TIMETABLE_LIFETIME)
+
+
+def invalidate_timetables(realm, clan_ids):
+    """Change versions of clans timetables, cached timetables aren't served anymore"""
+    if clan_ids:
+        memcache.set_many({
+            timetable_version_key(realm, clan_id): new_timetable_version()
+            for clan_id in clan_ids
+        }, expire=TIMETABLE_VERSION_LIFETIME)
+
+
+def acquire_lock(key, timeout):
+    """Lock shared by all workers, released only by timeout
+
+    Returns True if lock was acquired by the caller
+    """
+    return memcache.add(f'lock/{key}', '1', expire=timeout, noreply=False)
+
+
+def lease_key(key):
+    return f'lease/{key}'
+
+
+def acquire_leases(keys):
+    """Elect single filler of missed cache keys across workers
+
+    Returns set of keys leased by the caller, the caller must fill them
+    and release leases, other workers wait for values with wait_for_keys()
+    """
+    if not keys:
+        return set()
+    leases = {lease_key(key): key for key in keys}
+    added = memcache.add_many(
+        dict.fromkeys(leases, '1'), expire=settings.CACHE_LEASE_TIMEOUT)
+    return {leases[i] for i in added}
+
+
+def release_leases(keys):
+    if keys:
+        memcache.delete_many([lease_key(key) for key in keys])
+
+
+def wait_for_keys(keys, deadline):
+    """Wait for keys filled by other workers until deadline (monotonic time)
+
+    Leases are polled with values, waiting is stopped as soon as all keys
+    are filled or lease of a key is released without filling it (e.g. the
+    filler failed), so the caller can take over.
+    Returns {key: value} for filled keys
+    """
+    result = {}
+    pending = list(keys)
+    while pending and monotonic() < deadline:
+        sleep(settings.CACHE_LEASE_POLL)
+        # leases are read first: filler stores values before releasing leases,
+        # so key without value and lease isn't being filled
+        values = memcache.get_many([lease_key(key) for key in pending] + pending)
+        result.update((key, values[key]) for key in pending if key in values)
+        pending = [key for key in pending if key not in result]
+        if any(lease_key(key) not in values for key in pending):
+            break
+    return result
+
+
+def fill_missed(keys, fill):
+    """Fill keys missed in cache, every key is filled by a single worker
+
+    fill(keys) fetches and caches values of keys leased by the caller.
+    Keys leased by other workers are waited for, lease released without
+    filling the key is taken over by one of waiting workers. Keys which
+    aren't filled in settings.CACHE_LEASE_WAIT seconds are filled by the caller.
+    Returns {key: cached value} for keys filled by other workers
+    """
+    cached = {}
+    pending = set(keys)
+    deadline = monotonic() + settings.CACHE_LEASE_WAIT
+    while pending:
+        leased = acquire_leases(pending)
+        if leased:
+            try:
+                fill(leased)
+            finally:
+                release_leases(leased)
+            pending -= leased
+        if not pending:
+            break
+        if monotonic() >= deadline:
+            log.warning('%s keys are not filled in time', len(pending))
+            fill(pending)
+            break
+        cached.update(wait_for_keys(pending, deadline))
+        pending -= cached.keys()
+    return cached
+
+
 def log_time(func):
     def wrapper(*args, **kwargs):
         start = perf_counter()
@@ -43,7 +278,135 @@ def log_time(func):
     return wrapper
 
 
-def memcached(timeout=MEMCACHE_LIFETIME, list_field=None):
+def is_stale(data):
+    """Last known good data served during upstream outage"""
+    return isinstance(data, dict) and data.get('stale', False)
+
+
+class LocalCache:
+    """Bounded in-process LRU cache with TTL, shared by threads
+
+    Values are copied on get and set, callers can't change cached values.
+    Values aren't copied if copy is False, they must not be changed by callers.
+    """
+    def __init__(self, size, lifetime, copy=True):
+        self.size = size
+        self.lifetime = lifetime
+        self.copy = copy
+        self._lock = threading.Lock()
+        # key -> (expires_at, value), least recently used first
+        self._data = OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+
+    def get_many(self, keys):
+        """Returns {key: value} for keys found in cache"""
+        result = {}
+        if not self.size:
+            return result
+        now = monotonic()
+        with self._lock:
+            for key in keys:
+                item = self._data.get(key)
+                if item is None or item[0] < now:
+                    self.misses += 1
+                    continue
+                self._data.move_to_end(key)
+                self.hits += 1
+                result[key] = item[1]
+        return copy.deepcopy(result) if self.copy else result
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def set_many(self, values, expire):
+        if not self.size:
+            return
+        expires_at = monotonic() + min(expire, self.lifetime)
+        if self.copy:
+            values = copy.deepcopy(values)
+        with self._lock:
+            for key, value in values.items():
+                self._data[key] = (expires_at, value)
+                self._data.move_to_end(key)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def set(self, key, value, expire):
+        self.set_many({key: value}, expire)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self._data),
+        }
+
+
+# L1 cache of memcached() in front of memcache, per process
+local_cache = LocalCache(settings.MEMCACHE_L1_SIZE, settings.MEMCACHE_L1_LIFETIME)
+
+
+# background refreshes of stale values
+_refresher = ThreadPoolExecutor(settings.CACHE_REFRESH_WORKERS, thread_name_prefix='refresh')
+
+
+def revalidate(keys, refresh):
+    """Call refresh(keys) in background, keys are refreshed by a single worker
+
+    Upstream calls of the refresh have background priority, so they wait
+    for interactive calls.
+    """
+    # upstream module uses memcache of this module
+    from .upstream import background
+
+    leased = acquire_leases(keys)
+    if not leased:
+        return
+
+    def run():
+        try:
+            with background():
+                refresh(leased)
+        except Exception:
+            log.exception('Refresh of %s failed', ', '.join(sorted(leased)))
+        finally:
+            release_leases(leased)
+
+    _refresher.submit(contextvars.copy_context().run, run)
+
+
+# cached None result of memcached() function
+NOT_FOUND = '<not found>'
+
+
+def memcached(timeout=MEMCACHE_LIFETIME, list_field=None, local=True, hard_timeout=None,
+              negative_timeout=None):
+    """Cache results in memcache and in local_cache if local is True
+
+    Values are fresh for timeout seconds. If hard_timeout is set, values are
+    kept up to hard_timeout seconds, value which isn't fresh is returned
+    at once and is refreshed in background (stale-while-revalidate).
+    If negative_timeout is set, None results are cached for negative_timeout
+    seconds, exceptions aren't cached.
+    """
+    def pack(value):
+        if hard_timeout:
+            return {'fresh_until': time() + timeout, 'value': value}
+        return value
+
+    def unpack(cached):
+        """Returns (value, seconds to stay fresh)"""
+        if hard_timeout:
+            return cached['value'], cached['fresh_until'] - time()
+        return cached, timeout
+
     def memcache_decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
@@ -56,25 +419,87 @@ def memcached(timeout=MEMCACHE_LIFETIME, list_field=None):
                     f'{key}/{sub_key}': sub_key
                     for sub_key in kwargs[list_field]
                 }
-                data = memcache.get_many(keys)
+                data = local_cache.get_many(keys) if local else {}
+                expired = set()
+                if keys.keys() - data.keys():
+                    shared = memcache.get_many(list(keys.keys() - data.keys()))
+                    for k, cached in shared.items():
+                        data[k], fresh_for = unpack(cached)
+                        if fresh_for <= 0:
+                            expired.add(k)
+                        elif local:
+                            local_cache.set(k, data[k], fresh_for)
+
+                def fill(missed_keys):
+                    new_data = func(*args, **dict(kwargs, **{
+                        list_field: list(keys[i] for i in missed_keys)}))
+                    fresh = {
+                        f'{key}/{k}': v for k, v in new_data.items() if not is_stale(v)
+                    }
+                    memcache.set_many(
+                        {k: pack(v) for k, v in fresh.items()}, expire=hard_timeout or timeout)
+                    if local:
+                        local_cache.set_many(fresh, timeout)
+                    return new_data
+
+                if expired:
+                    revalidate(expired, fill)
                 missed_keys = keys.keys() - data.keys()
                 data = {keys[k]: v for k, v in data.items()}
                 if missed_keys:
-                    kwargs[list_field] = list(keys[i] for i in missed_keys)
-                    new_data = func(*args, **kwargs)
-                    memcache.set_many({f'{key}/{k}': v for k, v in new_data.items()},
-                                      expire=timeout)
-                    data.update(new_data)
+                    # every key is filled by a single worker
+                    filled = {
+                        k: unpack(v)[0] for k, v in
+                        fill_missed(missed_keys, lambda i: data.update(fill(i))).items()
+                    }
+                    if local and filled:
+                        local_cache.set_many(filled, timeout)
+                    data.update({keys[k]: v for k, v in filled.items()})
                 return data
             elif list_field:
                 # result doesn't contains keys to get from memcache
                 return func(*args, **kwargs)
             else:
-                data = memcache.get(key)
-                if data:
+                def fill(_=None):
+                    data = func(*args, **kwargs)
+                    if data is None and negative_timeout:
+                        memcache.set(key, value=NOT_FOUND, expire=negative_timeout)
+                        if local:
+                            local_cache.set(key, NOT_FOUND, negative_timeout)
+                    elif not is_stale(data):
+                        memcache.set(key, value=pack(data), expire=hard_timeout or timeout)
+                        if local:
+                            local_cache.set(key, data, timeout)
+                    return data
+
+                if local:
+                    data = local_cache.get(key)
+                    if data == NOT_FOUND:
+                        return None
+                    if data:
+                        return data
+                cached = memcache.get(key)
+                if cached == NOT_FOUND:
+                    if local:
+                        local_cache.set(key, NOT_FOUND, negative_timeout)
+                    return None
+                if cached:
+                    data, fresh_for = unpack(cached)
+                    if fresh_for <= 0:
+                        revalidate([key], fill)
+                    elif local:
+                        local_cache.set(key, data, fresh_for)
                     return data
-                data = func(*args, **kwargs)
-                memcache.set(key, value=data, expire=timeout)
+                result = []
+                # key is filled by a single worker
+                cached = fill_missed([key], lambda _: result.append(fill())).get(key)
+                if result:
+                    return result[0]
+                if cached == NOT_FOUND:
+                    return None
+                data = unpack(cached)[0]
+                if local:
+                    local_cache.set(key, data, timeout)
                 return data
         return wrapper
     return memcache_decorator
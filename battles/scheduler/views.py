@@ -1,74 +1,421 @@
+import hashlib
+from datetime import datetime, time, timedelta
+import pytz
+
 from django.views import View
-from django.http import JsonResponse, StreamingHttpResponse, Http404
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse, Http404
 from django.db.models import Q
-from django.db import IntegrityError
-from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils import timezone
 from django.conf import settings
 
-from datetime import datetime, timedelta
-
-from .models import Clan, Schedule
-from .wgconnect import get_clan_data, get_clans_tags, WGClanBattles
+from .encoding import dumps
+from .models import Clan, Schedule, ClanInvolvement
+from .push import event_stream
+from .tags import is_valid_tag, known_tags
+from .upstream import background, RateLimited, UPSTREAM_ERRORS
+from .util import get_today, get_battle_date, get_prime_hour, get_timetable_versions, \
+    get_cached_timetables, cache_timetables, invalidate_timetables, acquire_lock, \
+    TIMETABLE_FULL, TIMETABLE_COMPACT
+from .wgconnect import get_clan_data, get_clans_tags, get_clans_related_provinces, \
+    WGClanBattles, ProvinceLoader
+from .writer import write_provinces
+
+
+def parse_window_bound(value):
+    """Returns date or aware datetime, naive datetimes are UTC"""
+    if value is None:
+        return None
+    # date is a battle date, same as Schedule.date
+    date = parse_date(value)
+    if date is not None:
+        return date
+    dt = parse_datetime(value)
+    if dt is None:
+        raise ValueError(f'{value} is not ISO date or datetime')
+    if timezone.is_naive(dt):
+        dt = dt.replace(tzinfo=pytz.UTC)
+    return dt
+
+
+def get_schedules_filter(params, realm=None):
+    """Q with battles window and status filters from query parameters
+
+    from, to - battles start window, ISO datetime or battle date (inclusive)
+    hours - window from now, e.g. hours=6 for battles of next 6 hours,
+        at most settings.MAX_WINDOW_HOURS
+    status - comma separated statuses, e.g. status=STARTED
+    Raises ValueError on invalid parameters, OverflowError on out of range dates
+    """
+    query = Q()
+    start = parse_window_bound(params.get('from'))
+    end = parse_window_bound(params.get('to'))
+    if 'hours' in params:
+        hours = float(params['hours'])
+        # inf and nan are rejected too
+        if not 0 < hours <= settings.MAX_WINDOW_HOURS:
+            raise ValueError(f'hours should be from 0 to {settings.MAX_WINDOW_HOURS}')
+        end = timezone.now() + timedelta(hours=hours)
+
+    # datetime bounds are also converted to date bounds,
+    # so (date, status) index is used
+    if isinstance(start, datetime):
+        query &= Q(date__gte=get_battle_date(start, realm), battles_start_at__gte=start)
+    elif start is not None:
+        query &= Q(date__gte=start)
+    if isinstance(end, datetime):
+        query &= Q(date__lte=get_battle_date(end, realm), battles_start_at__lt=end)
+    elif end is not None:
+        query &= Q(date__lte=end)
+
+    if 'status' in params:
+        statuses = set(params['status'].split(','))
+        known = {i for i, _ in Schedule._meta.get_field('status').choices}
+        if statuses - known:
+            raise ValueError(f'Unknown status {", ".join(sorted(statuses - known))}')
+        query &= Q(status__in=statuses)
+    return query
+
+
+def active_clan_schedules(clan, date, filters=Q()):
+    # clan is owner, pretender of not started province or
+    # participant of current round battle
+    involved = Q(involvements__clan=clan) & (
+        Q(involvements__role=ClanInvolvement.OWNER) |
+        Q(round_number__isnull=True) |
+        Q(involvements__current_round=True)
+    )
+    return Schedule.objects. \
+        distinct('province_id'). \
+        filter(date__gte=date). \
+        exclude(status='FINISHED'). \
+        filter(filters). \
+        filter(involved)
 
 
-def get_today():
-    dt = datetime.now()
-    if dt.hour < settings.PRIME_STARTS_AT_HOUR:
-        dt = dt - timedelta(days=1)
-    return dt.date()
+def get_active_clan_schedules_by_date(clan, date, filters=Q()):
+    # pretenders and battles are prefetched, so
+    # Schedule.get_battle_times() doesn't hit DB for every schedule
+    return list(active_clan_schedules(clan, date, filters).with_timetable_data())
 
 
-def get_battle_date(battle_dt):
-    return (battle_dt - timedelta(hours=settings.PRIME_STARTS_AT_HOUR)).date()
+def get_active_clans_schedules_by_date(clans, date):
+    """Same as get_active_clan_schedules_by_date() for list of clans
 
+    Schedules shared by several clans are loaded only once.
+    Returns dict {clan_id: [schedule, ...]}
+    """
+    involvements = ClanInvolvement.objects. \
+        filter(clan__in=clans, schedule__date__gte=date). \
+        exclude(schedule__status='FINISHED'). \
+        filter(
+            Q(role=ClanInvolvement.OWNER) |
+            Q(schedule__round_number__isnull=True) |
+            Q(current_round=True)
+        ).values_list('clan_id', 'schedule_id')
+    involvements = list(involvements)
+
+    schedules = Schedule.objects.with_timetable_data().in_bulk(
+        {schedule_id for _, schedule_id in involvements})
+
+    # one schedule for the province per clan
+    result = {clan.id: {} for clan in clans}
+    for clan_id, schedule_id in involvements:
+        schedule = schedules[schedule_id]
+        result[clan_id].setdefault(schedule.province_id, schedule)
+    return {clan_id: list(i.values()) for clan_id, i in result.items()}
+
+
+COMPACT_CONTENT_TYPE = 'application/vnd.battles.compact+json'
+
+
+def get_clan_provinces(clan, schedules):
+    """Returns [(schedule, battle_times), ...] for provinces shown to clan"""
+    provinces_data = {}
+    for schedule in set(schedules):
+        province_id = schedule.province_id
+        battles = schedule.get_battle_times(clan)
 
-class MyDjangoJSONEncoder(DjangoJSONEncoder):
-    def default(self, o):
-        if hasattr(o, 'to_json'):
-            return o.to_json()
-        return super().default(o)
+        # if no active/planned battles for province - skip it
+        # clan is owner of the province
+        if not battles:
+            continue
+
+        # if clan not in attackers/competitors/owner, skip the province
+        if not schedule.is_involved(clan):
+            continue
+
+        provinces_data[province_id] = (schedule, battles)
+    return list(provinces_data.values())
+
+
+def get_clan_timetable(clan, schedules):
+    # fill data to send to client
+    return {
+        'clan': {'clan_id': clan.id, 'tag': clan.tag},
+        'provinces': [battles for _, battles in get_clan_provinces(clan, schedules)],
+    }
+
+
+def get_compact_clan_timetable(clan, schedules):
+    """Clan timetable in columnar format
+
+    Clans are sent once in 'clans' {clan_id: tag} dict, rounds are parallel
+    lists with clan ids, round time in minutes and battle start in seconds
+    from province's prime time ('prime_at').
+    """
+    clans = {clan.id: clan.tag}
+    provinces = []
+    for schedule, battles in get_clan_provinces(clan, schedules):
+        prime_at = schedule.prime_datetime
+        rounds = battles.pop('rounds')
+        if schedule.owner:
+            clans[schedule.owner.id] = schedule.owner.tag
+        for round_data in rounds:
+            for i in (round_data['clan_a'], round_data['clan_b']):
+                if i is not None:
+                    clans[i.id] = i.tag
+
+        battles['prime_at'] = prime_at
+        battles['rounds'] = {
+            'title': [i['title'] for i in rounds],
+            'clan_a': [i['clan_a'] and i['clan_a'].id for i in rounds],
+            'clan_b': [i['clan_b'] and i['clan_b'].id for i in rounds],
+            'time': [int((i['time'] - prime_at).total_seconds()) // 60 for i in rounds],
+            'start_at': [
+                i['start_at'] and int((i['start_at'] - prime_at).total_seconds())
+                for i in rounds
+            ],
+        }
+        provinces.append(battles)
+
+    return {
+        'format': TIMETABLE_COMPACT,
+        'clan': {'clan_id': clan.id, 'tag': clan.tag},
+        'clans': clans,
+        'provinces': provinces,
+    }
+
+
+TIMETABLE_BUILDERS = {
+    TIMETABLE_FULL: get_clan_timetable,
+    TIMETABLE_COMPACT: get_compact_clan_timetable,
+}
+
+
+def get_timetable_format(request):
+    """Compact format is selected by ?format=compact or Accept header"""
+    if request.GET.get('format') == TIMETABLE_COMPACT or \
+            COMPACT_CONTENT_TYPE in request.META.get('HTTP_ACCEPT', ''):
+        return TIMETABLE_COMPACT
+    return TIMETABLE_FULL
+
+
+def make_timetable(clan, schedules, fmt=TIMETABLE_FULL):
+    """Serialized clan timetable to store in cache"""
+    return dumps(TIMETABLE_BUILDERS[fmt](clan, schedules))
+
+
+def timetable_etag(version, date, fmt):
+    return f'"{version["id"]}/{date}/{fmt}"'
+
+
+def timetable_last_modified(versions, realm, date):
+    """Last-Modified of timetables, it never goes backwards
+
+    Timetables are changed on updates of their versions and on start
+    of the new battle day, when schedules of the previous day are left.
+    """
+    day_start = datetime.combine(date, time(get_prime_hour(realm)), tzinfo=pytz.UTC)
+    return max([int(day_start.timestamp())] + [i['modified'] for i in versions.values()])
+
+
+def timetables_stale(versions):
+    """True if some timetable couldn't be refreshed from WG API"""
+    return any(version.get('stale') for version in versions.values())
+
+
+def get_timetable(clan, date, fmt=TIMETABLE_FULL):
+    """Clan timetable validators and function returning its body
+
+    Returns (etag, last_modified, stale, get_body). Validators are made of the
+    timetable version, so body isn't built if client has the actual version.
+    Body is taken from cache, built and cached if missing.
+    """
+    # version is read before schedules, so timetable of outdated data isn't cached
+    versions = get_timetable_versions(clan.realm, [clan.id])
+
+    def get_body():
+        body = get_cached_timetables(clan.realm, versions, date, fmt).get(clan.id)
+        if body is None:
+            # get clan involved provinces for today
+            today_schedule = get_active_clan_schedules_by_date(clan, date)
+            body = make_timetable(clan, today_schedule, fmt)
+            cache_timetables(clan.realm, {clan.id: body}, versions, date, fmt)
+        return body
+
+    return (
+        timetable_etag(versions[clan.id], date, fmt),
+        timetable_last_modified(versions, clan.realm, date),
+        timetables_stale(versions),
+        get_body,
+    )
+
+
+def get_filtered_timetable(clan, date, filters, fmt=TIMETABLE_FULL):
+    """Same as get_timetable() for timetable of filtered schedules
+
+    Filtered timetables aren't cached. Window of schedules can be moved
+    by time (e.g. hours=6), so ETag includes ids of filtered schedules
+    and there is no Last-Modified.
+    """
+    versions = get_timetable_versions(clan.realm, [clan.id])
+    schedule_ids = sorted(
+        active_clan_schedules(clan, date, filters).values_list('id', flat=True))
+    etag = '"%s"' % hashlib.md5('{}/{}'.format(
+        timetable_etag(versions[clan.id], date, fmt), schedule_ids).encode()).hexdigest()
+    return etag, None, timetables_stale(versions), lambda: make_timetable(
+        clan, get_active_clan_schedules_by_date(clan, date, filters), fmt)
+
+
+def get_province_timetable(realm, front_id, province_id, date):
+    schedule = Schedule.objects. \
+        with_timetable_data(). \
+        filter(realm=realm, front_id=front_id, province_id=province_id, date__gte=date). \
+        order_by('date'). \
+        first()
+    if schedule is None:
+        return None
+    return {
+        'front_id': schedule.front_id,
+        'province_id': schedule.province_id,
+        'province_name': schedule.province_name,
+        'arena_name': schedule.arena_name,
+        'server': schedule.server,
+        'prime_time': schedule.prime_time,
+        'status': schedule.status,
+        'round_number': schedule.round_number,
+        'owner': schedule.owner,
+        'pretenders': list(schedule.pretenders.all()),
+        'battles': [{
+            'clan_a': battle.clan_a,
+            'clan_b': battle.clan_b,
+            'round': battle.round,
+            'start_at': battle.start_at,
+        } for battle in sorted(schedule.battles.all(), key=lambda i: (i.round, i.id))],
+    }
+
+
+def refresh_provinces(realm, provinces_ids):
+    """Update provinces of the realm from WG API
+
+    Every province is refreshed only by one worker once in settings.PUSH_INTERVAL
+    no matter how many clients are subscribed to it.
+    """
+    provinces_ids = [
+        (front_id, province_id) for front_id, province_id in provinces_ids
+        if acquire_lock(f'refresh/{realm}/{front_id}/{province_id}', settings.PUSH_INTERVAL)
+    ]
+    if provinces_ids:
+        write_provinces(ProvinceLoader(realm).fetch_many(provinces_ids), realm)
+
+
+def conditional_response(request, etag, last_modified, get_body, stale=False):
+    """Response with ETag/Last-Modified headers
+
+    Returns 304 response without calling get_body() if client has actual version.
+    Stale response (its data couldn't be refreshed from WG API) has Warning header.
+    """
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = HttpResponse(get_body(), content_type='application/json')
+    response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified)
+    # clients must revalidate timetable on every request
+    patch_cache_control(response, no_cache=True)
+    if stale:
+        response['Warning'] = '110 - "Response is Stale"'
+    # format can be selected by Accept header
+    patch_vary_headers(response, ['Accept'])
+    response['Access-Control-Allow-Origin'] = '*'
+    return response
+
+
+def get_realm(kwargs):
+    """Realm of URL, URLs without realm prefix are of the default realm"""
+    realm = kwargs.get('realm', settings.DEFAULT_REALM)
+    if realm not in settings.REALMS or realm not in settings.SERVED_REALMS:
+        raise Http404("Realm is not served")
+    return realm
+
+
+def invalidate_clans_timetables(realm, clan_ids):
+    """Invalidate timetables showing clans, e.g. after change of their tags
+
+    Tags are shown in timetables of clans sharing schedules with them.
+    """
+    invalidate_timetables(realm, set(clan_ids) | set(ClanInvolvement.objects.filter(
+        schedule__involvements__clan_id__in=clan_ids,
+    ).values_list('clan_id', flat=True)))
+
+
+def fetch_clan(realm, clan_tag):
+    """Find clan missing in DB in WG API, returns None if clan doesn't exist
+
+    Raises UPSTREAM_ERRORS if WG API is unavailable
+    """
+    # malformed tags aren't looked up
+    if not is_valid_tag(clan_tag):
+        return None
+    clan_data = get_clan_data(realm, clan_tag)
+    if clan_data:
+        # clan can be in DB already: saved by other process or renamed
+        clan, created = Clan.objects.get_or_create(
+            id=clan_data['clan_id'],
+            defaults={'realm': realm, 'tag': clan_data['tag']})
+        if not created and (clan.realm, clan.tag) != (realm, clan_data['tag']):
+            clan.realm, clan.tag = realm, clan_data['tag']
+            clan.save(update_fields=['realm', 'tag'])
+            invalidate_clans_timetables(realm, [clan.id])
+        return clan
+
+
+def find_clan(realm, clan_tag):
+    """Find clan in DB or in WG API, returns None if clan doesn't exist"""
+    # DB isn't queried for tags which are not in DB for sure
+    if is_valid_tag(clan_tag) and known_tags.might_exist(realm, clan_tag):
+        try:
+            return Clan.objects.get(realm=realm, tag=clan_tag)
+        except Clan.DoesNotExist:
+            pass
+    return fetch_clan(realm, clan_tag)
 
 
-def get_active_clan_schedules_by_date(clan, date):
-    schedules = Schedule.objects. \
-        distinct('province_id'). \
-        prefetch_related('pretenders').filter(
-            date__gte=date). \
-        exclude(status='FINISHED'). \
-        filter(
-            Q(owner=clan) |
-            Q(pretenders=clan) |
-            Q(battles__clan_a=clan) |
-            Q(battles__clan_b=clan)
-        )
-
-    result = []
-    for schedule in schedules:
-        if schedule.round_number is None:
-            result.append(schedule)
-        elif schedule.owner == clan:
-            result.append(schedule)
-        elif any((clan == i.clan_a or clan == i.clan_b)
-                 for i in schedule.battles.filter(round=schedule.round_number)):
-            result.append(schedule)
-    return list(set(result))
+def upstream_error_response(error):
+    response = JsonResponse({'error': f'WG API is unavailable: {error}'}, status=503)
+    if isinstance(error, RateLimited):
+        response['Retry-After'] = str(settings.UPSTREAM_RATE_LIMIT_WAIT)
+    return response
 
 
 class FetchClanDataView(View):
+    """Clan timetable
+
+    [/realm]/update/TAG[?from=...&to=...|hours=6][&status=STARTED][&format=compact]
+    """
     def get(self, request, *args, **kwargs):
-        clan_tag = kwargs['clan_tag'].upper()
+        realm = get_realm(kwargs)
         try:
-            clan = Clan.objects.get(tag=clan_tag)
-        except Clan.DoesNotExist:
-            clan_data = get_clan_data(clan_tag)
-            if clan_data:
-                clan = Clan.objects.update_or_create(
-                    id=clan_data['clan_id'], 
-                    defaults={'tag': clan_data['tag']})[0]
-            else:
-                raise Http404("Clan not found")
+            clan = find_clan(realm, kwargs['clan_tag'].upper())
+        except UPSTREAM_ERRORS as e:
+            return upstream_error_response(e)
+        if clan is None:
+            raise Http404("Clan not found")
 
-        today = get_today()
+        today = get_today(realm)
 
         # # list involved provinces
         # today_schedule = get_active_clan_schedules_by_date(clan, today)
@@ -81,119 +428,167 @@ class FetchClanDataView(View):
         # # update DB records for schedules and related provinces
         # self.update(clan.id, province_ida)
 
-        predicates = [
-            lambda schedule, clan: clan == schedule.owner,
-            lambda schedule, clan: clan in schedule.pretenders.all(),
-            lambda schedule, clan: schedule.battles.filter(
-                round=schedule.round_number).filter(Q(clan_a=clan) | Q(clan_b=clan)),
-        ]
-
-        # get clan involved provinces for today
-        today_schedule = get_active_clan_schedules_by_date(clan, today)
-
-        # fill data to send to client
-        provinces_data = {}
-        for schedule in set(today_schedule):
-            province_id = schedule.province_id
-            battles = schedule.get_battle_times(clan)
-
-            # if no active/planned battles for province - skip it
-            # clan is owner of the province
-            if not battles:
-                continue
-
-            # if clan not in attackers/competitors/owner, skip the province
-            if not any(predicate(schedule, clan) for predicate in predicates):
-                continue
-
-            provinces_data[province_id] = battles
-
-        response = JsonResponse({
-            'clan': {'clan_id': clan.id, 'tag': clan.tag},
-            'provinces': list(provinces_data.values()),
-        }, encoder=MyDjangoJSONEncoder)
-        response['Access-Control-Allow-Origin'] = '*'
-        return response
+        try:
+            filters = get_schedules_filter(request.GET, realm)
+        except (ValueError, OverflowError) as e:
+            return JsonResponse({'error': str(e)}, status=400)
+
+        fmt = get_timetable_format(request)
+        if filters:
+            etag, last_modified, stale, get_body = get_filtered_timetable(
+                clan, today, filters, fmt)
+        else:
+            etag, last_modified, stale, get_body = get_timetable(clan, today, fmt)
+        return conditional_response(request, etag, last_modified, get_body, stale)
 
     @staticmethod
-    def update_province(province_data):
-        pretenders = province_data['pretenders']
-        active_battles = province_data['active_battles']
-        battles_start_at = province_data['battles_start_at']
-        battle_date = get_battle_date(battles_start_at)
-        status = province_data['status']
-
-        print("Updating province " + province_data['province_id'])
-
-        owner_clan_id = province_data['owner_clan_id']
-        if owner_clan_id:
-            owner = Clan.objects.get_or_create(id=province_data['owner_clan_id'])[0]
-        else:
-            owner = None
-
-        # use this number only if battles have been started
-        # usually if contains irrelevant data before starting battles
-        round_number = province_data['round_number'] if status == "STARTED" else None
-
-        if not pretenders:
-            return
-
-        # update scheduled battle info
-        schedule = Schedule.objects.update_or_create(
-            front_id=province_data['front_id'],
-            province_id=province_data['province_id'],
-            date=battle_date,
-            defaults={
-                'province_name': province_data['province_name'],
-                'server': province_data['server'],
-                'arena_id': province_data['arena_id'],
-                'arena_name': province_data['arena_name'],
-                'prime_time': province_data['prime_time'],
-                'owner': owner,
-                'round_number': round_number,
-                'battles_start_at': province_data['battles_start_at'],
-            },
-        )[0]
-
-        print(f"Created schedule {schedule}")
+    def update_province(province_data, realm=None):
+        write_provinces([province_data], realm)
+
+    def update(self, clan_id, provinces_ids, realm=None):
+        provinces_data = WGClanBattles(
+            clan_id, provinces_ids, realm=realm).get_clan_related_provinces()
+        # --- Update provinces data in DB ---
+        write_provinces(provinces_data, realm)
+        return [p['province_id'] for p in provinces_data]
 
+
+class FetchClansDataView(View):
+    """Timetables for several clans at once
+
+    [/realm]/update_many/?tags=TAG1,TAG2&ids=1,2[&format=compact]
+    """
+    def get(self, request, *args, **kwargs):
+        realm = get_realm(kwargs)
+        tags = {i.upper() for i in request.GET.get('tags', '').split(',') if i}
         try:
-            schedule.pretenders.set(pretenders)
-        except IntegrityError:
-            existing = {i.id for i in Clan.objects.filter(id__in=pretenders)}
-            for clan_id in set(pretenders) - existing:
-                Clan.objects.create(id=clan_id)
-            schedule.pretenders.set(pretenders)
-
-        for battle in active_battles:
-            print(f"Create battle {battle}")
-            schedule.battles.update_or_create(
-                clan_a_id=battle['clan_a']['clan_id'],
-                clan_b_id=battle['clan_b']['clan_id'],
-                round=battle['round'],
-                defaults={'start_at': battle['start_at']},
+            ids = {int(i) for i in request.GET.get('ids', '').split(',') if i}
+        except ValueError:
+            return JsonResponse({'error': 'ids should be integers'}, status=400)
+        if len(tags) + len(ids) > settings.MAX_CLANS_PER_REQUEST:
+            return JsonResponse({
+                'error': f'Too many clans, max is {settings.MAX_CLANS_PER_REQUEST}'
+            }, status=400)
+
+        clans = {
+            clan.id: clan
+            for clan in Clan.objects.filter(Q(tag__in=tags) | Q(id__in=ids), realm=realm)
+        }
+        not_found = ids - clans.keys()
+
+        # lookup clans missing in DB in WG API
+        for clan_tag in tags - {clan.tag for clan in clans.values()}:
+            try:
+                clan = fetch_clan(realm, clan_tag)
+            except UPSTREAM_ERRORS as e:
+                return upstream_error_response(e)
+            if clan is None:
+                not_found.add(clan_tag)
+            else:
+                clans[clan.id] = clan
+
+        today = get_today(realm)
+        fmt = get_timetable_format(request)
+        # validators are made of versions, timetables are built only for the body
+        versions = get_timetable_versions(realm, clans.keys())
+        not_found = dumps(sorted(not_found, key=str))
+        etag = '"%s"' % hashlib.md5(''.join(
+            [timetable_etag(versions[clan_id], today, fmt) for clan_id in clans] + [not_found]
+        ).encode()).hexdigest()
+
+        def get_body():
+            timetables = get_cached_timetables(realm, versions, today, fmt)
+            missing = [clan for clan_id, clan in clans.items() if clan_id not in timetables]
+            if missing:
+                schedules = get_active_clans_schedules_by_date(missing, today)
+                new_timetables = {
+                    clan.id: make_timetable(clan, schedules[clan.id], fmt)
+                    for clan in missing
+                }
+                cache_timetables(realm, new_timetables, versions, today, fmt)
+                timetables.update(new_timetables)
+            # timetables are already serialized
+            return '{"clans":[%s],"not_found":%s}' % (
+                ','.join(timetables[clan_id] for clan_id in clans),
+                not_found,
             )
 
-    def update(self, clan_id, provinces_ids):
-        provinces_data = WGClanBattles(clan_id, provinces_ids).get_clan_related_provinces()
-        # --- Update provinces data in DB ---
-        for province_data in provinces_data:
-            self.update_province(province_data)
+        return conditional_response(
+            request, etag, timetable_last_modified(versions, realm, today), get_body,
+            timetables_stale(versions))
+
+    @staticmethod
+    def update(clan_ids, realm=None):
+        # provinces shared by clans are fetched from WG API only once
+        provinces_data = get_clans_related_provinces(clan_ids, realm)
+        write_provinces(provinces_data, realm)
         return [p['province_id'] for p in provinces_data]
 
 
+def event_stream_response(key, poll):
+    response = StreamingHttpResponse(event_stream(key, poll), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # disable buffering of proxied response in nginx
+    response['X-Accel-Buffering'] = 'no'
+    response['Access-Control-Allow-Origin'] = '*'
+    return response
+
+
+class ClanEventsView(View):
+    """Server-Sent Events with clan timetable sent on every change"""
+    def get(self, request, *args, **kwargs):
+        realm = get_realm(kwargs)
+        try:
+            clan = find_clan(realm, kwargs['clan_tag'].upper())
+        except UPSTREAM_ERRORS as e:
+            return upstream_error_response(e)
+        if clan is None:
+            raise Http404("Clan not found")
+
+        def poll():
+            refresh_provinces(realm, WGClanBattles(clan.id, realm=realm).list_involved_provinces())
+            etag, _, _, get_body = get_timetable(clan, get_today(realm))
+            return etag, get_body()
+
+        return event_stream_response(('clan', clan.id), poll)
+
+
+class ProvinceEventsView(View):
+    """Server-Sent Events with province battles sent on every change"""
+    def get(self, request, *args, **kwargs):
+        realm = get_realm(kwargs)
+        front_id, province_id = kwargs['front_id'], kwargs['province_id']
+
+        def poll():
+            refresh_provinces(realm, [(front_id, province_id)])
+            timetable = get_province_timetable(realm, front_id, province_id, get_today(realm))
+            payload = dumps(timetable)
+            return payload, payload
+
+        return event_stream_response(('province', realm, front_id, province_id), poll)
+
+
 class UpdateAllProvinces(View):
     @staticmethod
     def list_all():
         yield 'Updating all database'
-        no_tags = {str(i.id): i for i in Clan.objects.filter(tag='')}
-        total = len(no_tags)
-        for i in range(0, total, 100):
-            clans_req = list(no_tags.keys())[i:i+100]
-            for clan_id, clan_data in get_clans_tags(clans_req):
-                no_tags[clan_id].tag = clan_data['tag']
-                no_tags[clan_id].save()
-            yield 'Done %s/%s clans' % (i + 100, len(no_tags))
+        for realm in settings.SERVED_REALMS:
+            no_tags = {str(i.id): i for i in Clan.objects.filter(realm=realm, tag='')}
+            total = len(no_tags)
+            for i in range(0, total, 100):
+                clans_req = list(no_tags.keys())[i:i+100]
+                # backfill waits for interactive requests to WG API
+                try:
+                    with background():
+                        clans_tags = list(get_clans_tags(realm, clans_req))
+                except UPSTREAM_ERRORS as e:
+                    yield f'WG API is unavailable: {e}'
+                    return
+                for clan_id, clan_data in clans_tags:
+                    no_tags[clan_id].tag = clan_data['tag']
+                    no_tags[clan_id].save()
+                invalidate_clans_timetables(realm, [int(i) for i, _ in clans_tags])
+                yield 'Done %s/%s %s clans' % (i + 100, len(no_tags), realm)
         yield 'Done'
 
         # fronts = wot.globalmap.fronts()
@@ -1,132 +1,310 @@
-from datetime import datetime, time
-import pytz
+import threading
 
 from django.conf import settings
 
 import wargaming
 import logging
-import requests
-from requests.exceptions import RequestException
 
-from .util import memcached, log_time, memcache
+from .util import memcached, log_time, memcache, fill_missed, LocalCache, \
+    MEMCACHE_STALE_LIFETIME
+from .upstream import fan_out, papi
+from .records import parse_province, validate_papi_province, validate_tournament_info, \
+    validate_clan_battles, ValidationError
+from . import upstream
 
 
 log = logging.getLogger(__name__)
 
-wot = wargaming.WoT(settings.WARGAMING_API, 'ru', 'ru')
-wgn = wargaming.WGN(settings.WARGAMING_API, 'ru', 'ru')
+_clients = {}
+_clients_lock = threading.Lock()
 
 
-def convert_dt(date):
-    return datetime.strptime(date, '%Y-%m-%dT%H:%M:%S').replace(tzinfo=pytz.UTC)
+def get_clients(realm):
+    """(wot, wgn) PAPI clients of the realm, shared by all threads"""
+    with _clients_lock:
+        if realm not in _clients:
+            config = settings.REALMS[realm]
+            wot = wargaming.WoT(settings.WARGAMING_API, config['language'], config['region'])
+            wgn = wargaming.WGN(settings.WARGAMING_API, config['language'], config['region'])
+            if settings.WG_API_URL:
+                # all APIs are served by the stand-in
+                for api, prefix in ((wot, 'wot'), (wgn, 'wgn')):
+                    for module in api._module_dict:
+                        getattr(api, module).base_url = f'{settings.WG_API_URL}{prefix}/'
+            _clients[realm] = wot, wgn
+        return _clients[realm]
 
 
-def normalize_province_data(province):
-    # convert battles_start_at from str to datetime
-    province['battles_start_at'] = convert_dt(province['battles_start_at'])
-    province['prime_time'] = time(*map(int, province['prime_time'].split(':')))
+def get_game_api_url(realm):
+    if settings.WG_API_URL:
+        return f'{settings.WG_API_URL}game_api'
+    return settings.REALMS[realm]['game_api']
 
-    # convert str to datetime for active battles
-    for battle in province['active_battles']:
-        battle['start_at'] = convert_dt(battle['start_at'])
-    return province
 
+# only fields used by the scheduler are requested from PAPI
+CLAN_FIELDS = ['clan_id', 'tag']
+CLAN_PROVINCES_FIELDS = ['front_id', 'province_id']
+PROVINCE_FIELDS = [
+    'front_id', 'province_id', 'province_name', 'arena_id', 'arena_name',
+    'server', 'prime_time', 'battles_start_at', 'owner_clan_id', 'landing_type',
+    'round_number', 'status', 'attackers', 'competitors',
+    'active_battles.clan_a.clan_id', 'active_battles.clan_b.clan_id',
+    'active_battles.start_at', 'active_battles.round',
+]
 
-def normalize_provinces_data(provinces):
-    return [normalize_province_data(p)for p in provinces]
+
+# errors of malformed search value, other errors are WG API failures.
+# Codes can't be used: 407 is REQUEST_LIMIT_EXCEEDED too
+CLAN_SEARCH_ERRORS = {'INVALID_SEARCH', 'NOT_ENOUGH_SEARCH_LENGTH'}
 
 
 @log_time
-@memcached()
-def get_clan_data(clan_tag):
+@memcached(negative_timeout=settings.CLAN_NOT_FOUND_LIFETIME)
+def get_clan_data(realm, clan_tag):
+    """Returns None if clan is not found, upstream errors are raised"""
+    _, wgn = get_clients(realm)
     try:
-        clans = wgn.clans.list(search=clan_tag)
+        clans = papi(wgn.clans.list(search=clan_tag, fields=CLAN_FIELDS))
         for i in clans:
             if i['tag'] == clan_tag:
                 return i
     except wargaming.exceptions.RequestError as e:
+        if e.message not in CLAN_SEARCH_ERRORS:
+            raise
         log.error("Unable to find clan %s: %s", clan_tag, e.message)
 
 
 @log_time
-def get_clans_tags(clan_ids):
+def get_clans_tags(realm, clan_ids):
+    _, wgn = get_clients(realm)
     try:
-        return wgn.clans.info(clan_id=clan_ids, fields='tag').items()
+        return papi(wgn.clans.info(clan_id=clan_ids, fields='tag')).items()
     except wargaming.exceptions.RequestError as e:
         log.error(e.message)
     return {}
 
 
 @log_time
-@memcached()
-def game_api_tournament_info(province_id):
-    tournament_info_url = f'https://ru.wargaming.net/globalmap/game_api/' \
-                          f'tournament_info?alias={province_id}'
-    try:
-        data = requests.get(tournament_info_url)
-    except RequestException as e:
-        log.error('Unable to get data from %s: %s', tournament_info_url, e)
-        data = {
-            'battles': [],
-        }
-    else:
-        # TODO: add scheme validation
-        data = data.json()
+@memcached(hard_timeout=MEMCACHE_STALE_LIFETIME)
+def game_api_tournament_info(realm, province_id):
+    tournament_info_url = f'{get_game_api_url(realm)}/tournament_info?alias={province_id}'
+
+    def fetch():
+        response = upstream.get(tournament_info_url)
+        response.raise_for_status()
+        data = validate_tournament_info(response.json())
+        upstream.record_traffic(
+            'game_api/tournament_info', upstream.response_size(response), len(data['battles']))
+        return data
+
+    data, stale = upstream.guarded(
+        f'{realm}/game_api/tournament_info', f'tournament_info/{realm}/{province_id}', fetch)
+    if stale:
+        data['stale'] = True
     return data
 
 
 @log_time
-@memcached()
-def game_api_clan_battles(clan_id):
-    game_api_url = f'https://ru.wargaming.net/globalmap/game_api/clan/{clan_id}/battles'
-    try:
-        data = requests.get(game_api_url)
-    except RequestException as e:
-        log.error('Unable to get data from %s: %s', game_api_url, e)
-        data = {
-            'battles': [],
-            'planned_battles': []
-        }
-    else:
-        # TODO: add scheme validation
-        data = data.json()
+@memcached(hard_timeout=MEMCACHE_STALE_LIFETIME)
+def game_api_clan_battles(realm, clan_id):
+    game_api_url = f'{get_game_api_url(realm)}/clan/{clan_id}/battles'
+
+    def fetch():
+        response = upstream.get(game_api_url)
+        response.raise_for_status()
+        data = validate_clan_battles(response.json())
+        upstream.record_traffic('game_api/clan_battles', upstream.response_size(response),
+                                len(data['battles']) + len(data['planned_battles']))
+        return data
+
+    data, stale = upstream.guarded(
+        f'{realm}/game_api/clan_battles', f'clan_battles/{realm}/{clan_id}', fetch)
+    if stale:
+        data['stale'] = True
     return data
 
 
 @log_time
-@memcached()
-def wot_globalmap_clanprovinces(clan_id):
-    return wot.globalmap.clanprovinces(clan_id=clan_id)
+@memcached(hard_timeout=MEMCACHE_STALE_LIFETIME)
+def wot_globalmap_clanprovinces(realm, clan_id):
+    wot, _ = get_clients(realm)
+    data, _ = upstream.guarded(
+        f'{realm}/papi/globalmap/clanprovinces', f'clanprovinces/{realm}/{clan_id}',
+        lambda: papi(wot.globalmap.clanprovinces(
+            clan_id=clan_id, fields=CLAN_PROVINCES_FIELDS)))
+    return data
 
 
 @log_time
-@memcached(list_field='province_id')
-def wot_globalmap_provinces(front_id, province_id):
-    return {
-        i['province_id']: i
-        for i in wot.globalmap.provinces(front_id=front_id, province_id=province_id)
-    }
+@memcached(list_field='province_id', hard_timeout=MEMCACHE_STALE_LIFETIME)
+def wot_globalmap_provinces(realm, front_id, province_id):
+    wot, _ = get_clients(realm)
+
+    def fetch():
+        provinces = papi(wot.globalmap.provinces(
+            front_id=front_id, province_id=province_id, fields=PROVINCE_FIELDS))
+        data = {}
+        for province_data in provinces:
+            # malformed province is skipped, it isn't cached and isn't last known good
+            try:
+                validate_papi_province(province_data)
+            except ValidationError as e:
+                log.error('Invalid data of province on front %s: %s', front_id, e)
+                continue
+            data[province_data['province_id']] = province_data
+        if provinces and not data:
+            raise ValidationError(f'All provinces of front {front_id} are invalid')
+        return data
+
+    data, stale = upstream.guarded_many(
+        f'{realm}/papi/globalmap/provinces', f'provinces/{realm}/{front_id}', province_id, fetch)
+    if stale:
+        for province_data in data.values():
+            province_data['stale'] = True
+    return data
+
+
+# parsed provinces records shared by requests of the process, records aren't changed
+province_records = LocalCache(
+    settings.MEMCACHE_L1_SIZE, settings.MEMCACHE_L1_LIFETIME, copy=False)
+
+
+class ProvinceLoader:
+    """Batch loader of provinces data of the realm, scoped to a request
+
+    Provinces are collected by load() and fetched all together on first
+    access to data of any of them (or by dispatch()): one memcache multi-get
+    and one PAPI request per front for provinces missed in cache.
+    Only valid provinces data is cached, malformed provinces are skipped.
+    """
+    def __init__(self, realm=None):
+        self.realm = realm or settings.DEFAULT_REALM
+        self._lock = threading.RLock()
+        self._dispatch_lock = threading.Lock()
+        self._instances = {}
+        self._pending = []
+
+    def register(self, instance):
+        with self._lock:
+            self._instances.setdefault(instance.key, instance)
+            self._pending.append(instance)
+
+    def load(self, front_id, province_id):
+        with self._lock:
+            instance = self._instances.get(f'{self.realm}/{front_id}/{province_id}')
+            if instance is None:
+                instance = WGProvinceData(front_id, province_id, loader=self)
+            return instance
+
+    def load_many(self, provinces_ids):
+        return [self.load(front_id, province_id) for front_id, province_id in provinces_ids]
+
+    def fetch_many(self, provinces_ids):
+        """Load provinces and fetch their data at once
+
+        Provinces missing in WG API or with malformed data are skipped.
+        """
+        provinces = self.load_many(provinces_ids)
+        self.dispatch()
+        return [i for i in provinces if i._data is not None]
+
+    @staticmethod
+    def _parse(raw_data):
+        """Returns {key: Province} for valid provinces data, malformed data is skipped"""
+        records = {}
+        for key, province_data in raw_data.items():
+            if not province_data:
+                continue
+            try:
+                records[key] = parse_province(province_data)
+            except ValidationError as e:
+                log.error('Invalid data of province %s: %s', key, e)
+        province_records.set_many({
+            key: record for key, record in records.items() if not record.get('stale')
+        }, 300)
+        return records
+
+    def dispatch(self):
+        # concurrent callers wait for the batch being fetched
+        with self._dispatch_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+            instances = {}
+            for instance in pending:
+                if instance._data is None:
+                    instances.setdefault(instance.key, []).append(instance)
+            if not instances:
+                return
+            try:
+                provinces_data = self._fetch(instances)
+            except Exception:
+                # provinces are fetched again on the next access to their data
+                with self._lock:
+                    self._pending.extend(pending)
+                raise
+
+            # fill WGProvinceData instances with updated values
+            for key, province_data in provinces_data.items():
+                for instance in instances.get(key, []):
+                    instance.data = province_data
+
+    def _fetch(self, instances):
+        """Returns {key: Province} of instances {key: [WGProvinceData, ...]}"""
+        # provinces parsed by the process recently aren't parsed again
+        provinces_data = province_records.get_many(list(instances))
+        if instances.keys() - provinces_data.keys():
+            provinces_data.update(self._parse(
+                memcache.get_many(list(instances.keys() - provinces_data.keys()))))
+
+        def fill(keys):
+            grouped = {}
+            for key in keys:
+                grouped.setdefault(instances[key][0].front_id, []).append(
+                    instances[key][0].province_id)
+            new_data = WGProvinceData.fetch_provinces_data(self.realm, grouped)
+            records = self._parse(new_data)
+            # save valid data to memcache, stale data isn't cached
+            memcache.set_many({
+                key: new_data[key] for key, record in records.items()
+                if not record.get('stale')
+            }, 300)
+            provinces_data.update(records)
+
+        # provinces missed in cache are fetched by a single worker
+        missed = instances.keys() - provinces_data.keys()
+        if missed:
+            provinces_data.update(self._parse(fill_missed(missed, fill)))
+        return provinces_data
 
 
 class WGProvinceData:
-    """Class representing all cumulative data for the province from WG API/Game API"""
-    # [WGProvinceData, WGProvinceData, ...]
-    _need_update = []
+    """Class representing all cumulative data for the province from WG API/Game API
 
-    def __init__(self, front_id, province_id):
-        self.key = f'{front_id}/{province_id}'
+    Data is fetched by the loader in a batch with other provinces of the loader.
+    """
+    def __init__(self, front_id, province_id, loader=None):
+        self.loader = loader or ProvinceLoader()
+        self.realm = self.loader.realm
+        self.key = f'{self.realm}/{front_id}/{province_id}'
         self.front_id = front_id
         self.province_id = province_id
         self._data = None
+        self.loader.register(self)
 
     @staticmethod
-    def _fetch_api_provinces_data(grouped):
+    def _fetch_api_provinces_data(realm, grouped):
         """Get provinces data from WG Public API"""
         provinces_data = {}
-        for front_id, province_id in grouped.items():
-            raw_data = wot_globalmap_provinces(front_id=front_id, province_id=province_id)
+        # fronts are fetched concurrently
+        fronts_data = fan_out([
+            lambda front_id=front_id, province_id=province_id:
+                wot_globalmap_provinces(realm, front_id=front_id, province_id=province_id)
+            for front_id, province_id in grouped.items()
+        ])
+        for raw_data in fronts_data:
             for province_data in raw_data.values():
-                key = '{front_id}/{province_id}'.format(
+                key = '{realm}/{front_id}/{province_id}'.format(
+                    realm=realm,
                     front_id=province_data['front_id'],
                     province_id=province_data['province_id'])
                 provinces_data[key] = province_data
@@ -168,19 +346,13 @@ class WGProvinceData:
                     print("ERROR: more than 1 clan is skipping battles on this province!")
         return provinces_data
 
-    def _get_memcached(self):
-        self._data = memcache.get(self.key)
-        if not self._data:
-            self.__class__._need_update.append(self)
-        else:
-            self._data = normalize_province_data(self.data)
-
     @staticmethod
-    def _fetch_data_game_api(province_data):
+    def _fetch_data_game_api(realm, province_data, tournament_info=None):
         print(province_data)
         # reset data to avoid incorrect values
         province_data['active_battles'] = []
-        tournament_info = game_api_tournament_info(province_data['province_id'])
+        if tournament_info is None:
+            tournament_info = game_api_tournament_info(realm, province_data['province_id'])
         for battle in tournament_info['battles']:
             clan_a = {
                 'clan_id': battle['first_competitor']['id']
@@ -199,63 +371,48 @@ class WGProvinceData:
         province_data['round_number'] = tournament_info['round_number']
 
     @classmethod
-    def _update(cls):
-        grouped = {}
-        instances = {}
-
-        # group provinces by fronts
-        while True:
-            try:
-                # Avoiding possible race condition when 2 threads would tries
-                # to update same cache.
-                # pop() is atomic operation
-                instance = cls._need_update.pop()
-                front_id, province_id = instance.front_id, instance.province_id
-            except IndexError:
-                break
-            grouped.setdefault(front_id, []).append(province_id)
-            instances[f'{front_id}/{province_id}'] = instance
-        cls._need_update = []
+    def fetch_provinces_data(cls, realm, grouped):
+        """Fetch provinces data of the realm from PAPI and Game API
 
+        :param grouped: {front_id: [province_id, ...]}
+        Returns {'realm/front_id/province_id': province_data}
+        """
         # fetch data from PAPI
-        provinces_data = cls._fetch_api_provinces_data(grouped)
+        provinces_data = cls._fetch_api_provinces_data(realm, grouped)
 
         # validate data
+        need_game_api = []
         for province_data in provinces_data.values():
             active_battles = province_data['active_battles']
             owner_id = province_data['owner_clan_id']
 
             # check if there is only one battle with owner
-            if all([
-                owner_id is not None,
-                len(active_battles) == 1,
-                owner_id in [
-                    active_battles[0]['clan_a']['clan_id'],
-                    active_battles[0]['clan_b']['clan_id'],
-                    ]
-                ]):
-                    continue
+            if owner_id is not None and len(active_battles) == 1 and owner_id in [
+                active_battles[0]['clan_a']['clan_id'],
+                active_battles[0]['clan_b']['clan_id'],
+            ]:
+                continue
 
             if province_data['status'] == 'STARTED' and province_data['pretenders'] == []:
                 # If no attackers clans in PAPI response then it is impossible to
                 # detect if clan has no opponent because there is no such option in PAPI.
                 # Using Unofficial WG API to get required data
-                cls._fetch_data_game_api(province_data)
-
-        # save it to memcache
-        memcache.set_many(provinces_data, 300)
-
-        # fill WGProvinceData instances with updated values
-        for key, province_data in provinces_data.items():
-            instances[key].data = normalize_province_data(province_data)
+                need_game_api.append(province_data)
+
+        # tournament info of provinces is fetched concurrently
+        tournaments_info = fan_out([
+            lambda province_id=province_data['province_id']:
+                game_api_tournament_info(realm, province_id)
+            for province_data in need_game_api
+        ])
+        for province_data, tournament_info in zip(need_game_api, tournaments_info):
+            cls._fetch_data_game_api(realm, province_data, tournament_info)
+        return provinces_data
 
     @property
     def data(self):
-        if self._data:
-            return self._data
-        self._get_memcached()
-        if not self._data:
-            self._update()
+        if self._data is None:
+            self.loader.dispatch()
         return self._data
 
     @data.setter
@@ -265,11 +422,18 @@ class WGProvinceData:
     def __getitem__(self, item):
         return self.data[item]
 
-    # to make set(provinces_list) working correctly
+    def get(self, item, default=None):
+        return self.data.get(item, default)
+
+    # to make set(provinces_list) working correctly,
+    # data isn't fetched for comparison
     def __eq__(self, other):
         if isinstance(other, self.__class__):
             return self.key == other.key
-        return self.data == other
+        return self._data == other
+
+    def __hash__(self):
+        return hash(self.key)
 
 
 class WGClanBattles:
@@ -281,8 +445,9 @@ class WGClanBattles:
     Clan may be found only in GameAPI if it doesn't have opposite clan
     - game_api['planned_battles']['clan']
     """
-    def __init__(self, clan_id, provinces_ids=None):
+    def __init__(self, clan_id, provinces_ids=None, realm=None):
         self.clan_id = clan_id
+        self.realm = realm or settings.DEFAULT_REALM
         self._game_api_clan_battles = None
         self._wg_papi_provinces = None
         self._wg_papi_clan_provinces = None
@@ -291,7 +456,7 @@ class WGClanBattles:
     @property
     def game_api_clan_battles(self):
         if self._game_api_clan_battles is None:
-            self._game_api_clan_battles = game_api_clan_battles(self.clan_id)
+            self._game_api_clan_battles = game_api_clan_battles(self.realm, self.clan_id)
         return self._game_api_clan_battles
 
     @property
@@ -299,10 +464,17 @@ class WGClanBattles:
         """wot.globalmap.clanprovinces"""
         if self._wg_papi_clan_provinces is None:
             self._wg_papi_clan_provinces = \
-                wot_globalmap_clanprovinces(self.clan_id)
+                wot_globalmap_clanprovinces(self.realm, self.clan_id)
         return self._wg_papi_clan_provinces[str(self.clan_id)] or []
 
     def list_involved_provinces(self):
+        if self._game_api_clan_battles is None and self._wg_papi_clan_provinces is None:
+            # both APIs are requested concurrently
+            self._game_api_clan_battles, self._wg_papi_clan_provinces = fan_out([
+                lambda: game_api_clan_battles(self.realm, self.clan_id),
+                lambda: wot_globalmap_clanprovinces(self.realm, self.clan_id),
+            ])
+
         # planned battles from unofficial api and WG_PAPI
         all_battles = self.game_api_clan_battles['battles'] + \
             self.game_api_clan_battles['planned_battles'] + \
@@ -314,8 +486,17 @@ class WGClanBattles:
             list(self.provinces_ids)
         )
 
-    def get_clan_related_provinces(self):
-        provinces = []
-        for front_id, province_id in self.list_involved_provinces():
-            provinces.append(WGProvinceData(front_id, province_id))
-        return provinces
+    def get_clan_related_provinces(self, loader=None):
+        loader = loader or ProvinceLoader(self.realm)
+        return loader.fetch_many(self.list_involved_provinces())
+
+
+def get_clans_related_provinces(clan_ids, realm=None):
+    """Collect provinces for several clans of the realm, every province is fetched once"""
+    provinces_ids = set()
+    for clan_provinces in fan_out([
+        lambda clan_id=clan_id: WGClanBattles(clan_id, realm=realm).list_involved_provinces()
+        for clan_id in clan_ids
+    ]):
+        provinces_ids.update(clan_provinces)
+    return ProvinceLoader(realm).fetch_many(provinces_ids)
@@ -0,0 +1,221 @@
+"""Set-based writer of provinces data from WG API into DB
+
+All provinces of the batch are written with a handful of
+INSERT ... ON CONFLICT statements in a single transaction,
+so concurrent refreshes of the same province can't duplicate rows.
+"""
+import logging
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from .models import Clan, Schedule, ProvinceBattles, ClanInvolvement
+from .util import get_battle_date, invalidate_timetables, mark_timetables_stale
+
+
+log = logging.getLogger(__name__)
+
+CLAN_TABLE = Clan._meta.db_table
+SCHEDULE_TABLE = Schedule._meta.db_table
+PRETENDERS_TABLE = Schedule.pretenders.through._meta.db_table
+BATTLES_TABLE = ProvinceBattles._meta.db_table
+
+
+def _upsert_clans(cursor, realm, clan_ids):
+    # tags are filled later by UpdateAllProvinces
+    cursor.execute(f'''
+        INSERT INTO {CLAN_TABLE} (id, realm, tag)
+        SELECT unnest(%s::integer[]), %s, ''
+        ON CONFLICT (id) DO NOTHING
+    ''', [sorted(clan_ids), realm])
+
+
+def _upsert_schedules(cursor, schedules):
+    """Returns ({(front_id, province_id, date): schedule_id}, ids of new or changed schedules)
+
+    schedules are of the same realm
+    """
+    columns = [
+        ('realm', 'varchar'),
+        ('front_id', 'varchar'),
+        ('front_name', 'varchar'),
+        ('province_id', 'varchar'),
+        ('province_name', 'varchar'),
+        ('arena_id', 'varchar'),
+        ('arena_name', 'varchar'),
+        ('server', 'varchar'),
+        ('date', 'date'),
+        ('prime_time', 'time'),
+        ('battles_start_at', 'timestamptz'),
+        ('owner_id', 'integer'),
+        ('landing_type', 'varchar'),
+        ('round_number', 'integer'),
+        ('status', 'varchar'),
+    ]
+    names = ', '.join(name for name, _ in columns)
+    arrays = ', '.join(f'%s::{column_type}[]' for _, column_type in columns)
+    updated = [
+        name for name, _ in columns if name not in ('realm', 'front_id', 'province_id', 'date')]
+    updates = ', '.join(f'{name} = EXCLUDED.{name}' for name in updated)
+    # updated_at is changed only if values were changed, so it marks
+    # changed schedules in RETURNING
+    changed = '({}) IS DISTINCT FROM ({})'.format(
+        ', '.join(f'{SCHEDULE_TABLE}.{name}' for name in updated),
+        ', '.join(f'EXCLUDED.{name}' for name in updated),
+    )
+    cursor.execute(f'''
+        INSERT INTO {SCHEDULE_TABLE} ({names}, updated_at)
+        SELECT *, now() FROM unnest({arrays})
+        ON CONFLICT (realm, front_id, province_id, date) DO UPDATE SET {updates},
+            updated_at = CASE WHEN {changed}
+                THEN EXCLUDED.updated_at ELSE {SCHEDULE_TABLE}.updated_at END
+        RETURNING id, front_id, province_id, date, updated_at = now()
+    ''', [[schedule[name] for schedule in schedules] for name, _ in columns])
+    rows = cursor.fetchall()
+    return {
+        (front_id, province_id, date): schedule_id
+        for schedule_id, front_id, province_id, date, _ in rows
+    }, {schedule_id for schedule_id, *_, changed in rows if changed}
+
+
+def _replace_pretenders(cursor, schedule_ids, pretenders):
+    """Set pretenders of schedules to the list of (schedule_id, clan_id) pairs
+
+    Returns ids of schedules with changed pretenders
+    """
+    schedules_column = [schedule_id for schedule_id, _ in pretenders]
+    clans_column = [clan_id for _, clan_id in pretenders]
+    cursor.execute(f'''
+        DELETE FROM {PRETENDERS_TABLE}
+        WHERE schedule_id = ANY(%s::integer[])
+          AND (schedule_id, clan_id) NOT IN (
+            SELECT * FROM unnest(%s::integer[], %s::integer[]))
+        RETURNING schedule_id
+    ''', [schedule_ids, schedules_column, clans_column])
+    changed = {i for i, in cursor.fetchall()}
+    cursor.execute(f'''
+        INSERT INTO {PRETENDERS_TABLE} (schedule_id, clan_id)
+        SELECT * FROM unnest(%s::integer[], %s::integer[])
+        ON CONFLICT DO NOTHING
+        RETURNING schedule_id
+    ''', [schedules_column, clans_column])
+    return changed | {i for i, in cursor.fetchall()}
+
+
+def _upsert_battles(cursor, battles):
+    """battles is a list of (schedule_id, round, clan_a_id, clan_b_id, start_at)
+
+    Returns ids of schedules with new or changed battles
+    """
+    changed = set()
+    # NULL values are not equal in unique indexes, battles without opponent
+    # are covered by separate partial index
+    for conflict, rows in [
+        ('(schedule_id, round, clan_a_id, clan_b_id)',
+         [i for i in battles if i[3] is not None]),
+        ('(schedule_id, round, clan_a_id) WHERE clan_b_id IS NULL',
+         [i for i in battles if i[3] is None]),
+    ]:
+        if not rows:
+            continue
+        cursor.execute(f'''
+            INSERT INTO {BATTLES_TABLE} (schedule_id, round, clan_a_id, clan_b_id, start_at)
+            SELECT * FROM unnest(
+                %s::integer[], %s::integer[], %s::integer[], %s::integer[], %s::timestamptz[])
+            ON CONFLICT {conflict} DO UPDATE SET start_at = EXCLUDED.start_at
+                WHERE {BATTLES_TABLE}.start_at IS DISTINCT FROM EXCLUDED.start_at
+            RETURNING schedule_id
+        ''', [list(column) for column in zip(*rows)])
+        changed.update(i for i, in cursor.fetchall())
+    return changed
+
+
+def write_provinces(provinces_data, realm=None):
+    """Persist batch of normalized provinces data of the realm
+
+    Stale provinces aren't written, timetables of their clans are marked stale.
+    Returns ids of updated schedules
+    """
+    realm = realm or settings.DEFAULT_REALM
+    schedules = {}
+    stale_clan_ids = set()
+    for province_data in provinces_data:
+        if province_data.get('stale'):
+            # last known good data isn't written over fresher data in DB,
+            # timetables of its clans are served as stale
+            stale_clan_ids.update(province_data['pretenders'])
+            stale_clan_ids.add(province_data['owner_clan_id'])
+            continue
+        if not province_data['pretenders']:
+            continue
+        status = province_data['status']
+        key = (
+            province_data['front_id'],
+            province_data['province_id'],
+            get_battle_date(province_data['battles_start_at'], realm),
+        )
+        schedules[key] = {
+            'realm': realm,
+            'front_id': province_data['front_id'],
+            'front_name': province_data.get('front_name') or '',
+            'province_id': province_data['province_id'],
+            'province_name': province_data['province_name'],
+            'arena_id': province_data['arena_id'],
+            'arena_name': province_data['arena_name'],
+            'server': province_data['server'],
+            'date': key[2],
+            'prime_time': province_data['prime_time'],
+            'battles_start_at': province_data['battles_start_at'],
+            'owner_id': province_data['owner_clan_id'],
+            'landing_type': province_data.get('landing_type'),
+            # use this number only if battles have been started
+            # usually if contains irrelevant data before starting battles
+            'round_number': province_data['round_number'] if status == 'STARTED' else None,
+            'status': status,
+            'pretenders': province_data['pretenders'],
+            'active_battles': province_data['active_battles'],
+        }
+
+    stale_clan_ids.discard(None)
+    mark_timetables_stale(realm, stale_clan_ids)
+    if not schedules:
+        return []
+
+    clan_ids = set()
+    for schedule in schedules.values():
+        clan_ids.update(schedule['pretenders'])
+        clan_ids.add(schedule['owner_id'])
+        for battle in schedule['active_battles']:
+            clan_ids.add(battle['clan_a']['clan_id'])
+            clan_ids.add(battle['clan_b']['clan_id'])
+    clan_ids.discard(None)
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        _upsert_clans(cursor, realm, clan_ids)
+        # rows are locked in the same order by concurrent writers
+        schedule_ids, changed = _upsert_schedules(
+            cursor, [schedules[key] for key in sorted(schedules)])
+
+        pretenders = set()
+        battles = {}
+        for key, schedule in schedules.items():
+            schedule_id = schedule_ids[key]
+            pretenders.update((schedule_id, clan_id) for clan_id in schedule['pretenders'])
+            for battle in schedule['active_battles']:
+                battle_key = (
+                    schedule_id,
+                    battle['round'],
+                    battle['clan_a']['clan_id'],
+                    battle['clan_b']['clan_id'],
+                )
+                battles[battle_key] = battle_key + (battle['start_at'],)
+
+        changed |= _replace_pretenders(cursor, list(schedule_ids.values()), sorted(pretenders))
+        changed |= _upsert_battles(cursor, list(battles.values()))
+        # involvements and timetables of unchanged schedules are the same
+        if changed:
+            touched_clans = ClanInvolvement.rebuild(sorted(changed))
+            transaction.on_commit(lambda: invalidate_timetables(realm, touched_clans))
+
+    log.info('Updated %s schedules', len(schedule_ids))
+    return list(schedule_ids.values())